@@ -1,4 +1,6 @@
-import struct, sys, zlib, StringIO, time
+import struct, sys, zlib, StringIO, time, os
+from collections import deque, OrderedDict
+from multiprocessing.pool import ThreadPool
 
 #Pre block starts
 #start 0-indexted, end 1-indexted
@@ -88,22 +90,210 @@ def is_bgzf(filename):
      return False
   return True
 
+# Pre: handle is positioned at the start of a bgzf block
+# Post: [block_size, deflated bytes, crc and isize bytes]
+#       or None if there are no more blocks
+#       Only reads the block, the decompression is done by inflate_block
+def read_raw_block(handle):
+  header = handle.read(12)
+  if len(header) < 12: return None
+  gzip_mod_time, gzip_extra_flags, gzip_os,extra_len = struct.unpack("<LBBH",header[4:12])
+  extra = handle.read(extra_len)
+  pos = 0
+  block_size = None
+  #get block_size
+  while pos < extra_len:
+    subfield_id = extra[pos:pos+2]
+    subfield_len = struct.unpack("<H",extra[pos+2:pos+4])[0]
+    if subfield_id == 'BC':
+      block_size = struct.unpack("<H",extra[pos+4:pos+6])[0]+1
+    pos += subfield_len+4
+  #block_size is determined
+  deflate_size = block_size - 1 - extra_len - 19
+  deflated = handle.read(deflate_size)
+  tail = handle.read(8)
+  return [block_size,deflated,tail]
+
+# Pre: the deflated bytes of a block
+# Post: [data, crc of the data]
+#       zlib releases the GIL so this can be handed to a thread pool
+def inflate_block(deflated):
+  d = zlib.decompressobj(-15)
+  data = d.decompress(deflated)+d.flush()
+  return [data,zlib.crc32(data)]
+
+# Pre: the tail (crc and isize bytes) of a raw block and the inflated [data,crc]
+# Post: data if the size and crc match what the block expected
+def check_block(tail,inflated):
+  data, crc = inflated
+  expected_crc = tail[0:4]
+  expected_size = struct.unpack("<I",tail[4:8])[0]
+  if expected_size != len(data):
+    sys.stderr.write("ERROR unexpected size\n")
+    sys.exit()
+  if crc < 0:  crc = struct.pack("<i",crc)
+  else:  crc = struct.pack("<I",crc)
+  if crc != expected_crc:
+    sys.stderr.write("ERROR crc fail\n")
+    sys.exit()
+  return data
+
+# Pre: handle is positioned at the start of a bgzf block
+#      block_start is the byte position of that block
+# Post: dict with block_start, block_size and data
+#       block_size is zero and data is empty when there are no more blocks
+def load_block(handle,block_start):
+  raw = read_raw_block(handle)
+  if not raw: return {'block_start':block_start,'block_size':0,'data':''}
+  data = check_block(raw[2],inflate_block(raw[1]))
+  return {'block_start':block_start,'block_size':raw[0],'data':data}
+
+# Decompressed blocks kept for the whole process, least recently used
+# dropped first once they add up to more than max_bytes.
+# Blocks are keyed by file path and the byte position the block starts.
+# Pre: max_bytes limit on the decompressed data held, zero turns it off
+class BlockCache:
+  def __init__(self,max_bytes):
+    self.max_bytes = max_bytes
+    self.hits = 0
+    self.misses = 0
+    self._blocks = OrderedDict()
+    self._bytes = 0
+  def get(self,path,block_start):
+    block = self._blocks.pop((path,block_start),None)
+    if block is None:
+      self.misses += 1
+      return None
+    self.hits += 1
+    self._blocks[(path,block_start)] = block # now the most recent
+    return block
+  def put(self,path,block_start,block):
+    if len(block['data']) > self.max_bytes: return
+    if (path,block_start) in self._blocks: return
+    self._blocks[(path,block_start)] = block
+    self._bytes += len(block['data'])
+    while self._bytes > self.max_bytes:
+      self._bytes -= len(self._blocks.popitem(last=False)[1]['data'])
+  def set_max_bytes(self,max_bytes):
+    self.max_bytes = max_bytes
+    while self._bytes > self.max_bytes:
+      self._bytes -= len(self._blocks.popitem(last=False)[1]['data'])
+  def clear(self):
+    self._blocks.clear()
+    self._bytes = 0
+    self.hits = 0
+    self.misses = 0
+  # Post: dict of hits, misses, blocks and bytes held, and max_bytes
+  def get_stats(self):
+    return {'hits':self.hits,'misses':self.misses,'blocks':len(self._blocks),'bytes':self._bytes,'max_bytes':self.max_bytes}
+
+block_cache = BlockCache(32*1024*1024)
+
+# Post: what identifies a file in block_cache, the path along with its
+#       modification time and size so a rewritten file is not served
+#       stale blocks
+def block_cache_key(filename):
+  st = os.stat(filename)
+  return (os.path.abspath(filename),st.st_mtime,st.st_size)
+
+# Same as load_block but through block_cache
+# Pre: path identifies the file for the cache (see block_cache_key)
+#      None skips the cache
+#      store is False to only look in the cache, for blocks read in
+#      sequence that are unlikely to be asked for again
+# Post: the handle is left at the start of the next block either way
+def load_cached_block(handle,path,block_start,store=True):
+  if path is None or block_cache.max_bytes <= 0: return load_block(handle,block_start)
+  block = block_cache.get(path,block_start)
+  if block is not None:
+    handle.seek(block_start+block['block_size'])
+    return block
+  block = load_block(handle,block_start)
+  if store and block['block_size'] > 0: block_cache.put(path,block_start,block)
+  return block
+
+# Read ahead of the current block and inflate upcoming blocks on a
+# pool of threads.  Blocks are handed back in file order, each with
+# the byte position it started at so virtual offsets are unchanged.
+# Stands in for a pool's AsyncResult when the work was done in this
+# process, so ordered result queues can hold either
+class _Done:
+  def __init__(self,val):
+    self.val = val
+  def get(self):
+    return self.val
+
+# Pre: handle is positioned at block_start
+#      threads is the size of the pool
+#      (optional) depth is how many blocks to keep in flight
+class BlockReadAhead:
+  def __init__(self,handle,block_start,threads,depth=None):
+    self.fh = handle
+    self._pointer = block_start # where the next raw block starts
+    self._pool = ThreadPool(processes=threads)
+    self._depth = depth
+    if not self._depth: self._depth = threads*4
+    self._pending = deque()
+    self._finished = False
+
+  # Post: the next block in file order, same form as load_block
+  def next_block(self):
+    self._fill()
+    if len(self._pending) == 0:
+      return {'block_start':self._pointer,'block_size':0,'data':''}
+    block_start, block_size, tail, result = self._pending.popleft()
+    data = check_block(tail,result.get())
+    return {'block_start':block_start,'block_size':block_size,'data':data}
+
+  # Pre: the handle has been moved to block_start
+  # Post: work in flight is dropped and reading starts over from block_start
+  def reset(self,block_start):
+    self._pending.clear()
+    self._pointer = block_start
+    self._finished = False
+
+  def close(self):
+    self._pending.clear()
+    self._pool.close()
+    self._pool.join()
+
+  def _fill(self):
+    while not self._finished and len(self._pending) < self._depth:
+      raw = read_raw_block(self.fh)
+      if not raw:
+        self._finished = True
+        break
+      self._pending.append([self._pointer,raw[0],raw[2],self._pool.apply_async(inflate_block,(raw[1],))])
+      self._pointer += raw[0]
+
 class reader:
   # Methods adapted from biopython's bgzf.py
   # Pre: Handle is a file handle to read from
   #      (optional) blockStart is the byte start location of a block
   #      (optional) innerStart says how far into a decompressed bock to start
-  def __init__(self,handle,blockStart=None,innerStart=None):
+  #      (optional) threads greater than one inflates upcoming blocks
+  #                 on that many worker threads
+  def __init__(self,handle,blockStart=None,innerStart=None,threads=1):
     self.fh = handle
     self._pointer = 0
     self._block_start = 0
+    self._cache_path = None # random access goes through block_cache for named files
+    if hasattr(handle,'name') and os.path.isfile(handle.name):
+      self._cache_path = block_cache_key(handle.name)
+    self._cache_next = True # store the block we land on after a seek
     if blockStart: 
       self.fh.seek(blockStart)
       self._pointer = blockStart
+    self._read_ahead = None
+    if threads > 1:
+      self._read_ahead = BlockReadAhead(self.fh,self._pointer,threads)
     #holds block_size and data
     self._buffer = self._load_block()
     self._buffer_pos = 0
     if innerStart: self._buffer_pos = innerStart
+  def close(self):
+    if self._read_ahead: self._read_ahead.close()
+    self._read_ahead = None
   def get_block_start(self):
     return self._block_start
   def get_inner_start(self):
@@ -111,128 +301,164 @@ class reader:
   def seek(self,blockStart,innerStart):
     self.fh.seek(blockStart)
     self._pointer = blockStart
+    if self._read_ahead: self._read_ahead.reset(blockStart)
+    self._cache_next = True
     self._buffer_pos = 0
     self._buffer = self._load_block()
     self._buffer_pos = innerStart
   def read(self,size):
+    data = self._buffer['data']
+    if size < len(data) - self._buffer_pos: # all in this block
+      v = data[self._buffer_pos:self._buffer_pos+size]
+      self._buffer_pos += size
+      return v
     done = 0 #number of bytes that have been read so far
-    v = ''
+    parts = [] # joined once at the end rather than copied on every block
     while True:
       if size-done < len(self._buffer['data']) - self._buffer_pos:
-        v +=  self._buffer['data'][self._buffer_pos:self._buffer_pos+(size-done)]
+        parts.append(self._buffer['data'][self._buffer_pos:self._buffer_pos+(size-done)])
         self._buffer_pos += (size-done)
         #self.pointer += size
-        return v
+        return ''.join(parts)
       else: # we need more buffer
         vpart = self._buffer['data'][self._buffer_pos:]
         self._buffer = self._load_block()
-        v += vpart
+        parts.append(vpart)
         self._buffer_pos = 0
-        if len(self._buffer['data'])==0: return v
+        if len(self._buffer['data'])==0: return ''.join(parts)
         done += len(vpart)
 
+  # Pre: size in bytes
+  # Post: [buf, start, end] where buf[start:end] are the bytes read
+  #       If they are all in the current block, buf is the decompressed
+  #       block itself and nothing is copied.  Use with struct.unpack_from.
+  def read_buffer(self,size):
+    data = self._buffer['data']
+    start = self._buffer_pos
+    if size < len(data) - start:
+      self._buffer_pos += size
+      return [data,start,start+size]
+    v = self.read(size)
+    return [v,0,len(v)]
+
+  # Pre: b is a writable buffer such as a bytearray
+  # Post: b is filled straight from the decompressed blocks
+  #       returns the number of bytes read
+  def readinto(self,b):
+    view = memoryview(b)
+    size = len(view)
+    done = 0
+    while done < size:
+      data = self._buffer['data']
+      avail = len(data) - self._buffer_pos
+      if size-done < avail:
+        view[done:size] = buffer(data,self._buffer_pos,size-done)
+        self._buffer_pos += (size-done)
+        return size
+      view[done:done+avail] = buffer(data,self._buffer_pos,avail)
+      done += avail
+      self._buffer = self._load_block()
+      self._buffer_pos = 0
+      if len(self._buffer['data'])==0: break
+    return done
+
   def _load_block(self):
-    #pointer_start = self.fh.tell()
-    if not self.fh: return {'block_size':0,'data':''}
-    #self._block_start = self.fh.tell()
-    self._block_start = self._pointer
-    magic = self.fh.read(4)
-    self._pointer += 4
-    if len(magic) < 4:
-      #print 'end?'
-      #print len(self.fh.read())
-      return {'block_size':0,'data':''}
-    gzip_mod_time, gzip_extra_flags, gzip_os,extra_len = struct.unpack("<LBBH",self.fh.read(8))
-    self._pointer += 8
-    pos = 0
-    block_size = None
-    #get block_size
-    while pos < extra_len:
-      subfield_id = self.fh.read(2)
-      self._pointer += 2
-      subfield_len = struct.unpack("<H",self.fh.read(2))[0]
-      self._pointer += 2
-      subfield_data = self.fh.read(subfield_len)
-      self._pointer += subfield_len
-      pos += subfield_len+4
-      if subfield_id == 'BC':
-        block_size = struct.unpack("<H",subfield_data)[0]+1
-        #print 'blocksize :'+str(block_size)
-    #block_size is determined
-    deflate_size = block_size - 1 - extra_len - 19
-    #deflate_size = block_size - extra_len - 19
-    d = zlib.decompressobj(-15)
-    data = d.decompress(self.fh.read(deflate_size))+d.flush()
-    self._pointer += deflate_size
-    expected_crc = self.fh.read(4)
-    self._pointer += 4
-    expected_size = struct.unpack("<I",self.fh.read(4))[0]
-    self._pointer += 4
-    #print len(data)
-    #print expected_size
-    if expected_size != len(data):
-      sys.stderr.write("ERROR unexpected size\n")
-      sys.exit()
-    crc = zlib.crc32(data)
-    if crc < 0:  crc = struct.pack("<i",crc)
-    else:  crc = struct.pack("<I",crc)
-    if crc != expected_crc:
-      sys.stderr.write("ERROR crc fail\n")
-      sys.exit()
-    #print self._pointer-self._block_start
-    #print 'bsize '+str(block_size)
-    return {'block_size':block_size, 'data':data}
+    if not self.fh: return {'block_start':self._pointer,'block_size':0,'data':''}
+    if self._read_ahead:
+      block = self._read_ahead.next_block()
+    else:
+      block = load_cached_block(self.fh,self._cache_path,self._pointer,self._cache_next)
+      self._cache_next = False
+    self._block_start = block['block_start']
+    self._pointer = block['block_start']+block['block_size']
+    return block
+
+# The standard empty block that marks the end of a bgzf file
+EOF_BLOCK = "\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00\x42\x43\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00"
 
 class writer:
   #  Give it the handle of the stream to write to
-  def __init__(self,handle):
+  #  (optional) level is the zlib compression level 1-9
+  #  (optional) threads greater than one compresses blocks on that many
+  #             worker threads, blocks are still written in order
+  def __init__(self,handle,level=9,threads=1):
     #self.path = filename
     self.fh = handle
     self.buffer_size = 64000
     self.buffer = bytearray()
+    if level < 1 or level > 9:
+      sys.stderr.write("ERROR: compression level must be 1-9\n")
+      sys.exit()
+    self.level = level
+    self._pool = None
+    self._pending = deque()
+    self._depth = threads*4 # how many blocks to have in flight at once
+    if threads > 1:
+      self._pool = ThreadPool(processes=threads)
+    self._closed = False
   def __del__(self): 
     self.close()
   def write(self,bytes):
     self.buffer+=bytes
     if len(self.buffer) < self.buffer_size:
       return True
-    while len(self.buffer) >= self.buffer_size:
-      dobytes = self.buffer[0:self.buffer_size]
-      self.buffer = self.buffer[self.buffer_size:]
-      self._do_block(dobytes)
+    pos = 0
+    while len(self.buffer)-pos >= self.buffer_size:
+      self._do_block(self.buffer[pos:pos+self.buffer_size])
+      pos += self.buffer_size
+    self.buffer = self.buffer[pos:]
     return
 
+  # Write whats left and the end of file marker block
   def close(self):
-    if len(self.buffer) == 0:  return True
-    self._do_block(self.buffer)
-    self.buffer = []
+    if self._closed: return True
+    self._closed = True
+    if len(self.buffer) > 0:
+      self._do_block(self.buffer)
+    self.buffer = bytearray()
+    while len(self._pending) > 0:
+      self.fh.write(self._pending.popleft().get())
+    if self._pool:
+      self._pool.close()
+      self._pool.join()
+    self.fh.write(EOF_BLOCK)
     return True
 
   def _do_block(self,bytes):
-    # now we can output this  
-    isize = len(bytes)
-    s = StringIO.StringIO(bytes)
-    d = zlib.compressobj(9,zlib.DEFLATED,-zlib.MAX_WBITS)
-    data = d.compress(str(bytes))+d.flush()
-    datasize = len(data)
-    output = bytearray()
-    output += struct.pack('<B',31)  #IDentifier1
-    output += struct.pack('<B',139) #IDentifier2
-    output += struct.pack('<B',8)   #Compression Method
-    output += struct.pack('<B',4)   #FLaGs
-    output += struct.pack('<I',int(time.time())) #Modification TIME
-    output += struct.pack('<B',0)   #eXtra FLags
-    output += struct.pack('<B',0x03)   #Operating System = Unix
-    output += struct.pack('<H',6)   #eXtra LENgth
-    # Subfields
-    output += struct.pack('<B',66) #Subfield Identifier 1
-    output += struct.pack('<B',67) # Subfield Identifier 2
-    output += struct.pack('<H',2) #Subfield Length
-    outsize = datasize+19+6
-    output += struct.pack('<H',outsize) #Total block size minus one
-    output += data
-    crc = zlib.crc32(str(bytes))
-    if crc < 0:  output += struct.pack("<i",crc)
-    else:  output+= struct.pack("<I",crc)
-    output += struct.pack("<I",isize) #isize
-    self.fh.write(str(output))    
+    if not self._pool:
+      self.fh.write(compress_block(bytes,self.level))
+      return
+    self._pending.append(self._pool.apply_async(compress_block,(bytes,self.level,)))
+    while len(self._pending) >= self._depth:
+      self.fh.write(self._pending.popleft().get())
+
+# Pre: up to 64KB of uncompressed data and a zlib compression level
+# Post: a complete bgzf block as a string
+#       zlib releases the GIL so this can be handed to a thread pool
+def compress_block(bytes,level=9):
+  bytes = str(bytes)
+  isize = len(bytes)
+  d = zlib.compressobj(level,zlib.DEFLATED,-zlib.MAX_WBITS)
+  data = d.compress(bytes)+d.flush()
+  datasize = len(data)
+  output = bytearray()
+  output += struct.pack('<B',31)  #IDentifier1
+  output += struct.pack('<B',139) #IDentifier2
+  output += struct.pack('<B',8)   #Compression Method
+  output += struct.pack('<B',4)   #FLaGs
+  output += struct.pack('<I',int(time.time())) #Modification TIME
+  output += struct.pack('<B',0)   #eXtra FLags
+  output += struct.pack('<B',0x03)   #Operating System = Unix
+  output += struct.pack('<H',6)   #eXtra LENgth
+  # Subfields
+  output += struct.pack('<B',66) #Subfield Identifier 1
+  output += struct.pack('<B',67) # Subfield Identifier 2
+  output += struct.pack('<H',2) #Subfield Length
+  outsize = datasize+19+6
+  output += struct.pack('<H',outsize) #Total block size minus one
+  output += data
+  crc = zlib.crc32(bytes)
+  if crc < 0:  output += struct.pack("<i",crc)
+  else:  output+= struct.pack("<I",crc)
+  output += struct.pack("<I",isize) #isize
+  return str(output)
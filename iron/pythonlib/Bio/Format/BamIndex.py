@@ -1,6 +1,13 @@
-import gzip, sys, random, os
+import gzip, sys, random, os, struct, StringIO, re, mmap, heapq
+from array import array
+from collections import deque
+from multiprocessing import Pool
+from shutil import move, rmtree, copyfileobj
+from subprocess import Popen, PIPE
+from tempfile import mkdtemp
 from Bio.Range import GenomicRange
-from Bio.Format.Sam import BAMFile
+from Bio.Format.Sam import BAMFile, CompactBAM
+from Bio.Format.BGZF import reader as BGZF_reader, _Done
 
 # Index file is a gzipped TSV file with these fields:
 # 1. qname
@@ -76,9 +83,8 @@ class BAMIndex:
     return self._name_to_num.keys()
 
   def get_coords_by_name(self,name):
-    sys.stderr.write("error unimplemented get_coords_by_name\n")
-    sys.exit()
-    return [[self._lines[x]['filestart'],self._lines[x]['innerstart']] for x in self._queries[self._name_to_num[name]]]
+    if name not in self._name_to_num: return []
+    return [[self._lines[x]['filestart'],self._lines[x]['innerstart']] for x in self._name_to_num[name]]
 
   def get_longest_target_alignment_coords_by_name(self,name):
     longest = -1
@@ -160,8 +166,12 @@ class BAMIndexRandomAccessPrimary:
     if not index_file:
       sys.stderr.write("ERROR: Someway and somehow you need to define an index file.  Either through an alignment with one or directly or both\n")
       sys.exit()
-    fh = gzip.open(index_file)
     self.bests = []
+    self._binary = None
+    if is_binary_index(index_file): # primaries are already listed in the file
+      self._binary = BinaryBAMIndex(index_file)
+      return
+    fh = gzip.open(index_file)
     z = 0
     tot = 0
     for line in fh:
@@ -178,8 +188,10 @@ class BAMIndexRandomAccessPrimary:
     return
   def destroy(self):
     self.bests = []
+    if self._binary: self._binary.destroy()
     return
   def get_random_coord(self):
+    if self._binary: return self._binary.get_random_primary_coord()
     return random.choice(self.bests)
   #def get_alignment(self):
   #  if not self.alignment_file:
@@ -200,108 +212,585 @@ def check_flag(flag,inbit):
 # 4. bgzf inner block start
 # 5. aligned base count
 # 6. flag
-def write_index(path,index_file,verbose=False,samtools=False):
-  if verbose:
-    sys.stderr.write("scanning for primaries\n")
-  reads = {}
+# The bam is read once.  Records are handed out in runs of whole bgzf
+# blocks to worker processes that decode them, and the entries are
+# written in file order.  Any read (or mate) with more than one primary
+# alignment makes us choose a best alignment for every read, the one with
+# the most aligned bases, by an external sort rather than a dict of names.
+# Pre: path to a bam file, path to write the index to
+#      threads to decode with, tempdir for the sort files
+#      binary writes the BinaryBAMIndex format instead of the TSV
+#      flag_unaligned marks unaligned entries as not primary
+#      samtools is no longer used since its stream has no block coordinates
+def write_index(path,index_file,verbose=False,samtools=False,threads=1,tempdir=None,binary=False,flag_unaligned=False,blocks_per_chunk=64):
+  tdir = mkdtemp(prefix="weirathe.",dir=tempdir)
+  entries_file = tdir+'/entries.bgi'
+  keys_file = tdir+'/keys.txt'
+  of = gzip.open(entries_file,'wb',1)
+  kf = open(keys_file,'w')
+  bf = BAMFile(path,threads=threads)
+  p = None
+  if threads > 1:
+    p = Pool(processes=threads,initializer=_set_index_refs,initargs=(bf.ref_names,))
+  else: _set_index_refs(bf.ref_names)
+  pending = deque()
+  total = [0,0] # entries, unaligned entries still marked primary
+  def finish(r):
+    [text,keys,n_unaligned] = r.get()
+    of.write(text)
+    kf.write(keys)
+    total[1] += n_unaligned
+  fh = bf.fh
   z = 0
-  # force use of primary alignment flag if its not already used
-  # require one and only one primary alignment for each read (or mate)
-  fail_primary = False
-  b2 = None
-  if samtools:
-    b2 = SamtoolsBAMStream(path)
-  else:
-    b2 = BAMFile(path)
-
-  for e in b2:
-    z+=1
-    if verbose:
-      if z %1000==0: sys.stderr.write(str(z)+"\r")
-    name = e.value('qname')
-    if name not in reads:
-      reads[name] = {}
-    type = 'u'
-    if e.check_flag(64):
-      type = 'l' #left mate
-    elif e.check_flag(128):
-      type = 'r' #right mate
-    if not e.check_flag(2304):
-      if type not in reads[name]: reads[name][type] = 0
-      reads[name][type] += 1 # we have one
-      if reads[name][type] > 1: 
-        fail_primary = True
-        break # too many primaries set to be useful
-  # see if we have one primary set for each read
-  for name in reads:
-    for type in reads[name]:
-      if reads[name][type] != 1:
-        fail_primary = True
-  if verbose:
-    sys.stderr.write("\n")
-  if fail_primary:
-    sys.stderr.write("Failed to find a single primary for each read (or each mate).  Reading through bam to find best.\n")
-    best = {}
-    # must find the primary for each
-
-    b2 = None
-    if samtools:
-      b2 = SamtoolsBAMStream(path)
-    else:
-      b2 = BAMFile(path)
-    z = 0
-    for e in b2:
-      z += 1
-      if verbose:
-        if z %1000==0: sys.stderr.write(str(z)+"\r")
-      name = e.value('qname')
-      type = 'u'
-      if e.check_flag(64):
-        type = 'l' #left mate
-      elif e.check_flag(128):
-        type = 'r' #right mate
-      if name not in best: best[name] = {}
-      # get length
-      l = 0
-      if e.is_aligned():
-        l = e.get_aligned_bases_count()
-      if type not in best[name]: best[name][type] = {'line':z,'bpcnt':l}
-      if l > best[name][type]['bpcnt']: 
-        best[name][type]['bpcnt'] = l
-        best[name][type]['line'] = z
-    bestlinenumbers = set()
-    for name in best:
-      for type in best[name]:
-        bestlinenumbers.add(best[name][type]['line'])
-    if verbose:
-      sys.stderr.write("\n")
-  of = None
+  records = []
+  first = 1
+  blocks = 0
+  last_block = None
+  while True:
+    bstart = fh.get_block_start()
+    innerstart = fh.get_inner_start()
+    if bstart != last_block:
+      last_block = bstart
+      blocks += 1
+      if blocks > blocks_per_chunk and records:
+        # a run of whole blocks is ready to be decoded
+        if p: pending.append(p.apply_async(_index_records,args=(records,first,)))
+        else: pending.append(_Done(_index_records(records,first)))
+        while len(pending) > threads*2: finish(pending.popleft())
+        first = z+1
+        records = []
+        blocks = 1
+        if verbose: sys.stderr.write(str(z)+"\r")
+    [b,bs,be] = fh.read_buffer(4)
+    if be-bs < 4: break
+    block_size = struct.unpack_from('<i',b,bs)[0]
+    [data,ds,de] = fh.read_buffer(block_size)
+    records.append([bstart,innerstart,data[ds:de]])
+    z += 1
+  bf.close()
+  if records:
+    if p: pending.append(p.apply_async(_index_records,args=(records,first,)))
+    else: pending.append(_Done(_index_records(records,first)))
+  while pending: finish(pending.popleft())
+  if p:
+    p.close()
+    p.join()
+  of.close()
+  kf.close()
+  total[0] = z
+  if verbose: sys.stderr.write(str(z)+" reads indexed\n")
+  best_file = _find_best_entries(keys_file,tdir)
+  if best_file:
+    sys.stderr.write("Failed to find a single primary for each read (or each mate).  Using the best alignment for each.\n")
+  if not best_file and not binary and not (flag_unaligned and total[1] > 0):
+    move(entries_file,index_file)
+    rmtree(tdir)
+    return
+  # Rewrite the entries with the flags we settled on
+  w = None
   try:
-    of = gzip.open(index_file,'w')
+    if binary: w = BinaryBAMIndexWriter(index_file,tempdir=tdir)
+    else: w = gzip.open(index_file,'w')
   except IOError:
-    sys.sterr.write("ERROR: could not find or create index\n")
+    sys.stderr.write("ERROR: could not find or create index\n")
     sys.exit()
+  bests = None
+  next_best = None
+  if best_file:
+    bests = open(best_file)
+    next_best = _next_int(bests)
+  inf = gzip.open(entries_file)
+  z = 0
+  for line in inf:
+    z += 1
+    f = line.rstrip("\n").split("\t")
+    flag = int(f[5])
+    if bests:
+      if z == next_best: next_best = _next_int(bests)
+      else: flag = flag | 2304
+    elif flag_unaligned and f[4] == '0':
+      flag = flag | 2304
+    if binary: w.add(f[0],f[1],int(f[2]),int(f[3]),int(f[4]),flag)
+    else: w.write("\t".join(f[0:5])+"\t"+str(flag)+"\n")
+  inf.close()
+  if bests: bests.close()
+  w.close()
+  rmtree(tdir)
 
+_index_refs = None
+def _set_index_refs(ref_names):
+  global _index_refs
+  _index_refs = ref_names
 
-  b2 = None
-  if samtools:
-    b2 = SamtoolsBAMStream(path)
-  else:
-    b2 = BAMFile(path)
-  z = 0
-  for e in b2:
-    z+=1
-    if verbose:
-      if z%1000==0:
-        sys.stderr.write(str(z)+" reads indexed\r")
-    myflag = e.value('flag')
-    if fail_primary: # see if this should be a primary
-      if z not in bestlinenumbers:
-        myflag = myflag | 2304
+# Pre: records as [block start, inner start, bam record bytes]
+#      the entry number of the first of them
+# Post: [index lines, sort key lines, count of unaligned entries marked primary]
+#       sort keys are qname, mate type, aligned base count, entry number, primary
+def _index_records(records,first):
+  lines = []
+  keys = []
+  n_unaligned = 0
+  z = first
+  for [bstart,innerstart,data] in records:
+    e = CompactBAM(data,_index_refs,blockStart=bstart,innerStart=innerstart)
+    flag = e.value('flag')
+    qname = e.value('qname')
     rng = e.get_target_range()
-    if rng: 
+    rng_str = ''
+    l = 0
+    if rng:
+      rng_str = rng.get_range_string()
       l = e.get_aligned_bases_count()
-      of.write(e.value('qname')+"\t"+rng.get_range_string()+"\t"+str(e.get_block_start())+"\t"+str(e.get_inner_start())+"\t"+str(l)+"\t"+str(myflag)+"\n")
-    else: of.write(e.value('qname')+"\t"+''+"\t"+str(e.get_block_start())+"\t"+str(e.get_inner_start())+"\t"+'0'+"\t"+str(myflag)+"\n")
-  sys.stderr.write("\n")
+    type = 'u'
+    if flag & 64: type = 'l' #left mate
+    elif flag & 128: type = 'r' #right mate
+    primary = 0
+    if not flag & 2304:
+      primary = 1
+      if l == 0: n_unaligned += 1
+    lines.append(qname+"\t"+rng_str+"\t"+str(bstart)+"\t"+str(innerstart)+"\t"+str(l)+"\t"+str(flag)+"\n")
+    keys.append(qname+"\t"+type+"\t"+str(l)+"\t"+str(z)+"\t"+str(primary)+"\n")
+    z += 1
+  return [''.join(lines),''.join(keys),n_unaligned]
+
+# Sort the keys so each read (or mate) is together with its longest
+# alignment first, the earliest entry winning ties.
+# Pre: the sort keys written by _index_records, a directory to work in
+# Post: None if no read had more than one primary alignment
+#       otherwise a file of the best entry numbers in increasing order
+def _find_best_entries(keys_file,tdir):
+  env = dict(os.environ)
+  env['LC_ALL'] = 'C'
+  cmd = ['sort','-t',"\t",'-k1,1','-k2,2','-k3,3nr','-k4,4n','-S','1G','-T',tdir,keys_file]
+  ps = Popen(cmd,stdout=PIPE,env=env)
+  unsorted_file = tdir+'/best_unsorted.txt'
+  of = open(unsorted_file,'w')
+  fail_primary = False
+  last = None
+  primaries = 0
+  for line in ps.stdout:
+    f = line.rstrip("\n").split("\t")
+    if [f[0],f[1]] != last:
+      last = [f[0],f[1]]
+      primaries = 0
+      of.write(f[3]+"\n")
+    if f[4] == '1':
+      primaries += 1
+      if primaries > 1: fail_primary = True
+  ps.communicate()
   of.close()
+  if ps.returncode != 0:
+    sys.stderr.write("ERROR: sort failed on "+keys_file+"\n")
+    sys.exit()
+  if not fail_primary: return None
+  best_file = tdir+'/best.txt'
+  cmd = ['sort','-k1,1n','-S','1G','-T',tdir,'-o',best_file,unsorted_file]
+  ps = Popen(cmd,env=env)
+  ps.communicate()
+  if ps.returncode != 0:
+    sys.stderr.write("ERROR: sort failed on "+unsorted_file+"\n")
+    sys.exit()
+  return best_file
+
+def _next_int(fh):
+  line = fh.readline()
+  if not line: return None
+  return int(line)
+
+# Binary index file, a compact replacement for the gzipped TSV
+# Everything is little endian and fixed width so the file can be mmapped
+# 1. 'BGI\1'
+# 2. int32 reference count, then for each an int32 name length and name
+# 3. uint64 counts of entries, names and primary entries
+# 4. entries sorted by virtual offset (block start << 16 | inner start)
+#    32 bytes each: uint64 virtual offset, uint32 aligned base count,
+#    uint32 flag, int32 reference id (-1 unaligned), int32 1-indexed
+#    start, int32 end, uint32 name id
+# 5. names sorted by qname, 16 bytes each: uint64 offset of the name in
+#    the name text, uint32 first and uint32 count in the name entries
+# 6. uint32 entry numbers grouped by name, in file order within a name
+# 7. uint32 entry numbers of the primary alignments
+# 8. the name text, each name ending in a null
+_binary_magic = 'BGI\1'
+_binary_entry = struct.Struct('<QIIiiiI')
+_binary_name = struct.Struct('<QII')
+
+# Pre: path to an index
+# Post: True if its the binary format rather than the gzipped TSV
+def is_binary_index(index_file):
+  with open(index_file,'rb') as inf:
+    return inf.read(4) == _binary_magic
+
+# Pre: path to either index format
+# Post: a BinaryBAMIndex or a BAMIndex
+def load_index(index_file):
+  if is_binary_index(index_file): return BinaryBAMIndex(index_file)
+  return BAMIndex(index_file)
+
+# Same methods as BAMIndex but read straight out of an mmapped
+# binary index, so nothing is loaded up front
+class BinaryBAMIndex:
+  def __init__(self,index_file):
+    self.index_file = index_file
+    self._fh = open(index_file,'rb')
+    self._mm = mmap.mmap(self._fh.fileno(),0,access=mmap.ACCESS_READ)
+    if self._mm[0:4] != _binary_magic:
+      sys.stderr.write("ERROR: not a binary index "+index_file+"\n")
+      sys.exit()
+    pos = 4
+    n_ref = struct.unpack_from('<i',self._mm,pos)[0]
+    pos += 4
+    self._ref_names = []
+    for i in range(0,n_ref):
+      l_name = struct.unpack_from('<i',self._mm,pos)[0]
+      self._ref_names.append(self._mm[pos+4:pos+4+l_name])
+      pos += 4+l_name
+    self._n_entries, self._n_names, self._n_primary = struct.unpack_from('<QQQ',self._mm,pos)
+    self._entries_start = pos+24
+    self._names_start = self._entries_start+self._n_entries*_binary_entry.size
+    self._name_entries_start = self._names_start+self._n_names*_binary_name.size
+    self._primary_start = self._name_entries_start+self._n_entries*4
+    self._text_start = self._primary_start+self._n_primary*4
+
+  def destroy(self):
+    self._mm.close()
+    self._fh.close()
+
+  # Return how many entries have been indexed
+  def get_length(self):
+    return self._n_entries
+
+  def get_names(self):
+    return [self._get_name(i) for i in range(0,self._n_names)]
+
+  def get_coords_by_name(self,name):
+    return [[x['filestart'],x['innerstart']] for x in self._get_name_entries(name)]
+
+  def get_longest_target_alignment_coords_by_name(self,name):
+    for line in self._get_name_entries(name):
+      if line['flag'] & 2304 == 0:
+        return [line['filestart'],line['innerstart']]
+    return None
+
+  # Tak the 1-indexed line number and return its index information
+  def get_index_line(self,lnum):
+    if lnum < 1: 
+      sys.stderr.write("ERROR: line number should be greater than zero\n")
+      sys.exit()
+    elif lnum > self._n_entries:
+      sys.stderr.write("ERROR: too far this line nuber is not in index\n")
+      sys.exit()  
+    return self._get_entry(lnum-1)
+
+  # return the one-indexed line number given the coordinates
+  # entries are in virtual offset order so this is a binary search
+  def get_coord_line_number(self,coord):
+    voff = coord[0] << 16 | coord[1]
+    lo = 0
+    hi = self._n_entries
+    while lo < hi:
+      mid = (lo+hi)/2
+      if self._get_voffset(mid) < voff: lo = mid+1
+      else: hi = mid
+    if lo < self._n_entries and self._get_voffset(lo) == voff: return lo+1
+    return None
+
+  def get_primary_count(self):
+    return self._n_primary
+
+  # Post: [block start, inner start] of a primary alignment at random
+  def get_random_primary_coord(self):
+    if self._n_primary == 0: return None
+    i = struct.unpack_from('<I',self._mm,self._primary_start+4*random.randint(0,self._n_primary-1))[0]
+    voff = self._get_voffset(i)
+    return [voff >> 16,voff & 0xFFFF]
+
+  def _get_voffset(self,i):
+    return struct.unpack_from('<Q',self._mm,self._entries_start+i*_binary_entry.size)[0]
+
+  def _get_entry(self,i):
+    voff, basecount, flag, refid, start, end, name_id = _binary_entry.unpack_from(self._mm,self._entries_start+i*_binary_entry.size)
+    rng_str = ''
+    if refid >= 0: rng_str = self._ref_names[refid]+':'+str(start)+'-'+str(end)
+    return {'qname':self._get_name(name_id),'rng_str':rng_str,'filestart':voff >> 16,'innerstart':voff & 0xFFFF,'basecount':basecount,'flag':flag}
+
+  def _get_name(self,name_id):
+    offset = _binary_name.unpack_from(self._mm,self._names_start+name_id*_binary_name.size)[0]
+    start = self._text_start+offset
+    return self._mm[start:self._mm.find('\0',start)]
+
+  # binary search of the sorted names
+  def _get_name_entries(self,name):
+    lo = 0
+    hi = self._n_names
+    while lo < hi:
+      mid = (lo+hi)/2
+      if self._get_name(mid) < name: lo = mid+1
+      else: hi = mid
+    if lo >= self._n_names or self._get_name(lo) != name: return []
+    offset, first, count = _binary_name.unpack_from(self._mm,self._names_start+lo*_binary_name.size)
+    nums = struct.unpack_from('<'+str(count)+'I',self._mm,self._name_entries_start+first*4)
+    return [self._get_entry(x) for x in nums]
+
+# Collects index entries and writes the binary index on close
+# Entries go straight to a temporary file and the names are sorted in
+# runs that are spilled to disk and merged, so memory does not grow
+# with the number of alignments.
+# Pre: path to write to
+#      (optional) tempdir for the temporary files
+#      (optional) max_entries_in_memory names to sort before spilling a run
+class BinaryBAMIndexWriter:
+  def __init__(self,index_file,tempdir=None,max_entries_in_memory=5000000):
+    self.index_file = index_file
+    self._tdir = mkdtemp(prefix="weirathe.",dir=tempdir)
+    self._max_entries = max_entries_in_memory
+    self._ref_ids = {}
+    self._ref_names = []
+    self._entries = open(self._tdir+'/entries.bin','wb')
+    self._names = [] # qname, null, hex entry number lines still to sort
+    self._runs = []
+    self._n = 0
+    self._last_voffset = -1
+    self._in_order = True
+  # Pre: qname, target range string (empty if unaligned) and the rest of a TSV line
+  def add(self,qname,rng_str,filestart,innerstart,basecount,flag):
+    refid, start, end = -1, 0, 0
+    if rng_str:
+      m = re.match('^(.+):(\d+)-(\d+)$',rng_str)
+      if m.group(1) not in self._ref_ids:
+        self._ref_ids[m.group(1)] = len(self._ref_names)
+        self._ref_names.append(m.group(1))
+      refid, start, end = self._ref_ids[m.group(1)], int(m.group(2)), int(m.group(3))
+    voffset = filestart << 16 | innerstart
+    if voffset < self._last_voffset: self._in_order = False
+    self._last_voffset = voffset
+    # the name id is filled in once the names are sorted
+    self._entries.write(_binary_entry.pack(voffset,basecount,flag,refid,start,end,0))
+    # a null sorts before any name character and the fixed width hex
+    # keeps entry numbers in order within a name
+    self._names.append(qname+'\0'+('%016x' % self._n)+"\n")
+    self._n += 1
+    if len(self._names) >= self._max_entries: self._write_run()
+  def close(self):
+    self._entries.close()
+    self._write_run()
+    n = self._n
+    entries_file = self._tdir+'/entries.bin'
+    position = None
+    if not self._in_order: position = self._sort_entries(entries_file)
+    of = open(self.index_file,'w+b')
+    of.write(_binary_magic+struct.pack('<i',len(self._ref_names)))
+    for name in self._ref_names: of.write(struct.pack('<i',len(name))+name)
+    counts_start = of.tell()
+    of.write(struct.pack('<QQQ',n,0,0))
+    entries_start = of.tell()
+    # copy the entries in, picking out the primary alignments
+    n_primary = 0
+    pf = open(self._tdir+'/primary.bin','wb')
+    inf = open(entries_file,'rb')
+    j = 0
+    while True:
+      chunk = inf.read(_binary_entry.size*65536)
+      if not chunk: break
+      of.write(chunk)
+      primary = array('I')
+      for k in range(0,len(chunk),_binary_entry.size):
+        if struct.unpack_from('<I',chunk,k+12)[0] & 2304 == 0: primary.append(j)
+        j += 1
+      pf.write(primary.tostring())
+      n_primary += len(primary)
+    inf.close()
+    pf.close()
+    of.flush()
+    # merge the sorted names, numbering them and setting each entry's name id
+    mm = None
+    if n > 0: mm = mmap.mmap(of.fileno(),0)
+    nf = open(self._tdir+'/names.bin','wb')
+    ef = open(self._tdir+'/name_entries.bin','wb')
+    tf = open(self._tdir+'/text.bin','wb')
+    handles = [open(x,'rb') for x in self._runs]
+    n_names = 0
+    text_offset = 0
+    first = 0
+    last = None
+    nums = []
+    for line in heapq.merge(*handles):
+      qname = line[0:-18]
+      i = int(line[-17:-1],16)
+      if position is not None: i = position[i]
+      if qname != last:
+        if last is not None:
+          n_names, text_offset, first = self._write_name(nf,ef,tf,last,nums,n_names,text_offset,first)
+        last = qname
+        nums = []
+      nums.append(i)
+      struct.pack_into('<I',mm,entries_start+i*_binary_entry.size+28,n_names)
+    if last is not None:
+      n_names, text_offset, first = self._write_name(nf,ef,tf,last,nums,n_names,text_offset,first)
+    for h in handles: h.close()
+    nf.close()
+    ef.close()
+    tf.close()
+    if mm: mm.close()
+    of.seek(counts_start)
+    of.write(struct.pack('<QQQ',n,n_names,n_primary))
+    of.seek(0,2)
+    for fname in ['names.bin','name_entries.bin','primary.bin','text.bin']:
+      inf = open(self._tdir+'/'+fname,'rb')
+      copyfileobj(inf,of)
+      inf.close()
+    of.close()
+    rmtree(self._tdir)
+  def _write_name(self,nf,ef,tf,qname,nums,n_names,text_offset,first):
+    nums.sort()
+    nf.write(_binary_name.pack(text_offset,first,len(nums)))
+    ef.write(array('I',nums).tostring())
+    tf.write(qname+'\0')
+    return [n_names+1,text_offset+len(qname)+1,first+len(nums)]
+  def _write_run(self):
+    self._names.sort()
+    fname = self._tdir+'/run'+str(len(self._runs))+'.txt'
+    of = open(fname,'wb')
+    of.write(''.join(self._names))
+    of.close()
+    self._runs.append(fname)
+    self._names = []
+  # Entries were not added in virtual offset order.  Rare, so it is
+  # done in memory.
+  # Post: the entries file is rewritten in order
+  #       returns the new position of each entry by the order it was added
+  def _sort_entries(self,entries_file):
+    inf = open(entries_file,'rb')
+    data = inf.read()
+    inf.close()
+    size = _binary_entry.size
+    order = sorted(range(0,self._n),key=lambda i: struct.unpack_from('<Q',data,i*size)[0])
+    position = array('L',[0])*self._n
+    of = open(entries_file,'wb')
+    for j in range(0,self._n):
+      i = order[j]
+      position[i] = j
+      of.write(data[i*size:i*size+size])
+    of.close()
+    return position
+
+# Pre: a gzipped TSV .bgi and a path to write the binary index
+#      (optional) tempdir for the temporary files
+def convert_index(tsv_index_file,binary_index_file,tempdir=None):
+  w = BinaryBAMIndexWriter(binary_index_file,tempdir=tempdir)
+  inf = gzip.open(tsv_index_file)
+  for line in inf:
+    f = line.rstrip("\n").split("\t")
+    w.add(f[0],f[1],int(f[2]),int(f[3]),int(f[4]),int(f[5]))
+  inf.close()
+  w.close()
+
+# The standard samtools index of a coordinate sorted bam
+# Pre: path to a .bai file, or a bgzf compressed .csi file
+# Bins are kept per reference as a dict of bin to [loffset, chunks]
+# where chunks are [start, end] virtual file offsets
+# (block start << 16 | inner start).  .bai also has a linear index.
+class BAI:
+  def __init__(self,index_file):
+    self.index_file = index_file
+    with open(index_file,'rb') as inf:
+      data = inf.read()
+    if data[0:2] == "\x1f\x8b": # csi is bgzf compressed
+      br = BGZF_reader(StringIO.StringIO(data))
+      parts = []
+      while True:
+        v = br.read(1000000)
+        if len(v) == 0: break
+        parts.append(v)
+      data = ''.join(parts)
+    self._is_csi = False
+    if data[0:4] == 'BAI\1':
+      self.min_shift = 14
+      self.depth = 5
+      pos = 4
+    elif data[0:4] == 'CSI\1':
+      self._is_csi = True
+      self.min_shift, self.depth, l_aux = struct.unpack_from('<iii',data,4)
+      pos = 16+l_aux
+    else:
+      sys.stderr.write("ERROR: not a .bai or .csi index "+index_file+"\n")
+      sys.exit()
+    self._pseudo_bin = (((1 << ((self.depth+1)*3))-1)/7)+1
+    self._bins = []
+    self._linear = []
+    n_ref = struct.unpack_from('<i',data,pos)[0]
+    pos += 4
+    for i in range(0,n_ref):
+      bins = {}
+      n_bin = struct.unpack_from('<i',data,pos)[0]
+      pos += 4
+      for j in range(0,n_bin):
+        bin = struct.unpack_from('<I',data,pos)[0]
+        pos += 4
+        loffset = 0
+        if self._is_csi:
+          loffset = struct.unpack_from('<Q',data,pos)[0]
+          pos += 8
+        n_chunk = struct.unpack_from('<i',data,pos)[0]
+        pos += 4
+        v = struct.unpack_from('<'+str(n_chunk*2)+'Q',data,pos)
+        pos += n_chunk*16
+        if bin == self._pseudo_bin: continue # metadata not alignments
+        bins[bin] = [loffset,[[v[k],v[k+1]] for k in range(0,len(v),2)]]
+      self._bins.append(bins)
+      if not self._is_csi:
+        n_intv = struct.unpack_from('<i',data,pos)[0]
+        pos += 4
+        self._linear.append(struct.unpack_from('<'+str(n_intv)+'Q',data,pos))
+        pos += n_intv*8
+
+  # Pre: reference id and a 0-indexed half open region beg to end
+  # Post: sorted and merged [start, end] virtual offset chunks
+  #       that hold every alignment overlapping the region
+  def get_chunks(self,tid,beg,end):
+    if tid < 0 or tid >= len(self._bins): return []
+    bins = self._bins[tid]
+    min_off = self._get_min_offset(tid,beg)
+    chunks = []
+    for bin in reg2bins(beg,end,self.min_shift,self.depth):
+      if bin not in bins: continue
+      for c in bins[bin][1]:
+        if c[1] > min_off: chunks.append(c[:])
+    chunks.sort()
+    merged = []
+    for c in chunks:
+      if len(merged) > 0 and c[0] <= merged[-1][1]:
+        if c[1] > merged[-1][1]: merged[-1][1] = c[1]
+        continue
+      merged.append(c)
+    if len(merged) > 0 and merged[0][0] < min_off: merged[0][0] = min_off
+    return merged
+
+  # Nothing before this virtual offset can overlap beg
+  def _get_min_offset(self,tid,beg):
+    if not self._is_csi:
+      lin = self._linear[tid]
+      if len(lin) == 0: return 0
+      return lin[min(beg >> self.min_shift,len(lin)-1)]
+    # csi keeps it on the bins, use the smallest bin holding beg that exists
+    bins = self._bins[tid]
+    bin = (((1 << (self.depth*3))-1)/7) + (beg >> self.min_shift)
+    while bin > 0:
+      if bin in bins: return bins[bin][0]
+      bin = (bin-1) >> 3
+    if 0 in bins: return bins[0][0]
+    return 0
+
+# Pre: 0-indexed half open region beg to end
+# Post: list of every bin that could hold an alignment overlapping it
+#       (from the SAM specification, min_shift 14 and depth 5 for .bai)
+def reg2bins(beg,end,min_shift=14,depth=5):
+  bins = []
+  end -= 1
+  s = min_shift+depth*3
+  t = 0
+  for l in range(0,depth+1):
+    bins.extend(range(t+(beg >> s),t+(end >> s)+1))
+    t += 1 << (l*3)
+    s -= 3
+  return bins
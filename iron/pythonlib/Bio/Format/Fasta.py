@@ -1,16 +1,21 @@
-import os, re, gzip
+import os, re, gzip, sys, struct, mmap, zlib
+from array import array
+from bisect import bisect_right
 import Bio.Sequence
+from Bio.Format.BGZF import reader as BGZF_reader, load_block
 
 #Iterable Stream
+# Reads line by line, keeping the sequence lines of a record in a list and
+# joining them once, so a record costs time in proportion to its length.
+# Pre: handle to a fasta, uncompressed or gzipped (including BGZF)
+#      (optional) custom_buffer_size bytes to read from the handle at a time
+# Post: Seq for each entry named by the first word of its header
+#       entries with no sequence are skipped
 class FastaHandle:
   def __init__(self,fh,custom_buffer_size=10000000):
     self.fh = fh
     self.buffer_size = custom_buffer_size
-    self.working_string = self.fh.read(self.buffer_size)
-    self.buffered_results = []
-    self.p = re.compile('>([^\n]+)\n([^>]+)')
-    self.file_finished = False
-    if not self.working_string: self.file_finished = True
+    self._records = self._read_records()
 
   def __iter__(self):
     return self
@@ -22,33 +27,25 @@ class FastaHandle:
       return v
 
   def get_entry(self):
-    if len(self.buffered_results) > 0:
-      m = self.buffered_results.pop(0)
-      m1 = re.match('(\S+)',m.group(1))
-      return Bio.Sequence.Seq(m.group(2).rstrip(),m1.group(1))
-    vals = [x for x in self.p.finditer(self.working_string)]
-    while not self.file_finished:
-      if vals: #have a match
-        if vals[0].end() != len(self.working_string): # match is totally covered
-          break
-      chunk = self.fh.read(self.buffer_size)
-      if not chunk: 
-        self.file_finished = True
-        break
-      self.working_string += chunk
-      vals = [x for x in self.p.finditer(self.working_string)]
-    # If we've finished file clean up
-    if self.file_finished:
-      self.buffered_results = [x for x in self.p.finditer(self.working_string)]
-      self.working_string = ''
-    else:  # we have more to do so fix working string buffer
-      self.buffered_results = [x for x in vals if x.end() != len(self.working_string)]
-      self.working_string = self.working_string[self.buffered_results[-1].end():]
-    if len(self.buffered_results) > 0:
-      m = self.buffered_results.pop(0)
-      m1 = re.match('(\S+)',m.group(1))
-      return Bio.Sequence.Seq(m.group(2).rstrip(),m1.group(1))
+    for v in self._records:
+      return v
     return None
+
+  def _read_records(self):
+    name = None
+    lines = []
+    for line in _chunk_lines(_handle_chunks(self.fh,self.buffer_size)):
+      if line[0:1] == '>':
+        if lines: yield Bio.Sequence.Seq(''.join(lines),name)
+        fields = line[1:].split()
+        name = ''
+        if len(fields) > 0: name = fields[0]
+        lines = []
+      elif name is not None:
+        line = line.rstrip()
+        if line: lines.append(line)
+    if lines: yield Bio.Sequence.Seq(''.join(lines),name)
+
 # Slicable fast fasta
 # It loses any additional header information in fasta header
 # only the first non-whitespace is what we use
@@ -107,24 +104,39 @@ class FastaData:
 
 # Do random access with an indexed Fasta File
 # Creates the index if its not there already
-# Pre: An uncompressed fasta file
+# Pre: A fasta file, uncompressed or BGZF compressed (bgzip)
 #      Can be called by chromosome and location slices
 #          Slices are same as array - zero indexed
+#      (optional) index a samtools style .fai
+#      (optional) gzi a samtools style .gzi for a BGZF fasta
 # Post: Makes index if doesn't exist upon being called.
 #       Can access sequence
 # Modifies: File IO reads the fasta, and writes a fasta index file
 class FastaFile:
-  def __init__(self,fname,index=None):
+  def __init__(self,fname,index=None,gzi=None):
     self.fname = fname
     self.index = index
+    self.gzi = gzi
     self.fai = {}
+    self._bgzf = None
+    self._is_bgzf = _is_bgzf_file(fname)
     if not self.index:
       if os.path.isfile(self.fname+'.fai'): self.index = self.fname+'.fai'
-    if not self.index:
+    if self._is_bgzf and not self.gzi:
+      if os.path.isfile(self.fname+'.gzi'): self.gzi = self.fname+'.gzi'
+    if not self.index or (self._is_bgzf and not self.gzi):
       sys.stderr.write("Warning no index trying to create\n")
       self._make_index()
     self._read_index()
-    self.fh = open(fname)
+    self.fh = open(fname,'rb')
+    if self._is_bgzf:
+      self._read_gzi()
+      self._bgzf = BGZF_reader(self.fh)
+
+  def keys(self):
+    return self.fai.keys()
+  def __contains__(self,chr):
+    return chr in self.fai
 
   def __getitem__(self,key):
     chr = FastaFile.Chromosome(self,key)
@@ -143,7 +155,9 @@ class FastaFile:
         sys.stderr.write("ERROR: FastaFile doesn't support step access\n")
         sys.exit()
       clen = self.outer.fai[self.chr]['length']
-      return self.outer.get_sequence(self.chr,val.start+1,min(val.stop,clen))
+      [start,stop,step] = val.indices(clen)
+      if stop <= start: return ''
+      return self.outer.get_sequence(self.chr,start+1,stop)
 
     def __len__(self):
       return self.outer.fai[self.chr]['length']
@@ -157,18 +171,64 @@ class FastaFile:
     if not start: start = 1
     if not end: end = self.fai[chr]['length']
     if not dir: dir = '+'
-    [sblocks,srem] = divmod(start,self.fai[chr]['linebases'])
-    missing_start = sblocks*(self.fai[chr]['linewidth']-self.fai[chr]['linebases'])
-    [eblocks,erem] = divmod(end,self.fai[chr]['linebases'])
-    missing_end = eblocks*(self.fai[chr]['linewidth']-self.fai[chr]['linebases'])
-    pos_start = self.fai[chr]['offset']+start+missing_start-1
-    pos_end = self.fai[chr]['offset']+end+missing_end
-    self.fh.seek(pos_start)
-    v = self.fh.read(pos_end-pos_start).replace("\n",'')
+    if end < start: return ''
+    e = self.fai[chr]
+    # byte positions of the first base and one past the last base
+    [sline,scol] = divmod(start-1,e['linebases'])
+    [eline,ecol] = divmod(end-1,e['linebases'])
+    pos_start = e['offset']+sline*e['linewidth']+scol
+    pos_end = e['offset']+eline*e['linewidth']+ecol+1
+    v = self._read_at(pos_start,pos_end-pos_start).translate(None,"\r\n")
     if dir == '-':
       return Bio.Sequence.rc(v)
     return v
 
+  # Fetch many ranges with few reads.  Ranges are sorted and any on the
+  # same chromosome within max_gap bases of each other are read together
+  # as one stretch, up to max_read bases, then sliced apart.
+  # Pre: list of ranges with chr, start, end and direction (GenomicRange)
+  #      1-indexed and inclusive like get_sequence
+  #      (optional) max_gap bases between ranges to read through
+  #      (optional) max_read bases to stop growing a stretch at
+  # Post: list of sequences in the same order as ranges
+  def get_sequences(self,ranges,max_gap=65536,max_read=4000000):
+    out = [None]*len(ranges)
+    order = sorted(range(0,len(ranges)),key=lambda i: (self.fai[ranges[i].chr]['offset'],ranges[i].start))
+    i = 0
+    while i < len(order):
+      first = ranges[order[i]]
+      chr = first.chr
+      start = first.start
+      end = first.end
+      j = i+1
+      while j < len(order):
+        r = ranges[order[j]]
+        if r.chr != chr or r.start > end+max_gap: break
+        if r.end > end:
+          if r.end-start+1 > max_read: break
+          end = r.end
+        j += 1
+      v = self.get_sequence(chr,start,min(end,self.fai[chr]['length']))
+      vc = None # complement of the stretch, made once if any range needs it
+      for k in order[i:j]:
+        r = ranges[k]
+        if r.direction == '-':
+          if vc is None: vc = v.translate(Bio.Sequence.complement_table)
+          out[k] = vc[r.start-start:r.end-start+1][::-1]
+        else:
+          out[k] = v[r.start-start:r.end-start+1]
+      i = j
+    return out
+
+  # Pre: position in the uncompressed fasta and number of bytes
+  def _read_at(self,pos,size):
+    if not self._bgzf:
+      self.fh.seek(pos)
+      return self.fh.read(size)
+    i = bisect_right(self._gzi_uncompressed,pos)-1
+    self._bgzf.seek(self._gzi_compressed[i],pos-self._gzi_uncompressed[i])
+    return self._bgzf.read(size)
+
   def _read_index(self):
     with open(self.index) as inf:
       for line in inf:
@@ -180,36 +240,379 @@ class FastaFile:
         self.fai[v[0]]['linebases'] = int(v[3])
         self.fai[v[0]]['linewidth'] = int(v[4])
 
+  # The first block at 0,0 is not written in a .gzi
+  def _read_gzi(self):
+    self._gzi_compressed = [0]
+    self._gzi_uncompressed = [0]
+    with open(self.gzi,'rb') as inf:
+      count = struct.unpack('<Q',inf.read(8))[0]
+      for i in range(0,count):
+        [c,u] = struct.unpack('<QQ',inf.read(16))
+        self._gzi_compressed.append(c)
+        self._gzi_uncompressed.append(u)
+
   def _make_index(self):
-    of = None
-    try:
-      of = open(self.fname+'.fai','w')
-    except IOError:
-      sys.stderr.write("ERROR: could not open file\n")
-      sys.exit()
     self.index = self.fname+'.fai'
-    # now we can parse the file
-    p1 = re.compile('>([^\r\n]+)([\n\r]+)([^>]+)')
-    p2 = re.compile('([^\r\n]+)($|[\n\r]+)')
-    pos = 0
-    for m1 in p1.finditer(open(self.fname).read()):
-      name = m1.group(1)
-      pos += len(m1.group(1))+1+len(m1.group(2))
-      linewidth_bases = None
-      linewidth_bytes = None
-      seqlen = 0
-      nextoffset = len(m1.group(3))
-      for m2 in p2.finditer(m1.group(3)):
-        if not linewidth_bases: linewidth_bases = len(m2.group(1))
-        elif linewidth_bases != len(m2.group(1)) and len(m2.group(2)) > 0:
-          sys.stderr.write("ERROR: irregular line breaks\n")
-          sys.exit()
-        if not linewidth_bytes: linewidth_bytes = len(m2.group(1))+len(m2.group(2))
-        elif linewidth_bytes != len(m2.group(1))+len(m2.group(2)) and len(m2.group(2)) > 0:
-          sys.stderr.write("ERROR: irregular bytes line breaks\n")
-          sys.exit() 
-        seqlen += len(m2.group(1))      
-      of.write(name + "\t" + str(seqlen) + "\t"+str(pos)+"\t" + str(linewidth_bases) + "\t" + str(linewidth_bytes)+"\n")
-      pos += nextoffset
+    if self._is_bgzf:
+      self.gzi = self.fname+'.gzi'
+      write_fasta_index(self.fname,self.index,self.gzi)
+    else:
+      write_fasta_index(self.fname,self.index)
+
+# Pre: first bytes of a file
+# Post: True if the file starts with a gzip header carrying the BGZF 'BC' field
+def _is_bgzf_file(fname):
+  with open(fname,'rb') as inf:
+    v = inf.read(18)
+  if len(v) < 18 or v[0:4] != "\x1f\x8b\x08\x04": return False
+  return v[12:14] == 'BC'
+
+# Write a samtools compatible .fai, reading the fasta one line at a time
+# so memory does not grow with the genome.
+# Pre: fasta file, uncompressed or BGZF, and the .fai to write
+#      (optional) gzi to also write the BGZF block offsets (BGZF only)
+# Post: name, length, offset, line bases and line bytes for each sequence
+#       offsets are in the uncompressed fasta
+def write_fasta_index(fasta_file,index_file,gzi_file=None):
+  entries = []
+  blocks = []
+  if _is_bgzf_file(fasta_file):
+    inf = open(fasta_file,'rb')
+    chunks = _bgzf_chunks(inf,blocks)
+  elif re.search('\.gz$',fasta_file):
+    sys.stderr.write("ERROR: a gzipped fasta needs to be compressed with bgzip for random access\n")
+    sys.exit()
+  else:
+    inf = open(fasta_file,'rb')
+    chunks = iter(lambda: inf.read(16*1024*1024),'')
+  pos = 0 # uncompressed position of the current line
+  cur = None # [name, length, offset, linebases, linewidth]
+  short = False # a line shorter than the first has been seen
+  for line in _chunk_lines(chunks):
+    size = len(line)
+    if line[0:1] == '>':
+      if cur: entries.append(cur)
+      fields = line[1:].split()
+      name = ''
+      if len(fields) > 0: name = fields[0]
+      cur = [name,0,pos+size,0,0]
+      short = False
+    elif cur:
+      bases = len(line.rstrip("\r\n"))
+      if bases > 0 and short:
+        sys.stderr.write("ERROR: irregular line breaks in "+cur[0]+"\n")
+        sys.exit()
+      if cur[3] == 0 and bases > 0:
+        cur[3] = bases
+        cur[4] = size
+      elif bases > cur[3]:
+        sys.stderr.write("ERROR: irregular line breaks in "+cur[0]+"\n")
+        sys.exit()
+      elif bases < cur[3] or size != cur[4]:
+        short = True
+      cur[1] += bases
+    pos += size
+  if cur: entries.append(cur)
+  inf.close()
+  of = None
+  try:
+    of = open(index_file,'w')
+  except IOError:
+    sys.stderr.write("ERROR: could not open file\n")
+    sys.exit()
+  for e in entries:
+    of.write("\t".join([str(x) for x in e])+"\n")
+  of.close()
+  if gzi_file:
+    # every block start after the first, as [compressed, uncompressed]
+    of = open(gzi_file,'wb')
+    of.write(struct.pack('<Q',len(blocks)-1))
+    for [c,u] in blocks[1:]:
+      of.write(struct.pack('<QQ',c,u))
     of.close()
 
+# Pre: handle at the start of a BGZF file
+#      blocks list to fill with [compressed, uncompressed] block starts
+# Post: generator of the decompressed data one block at a time
+def _bgzf_chunks(inf,blocks):
+  cpos = 0
+  upos = 0
+  while True:
+    block = load_block(inf,cpos)
+    if block['block_size'] == 0: break
+    blocks.append([cpos,upos])
+    cpos += block['block_size']
+    upos += len(block['data'])
+    if len(block['data']) > 0: yield block['data']
+
+# Pre: handle to a file that may be gzipped
+#      size of each read, and the most decompressed data yielded at once
+# Post: generator of the data, decompressed if it starts with a gzip header
+#       concatenated gzip members (like BGZF blocks) are all read
+def _handle_chunks(fh,size):
+  first = fh.read(max(size,2)) # enough to see the gzip magic
+  if first[0:2] != "\x1f\x8b":
+    if first: yield first
+    for chunk in iter(lambda: fh.read(size),''): yield chunk
+    return
+  d = zlib.decompressobj(16+zlib.MAX_WBITS)
+  chunk = first
+  while chunk:
+    while chunk:
+      # at most size bytes come out at a time
+      v = d.decompress(chunk,size)
+      if v: yield v
+      if d.unused_data:
+        # the rest of the chunk is the next gzip member
+        chunk = d.unused_data
+        d = zlib.decompressobj(16+zlib.MAX_WBITS)
+      else: chunk = d.unconsumed_tail
+    chunk = fh.read(size)
+  v = d.flush()
+  if v: yield v
+
+# Pre: generator of data chunks
+# Post: generator of lines, each with its line break
+def _chunk_lines(chunks):
+  rem = ''
+  for chunk in chunks:
+    lines = (rem+chunk).split("\n")
+    rem = lines.pop()
+    for line in lines: yield line+"\n"
+  if rem: yield rem
+
+# UCSC .2bit reference, converted once with write_2bit and then read
+# straight out of an mmapped file.  Every process that opens the same
+# file shares the pages, so a genome costs about a quarter of its length
+# however many workers use it.
+# Bases are packed four to a byte as T C A G.  Runs of N and runs of
+# lower case (soft masked) bases are kept as start and size blocks.
+_twobit_signature = 0x1A412743
+_twobit_bases = 'TCAG'
+_twobit_unpack = [''.join([_twobit_bases[(i >> s) & 3] for s in (6,4,2,0)]) for i in range(0,256)]
+# base k of each byte as a translate table, interleaved to unpack in bulk
+_twobit_unpack_tables = [''.join([_twobit_bases[(i >> s) & 3] for i in range(0,256)]) for s in (6,4,2,0)]
+_twobit_pack = {}
+for i in range(0,256): _twobit_pack[_twobit_unpack[i]] = chr(i)
+# anything that is not ACGT is an N, packed as T under its N block
+_twobit_acgt = ''.join([c if c in 'ACGT' else 'T' for c in [chr(i).upper() for i in range(0,256)]])
+
+# Pre: path to a .2bit file
+#      Accessed by chromosome and slices like FastaData,
+#      ref[chr][start:end] is zero indexed, and get_sequence is one indexed
+class TwoBitFasta:
+  def __init__(self,fname):
+    self.fname = fname
+    self._open()
+
+  def _open(self):
+    self._fh = open(self.fname,'rb')
+    self._mm = mmap.mmap(self._fh.fileno(),0,access=mmap.ACCESS_READ)
+    self._endian = '<'
+    if struct.unpack_from('<I',self._mm,0)[0] != _twobit_signature:
+      self._endian = '>'
+      if struct.unpack_from('>I',self._mm,0)[0] != _twobit_signature:
+        sys.stderr.write("ERROR: not a .2bit file "+self.fname+"\n")
+        sys.exit()
+    version, count = struct.unpack_from(self._endian+'II',self._mm,4)
+    offset_format = self._endian+'I'
+    if version == 1: offset_format = self._endian+'Q'
+    self._names = []
+    self._offsets = {}
+    self._records = {} # record information read the first time a chromosome is used
+    pos = 16
+    for i in range(0,count):
+      l = ord(self._mm[pos])
+      name = self._mm[pos+1:pos+1+l]
+      self._offsets[name] = struct.unpack_from(offset_format,self._mm,pos+1+l)[0]
+      self._names.append(name)
+      pos += 1+l+struct.calcsize(offset_format)
+
+  # the mmap is opened again rather than pickled, so a TwoBitFasta
+  # can be handed to a Pool
+  def __getstate__(self):
+    return {'fname':self.fname}
+  def __setstate__(self,state):
+    self.fname = state['fname']
+    self._open()
+
+  def close(self):
+    self._mm.close()
+    self._fh.close()
+
+  def keys(self):
+    return self._names[:]
+  def get_names(self):
+    return self._names[:]
+  def __contains__(self,chr):
+    return chr in self._offsets
+  def get_length(self,chr):
+    return self._get_record(chr)['length']
+
+  def __getitem__(self,chr):
+    if chr not in self._offsets: raise KeyError(chr)
+    return TwoBitFasta.Chromosome(self,chr)
+
+  # Sliced like a string without reading the whole chromosome
+  class Chromosome:
+    def __init__(self,outer,chr):
+      self.outer = outer
+      self.chr = chr
+    def __getitem__(self,val):
+      clen = len(self)
+      if isinstance(val,slice):
+        if val.step:
+          sys.stderr.write("ERROR: TwoBitFasta doesn't support step access\n")
+          sys.exit()
+        [start,stop,step] = val.indices(clen)
+        if stop <= start: return ''
+        return self.outer.get_sequence(self.chr,start+1,stop)
+      if val < 0: val += clen
+      if val < 0 or val >= clen: raise IndexError(val)
+      return self.outer.get_sequence(self.chr,val+1,val+1)
+    def __len__(self):
+      return self.outer.get_length(self.chr)
+    def __str__(self):
+      return self.outer.get_sequence(self.chr)
+
+  def get_sequence(self,chr=None,start=None,end=None,dir=None,rng=None):
+    if rng: 
+      chr = rng.chr
+      start = rng.start
+      end = rng.end
+      dir = rng.direction
+    r = self._get_record(chr)
+    if not start: start = 1
+    if not end: end = r['length']
+    if not dir: dir = '+'
+    s0 = start-1
+    if end <= s0: return ''
+    first = s0/4
+    last = (end-1)/4
+    packed = self._mm[r['dna']+first:r['dna']+last+1]
+    v = bytearray(4*len(packed))
+    for k in range(0,4): v[k::4] = packed.translate(_twobit_unpack_tables[k])
+    v = v[s0-first*4:end-first*4]
+    for [bstart,bend] in self._get_blocks(r['n_starts'],r['n_sizes'],s0,end):
+      v[bstart-s0:bend-s0] = 'N'*(bend-bstart)
+    for [bstart,bend] in self._get_blocks(r['mask_starts'],r['mask_sizes'],s0,end):
+      v[bstart-s0:bend-s0] = v[bstart-s0:bend-s0].lower()
+    if dir == '-':
+      return Bio.Sequence.rc(str(v))
+    return str(v)
+
+  # Same as FastaFile.get_sequences, reads are already cheap from the mmap
+  def get_sequences(self,ranges):
+    return [self.get_sequence(rng=r) for r in ranges]
+
+  # Post: [start,end] zero indexed half open blocks clipped to start and end
+  def _get_blocks(self,starts,sizes,start,end):
+    out = []
+    i = bisect_right(starts,end-1)-1
+    while i >= 0 and starts[i]+sizes[i] > start:
+      out.append([max(start,starts[i]),min(end,starts[i]+sizes[i])])
+      i -= 1
+    return out
+
+  def _get_record(self,chr):
+    if chr in self._records: return self._records[chr]
+    pos = self._offsets[chr]
+    length, n_count = struct.unpack_from(self._endian+'II',self._mm,pos)
+    pos += 8
+    n_starts = self._read_uints(pos,n_count)
+    n_sizes = self._read_uints(pos+4*n_count,n_count)
+    pos += 8*n_count
+    mask_count = struct.unpack_from(self._endian+'I',self._mm,pos)[0]
+    pos += 4
+    mask_starts = self._read_uints(pos,mask_count)
+    mask_sizes = self._read_uints(pos+4*mask_count,mask_count)
+    pos += 8*mask_count+4 # and the reserved word
+    r = {'length':length,'n_starts':n_starts,'n_sizes':n_sizes,'mask_starts':mask_starts,'mask_sizes':mask_sizes,'dna':pos}
+    self._records[chr] = r
+    return r
+
+  def _read_uints(self,pos,count):
+    v = array('I')
+    v.fromstring(self._mm[pos:pos+4*count])
+    if (self._endian == '<') != (sys.byteorder == 'little'): v.byteswap()
+    return v
+
+# Convert a fasta file, gzipped or not, to .2bit
+# Only the first non-whitespace of each header is kept as the name.
+# One chromosome at a time is held in memory.
+# Pre: fasta file name, .2bit file name to write
+def write_2bit(fasta_file,twobit_file):
+  tmp_file = twobit_file+'.records'
+  tof = open(tmp_file,'wb')
+  names = []
+  sizes = []
+  for [name,seq] in _fasta_records(fasta_file):
+    record = _twobit_record(seq)
+    names.append(name)
+    sizes.append(len(record))
+    tof.write(record)
+  tof.close()
+  index_size = sum([1+len(x)+4 for x in names])
+  version = 0
+  offset_format = '<I'
+  if 16+index_size+sum(sizes) >= 1 << 32:
+    version = 1
+    offset_format = '<Q'
+    index_size = sum([1+len(x)+8 for x in names])
+  of = open(twobit_file,'wb')
+  of.write(struct.pack('<IIII',_twobit_signature,version,len(names),0))
+  offset = 16+index_size
+  for i in range(0,len(names)):
+    of.write(chr(len(names[i]))+names[i]+struct.pack(offset_format,offset))
+    offset += sizes[i]
+  inf = open(tmp_file,'rb')
+  while True:
+    chunk = inf.read(16*1024*1024)
+    if not chunk: break
+    of.write(chunk)
+  inf.close()
+  of.close()
+  os.remove(tmp_file)
+
+def _fasta_records(fasta_file):
+  inf = None
+  if re.search('\.gz$',fasta_file): inf = gzip.open(fasta_file)
+  else: inf = open(fasta_file)
+  name = None
+  lines = []
+  for line in inf:
+    if line[0] == '>':
+      if name is not None: yield [name,''.join(lines)]
+      name = line[1:].split()[0]
+      lines = []
+    else: lines.append(line.rstrip())
+  if name is not None: yield [name,''.join(lines)]
+  inf.close()
+
+def _twobit_record(seq):
+  if sys.byteorder == 'big':
+    sys.stderr.write("ERROR: write_2bit expects a little endian machine\n")
+    sys.exit()
+  n_blocks = [[m.start(),m.end()-m.start()] for m in re.finditer('[^ACGTacgt]+',seq)]
+  mask_blocks = [[m.start(),m.end()-m.start()] for m in re.finditer('[a-z]+',seq)]
+  out = [struct.pack('<II',len(seq),len(n_blocks))]
+  out.append(array('I',[x[0] for x in n_blocks]+[x[1] for x in n_blocks]).tostring())
+  out.append(struct.pack('<I',len(mask_blocks)))
+  out.append(array('I',[x[0] for x in mask_blocks]+[x[1] for x in mask_blocks]).tostring())
+  out.append(struct.pack('<I',0))
+  chunk_size = 4*1024*1024
+  for i in range(0,len(seq),chunk_size):
+    chunk = seq[i:i+chunk_size].translate(_twobit_acgt)
+    if len(chunk) % 4: chunk += 'T'*(4-len(chunk)%4)
+    out.append(''.join(map(_twobit_pack.__getitem__,re.findall('....',chunk))))
+  return ''.join(out)
+
+# Pre: a fasta file (gzipped or not) or a .2bit file
+# Post: TwoBitFasta for .2bit, otherwise FastaData
+def open_reference(fname):
+  if is_2bit_file(fname): return TwoBitFasta(fname)
+  return FastaData(file=fname)
+
+def is_2bit_file(fname):
+  with open(fname,'rb') as inf:
+    return inf.read(4) in [struct.pack('<I',_twobit_signature),struct.pack('>I',_twobit_signature)]
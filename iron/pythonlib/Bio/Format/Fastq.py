@@ -1,10 +1,19 @@
-import re
+import re, sys, os, struct, hashlib, mmap, heapq
+from collections import deque
+from multiprocessing import Pool
+from tempfile import mkdtemp
+from shutil import rmtree
 import Bio.Sequence
+from Bio.Format.Fasta import _handle_chunks
+from Bio.Format.BGZF import reader as BGZF_reader, read_raw_block, inflate_block, check_block, _Done
 
 #Iterable Stream
+# Reads come from small batches so memory stays near one buffer
 class FastqHandle:
   def __init__(self,fh):
     self.fh = fh
+    self._batches = FastqBatchHandle(fh,batch_size=1000,buffer_size=1024*1024)
+    self._entries = self._read_entries()
   def __iter__(self):
     return self
   def next(self):
@@ -14,15 +23,84 @@ class FastqHandle:
     else:
       return v
   def get_entry(self):
-    line1 = self.fh.readline().rstrip()[1:]
-    if not line1: return None
-    line2 = self.fh.readline().rstrip()
-    if not line2: return None
-    line3 = self.fh.readline().rstrip()
-    if not line3: return None
-    line4 = self.fh.readline().rstrip()
-    if not line4: return None
-    return Fastq([line1,line2,line3,line4])
+    return next(self._entries,None)
+  def _read_entries(self):
+    for batch in self._batches:
+      for v in zip(batch.names,batch.seqs,batch.plus,batch.quals):
+        yield Fastq(list(v))
+
+# Read a fastq in large buffers, splitting records on line breaks and
+# returning them a batch at a time rather than one object per read.
+# Pre: handle to a fastq with four lines per record, may be gzipped
+#      (optional) batch_size most reads per batch
+#      (optional) buffer_size bytes read from the handle at a time, a
+#                 batch stops growing once this much is waiting so long
+#                 reads do not make huge batches
+# Post: iterable of FastqBatch
+class FastqBatchHandle:
+  def __init__(self,fh,batch_size=100000,buffer_size=16*1024*1024):
+    self.fh = fh
+    self.batch_size = batch_size
+    self.buffer_size = buffer_size
+    self._chunks = _handle_chunks(self.fh,self.buffer_size)
+    self._lines = [] # complete lines not yet batched
+    self._rem = '' # partial line at the end of the last chunk
+    self._bytes = 0 # size of the lines and partial line waiting
+    self._finished = False
+  def __iter__(self):
+    return self
+  def next(self):
+    v = self.get_batch()
+    if not v:
+      raise StopIteration
+    else:
+      return v
+  def get_batch(self):
+    n = 4*self.batch_size
+    # always fill to at least one whole record
+    while not self._finished and (len(self._lines) < 4 or (len(self._lines) < n and self._bytes < self.buffer_size)):
+      chunk = next(self._chunks,None)
+      if chunk is None:
+        self._finished = True
+        if self._rem: self._lines.append(self._rem)
+        # drop blank lines trailing the last record
+        while self._lines and not self._lines[-1].rstrip(): self._lines.pop()
+        break
+      self._bytes += len(chunk)
+      lines = (self._rem+chunk).split("\n")
+      self._rem = lines.pop()
+      self._lines += lines
+    n = min(n,len(self._lines)-len(self._lines)%4)
+    lines = self._lines[0:n]
+    del self._lines[0:n]
+    if not lines: return None
+    self._bytes -= sum(map(len,lines))+len(lines)
+    # trailing whitespace and \r were always stripped from each line
+    lines = map(str.rstrip,lines)
+    return FastqBatch(lines)
+
+# A batch of reads as parallel lists
+# names are the header lines without the '@'
+class FastqBatch:
+  def __init__(self,lines):
+    self.names = [x[1:] for x in lines[0::4]]
+    self.seqs = lines[1::4]
+    self.plus = lines[2::4]
+    self.quals = lines[3::4]
+  def __len__(self):
+    return len(self.names)
+  def get_entry(self,i):
+    return Fastq([self.names[i],self.seqs[i],self.plus[i],self.quals[i]])
+  # Post: names, seqs and quals as NumPy byte string arrays
+  def get_arrays(self):
+    import numpy as np
+    return [np.array(self.names),np.array(self.seqs),np.array(self.quals)]
+  # Post: every quality score in the batch as one NumPy uint8 array
+  #       with the read lengths to split it by
+  def get_quality_array(self,offset=33):
+    import numpy as np
+    v = np.frombuffer(''.join(self.quals),dtype=np.uint8)-np.uint8(offset)
+    return [v,np.array([len(x) for x in self.quals],dtype=np.int64)]
 
 class Fastq(Bio.Sequence.Seq):
   def __init__(self,v):
@@ -44,3 +122,244 @@ class Fastq(Bio.Sequence.Seq):
     return '@'+"\n".join(self.lines)+"\n"
   def __str__(self):
     return self.fastq().rstrip()
+
+# Index of a BGZF compressed fastq by read name
+# Everything is fixed width so the file can be mmapped
+# 1. 'FQI\1'
+# 2. uint64 count of reads, little endian
+# 3. for each read 16 bytes, big endian so they sort as strings:
+#    uint64 hash of the name, uint64 virtual offset of the record
+#    (block start << 16 | inner start), sorted by hash then offset
+# The name is the first word of the header.  Reads sharing a hash are
+# told apart by checking the name when they are fetched.
+_index_magic = 'FQI\1'
+_index_entry = struct.Struct('>QQ')
+
+# Pre: read name
+# Post: 64 bit hash of the name that is the same in every process
+def fastq_name_hash(name):
+  return struct.unpack('<Q',hashlib.md5(name).digest()[0:8])[0]
+
+def _header_hash(line):
+  name = line[1:].split(None,1)
+  if len(name) == 0: return fastq_name_hash('')
+  return fastq_name_hash(name[0])
+
+# Make the index of a BGZF fastq.  Runs of blocks are inflated and
+# scanned for line breaks on worker processes, and an ordered pass over
+# their results counts lines across the whole file, joining the lines
+# that span blocks, to find where each record starts.
+# Pre: BGZF compressed fastq, path to write the index to
+#      threads to scan blocks with
+#      (optional) tempdir for sorted runs of the entries
+# Post: writes the index, returns the number of reads indexed
+def write_fastq_index(fastq_file,index_file,threads=1,blocks_per_chunk=64,tempdir=None,max_entries_in_memory=10000000,verbose=False):
+  tdir = mkdtemp(prefix="weirathe.",dir=tempdir)
+  p = None
+  if threads > 1: p = Pool(processes=threads)
+  pending = deque()
+  state = {'line':0,'text':'','voffset':None,'entries':[],'runs':[],'count':0}
+  def finish(r):
+    for block in r.get():
+      _stitch_block(block,state)
+    if len(state['entries']) >= max_entries_in_memory:
+      state['runs'].append(_write_run(state['entries'],tdir,len(state['runs'])))
+      state['entries'] = []
+  inf = open(fastq_file,'rb')
+  blocks = []
+  z = 0
+  while True:
+    block_start = inf.tell()
+    raw = read_raw_block(inf)
+    if raw: blocks.append([block_start]+raw[1:])
+    if (not raw and blocks) or len(blocks) >= blocks_per_chunk:
+      if p: pending.append(p.apply_async(_scan_blocks,args=(blocks,)))
+      else: pending.append(_Done(_scan_blocks(blocks)))
+      while len(pending) > threads*2: finish(pending.popleft())
+      z += len(blocks)
+      blocks = []
+      if verbose: sys.stderr.write(str(z)+" blocks\r")
+    if not raw: break
+  inf.close()
+  while pending: finish(pending.popleft())
+  if p:
+    p.close()
+    p.join()
+  if state['text']:
+    # the last line had no line break
+    _stitch_line(state['text'],state)
+  if state['line'] % 4 != 0:
+    sys.stderr.write("ERROR: fastq line count is not a multiple of 4\n")
+    sys.exit()
+  if verbose: sys.stderr.write("\n"+str(state['count'])+" reads indexed\n")
+  # merge the sorted runs into the index
+  state['entries'].sort()
+  runs = [state['entries']]
+  handles = []
+  for fname in state['runs']:
+    handles.append(open(fname,'rb'))
+    runs.append(iter(lambda h=handles[-1]: h.read(_index_entry.size),''))
+  of = open(index_file,'wb')
+  of.write(_index_magic+struct.pack('<Q',state['count']))
+  if len(runs) == 1: of.write(''.join(runs[0]))
+  else:
+    for v in heapq.merge(*runs): of.write(v)
+  of.close()
+  for h in handles: h.close()
+  rmtree(tdir)
+  return state['count']
+
+def _write_run(entries,tdir,i):
+  entries.sort()
+  fname = tdir+'/run'+str(i)+'.fqi'
+  of = open(fname,'wb')
+  of.write(''.join(entries))
+  of.close()
+  return fname
+
+# Pre: list of [block start, deflated bytes, crc and isize bytes]
+# Post: for each block [block start, data size, count of line breaks,
+#       entries by phase, text before the first line break, text after
+#       the last].  The lines that start and end in the block are split
+#       into four phases by their position mod 4, and each phase is the
+#       list of packed index entries of its lines, or None if one of
+#       them is not a header.  Which phase holds the headers depends on
+#       the lines before the block, so that is left to the ordered pass.
+def _scan_blocks(blocks):
+  out = []
+  for [block_start,deflated,tail] in blocks:
+    data = check_block(tail,inflate_block(deflated))
+    parts = data.split("\n")
+    phases = [[],[],[],[]]
+    pos = len(parts[0])+1
+    for j in range(1,len(parts)-1):
+      line = parts[j]
+      p = (j-1) & 3
+      if phases[p] is not None:
+        if line[0:1] == '@': phases[p].append(_index_entry.pack(_header_hash(line),block_start << 16 | pos))
+        else: phases[p] = None
+      pos += len(line)+1
+    last = ''
+    if len(parts) > 1: last = parts[-1]
+    out.append([block_start,len(data),len(parts)-1,phases,parts[0],last])
+  return out
+
+# Pre: a scanned block, handed over in file order
+#      state of the lines so far, with the text of a line that began in
+#      an earlier block and has not ended
+def _stitch_block(block,state):
+  [block_start,size,n_breaks,phases,first,last] = block
+  if size == 0: return
+  if state['voffset'] is None: state['voffset'] = block_start << 16
+  if n_breaks == 0:
+    state['text'] += first
+    return
+  # the line that was open when the block began ends at its first break
+  _stitch_line(state['text']+first,state)
+  entries = phases[-state['line'] % 4]
+  if entries is None:
+    sys.stderr.write("ERROR: expected a fastq header in the block at "+str(block_start)+"\n")
+    sys.exit()
+  state['entries'] += entries
+  state['count'] += len(entries)
+  state['line'] += n_breaks-1
+  state['text'] = last
+  state['voffset'] = None
+  if last: state['voffset'] = block_start << 16 | size-len(last)
+
+def _stitch_line(text,state):
+  if state['line'] % 4 == 0:
+    if text[0:1] != '@':
+      sys.stderr.write("ERROR: expected a fastq header\n"+text+"\n")
+      sys.exit()
+    state['entries'].append(_index_entry.pack(_header_hash(text),state['voffset']))
+    state['count'] += 1
+  state['line'] += 1
+  state['text'] = ''
+  state['voffset'] = None
+
+# Read straight out of the mmapped index from write_fastq_index
+class FastqIndex:
+  def __init__(self,index_file):
+    self.index_file = index_file
+    self._fh = open(index_file,'rb')
+    self._mm = mmap.mmap(self._fh.fileno(),0,access=mmap.ACCESS_READ)
+    if self._mm[0:4] != _index_magic:
+      sys.stderr.write("ERROR: not a fastq index "+index_file+"\n")
+      sys.exit()
+    self._n = struct.unpack_from('<Q',self._mm,4)[0]
+  def close(self):
+    self._mm.close()
+    self._fh.close()
+  def __len__(self):
+    return self._n
+  # Post: virtual offsets of the records whose name has the same hash
+  def get_voffsets(self,name):
+    h = fastq_name_hash(name)
+    lo = 0
+    hi = self._n
+    while lo < hi:
+      mid = (lo+hi)/2
+      if self._get(mid)[0] < h: lo = mid+1
+      else: hi = mid
+    out = []
+    while lo < self._n:
+      [h2,voffset] = self._get(lo)
+      if h2 != h: break
+      out.append(voffset)
+      lo += 1
+    return out
+  def _get(self,i):
+    return _index_entry.unpack_from(self._mm,12+i*_index_entry.size)
+
+# Random access to reads of a BGZF fastq by name
+# Pre: BGZF compressed fastq
+#      (optional) index_file, the .fqi next to the fastq by default
+class IndexedFastq:
+  def __init__(self,fname,index_file=None):
+    self.fname = fname
+    if not index_file: index_file = fname+'.fqi'
+    if not os.path.exists(index_file):
+      sys.stderr.write("ERROR: no .fqi index found for "+fname+"\n")
+      sys.exit()
+    self.index = FastqIndex(index_file)
+  def close(self):
+    self.index.close()
+  # Post: list of every read with the name
+  def fetch_by_name(self,name):
+    return [x for x in self.fetch_by_names([name])]
+  # Pre: a list of names
+  #      file_order yields reads in file order rather than name by name
+  # Post: generator of every read for each name found in the index
+  #       records are read in file order through one handle
+  def fetch_by_names(self,names,file_order=False):
+    voffsets = []
+    for name in names:
+      voffsets += [[x,name] for x in self.index.get_voffsets(name)]
+    inf = open(self.fname,'rb')
+    r = BGZF_reader(inf)
+    found = {}
+    for [voffset,name] in sorted(voffsets):
+      r.seek(voffset >> 16,voffset & 0xFFFF)
+      e = _read_record(r)
+      # a different name with the same hash
+      if not e or e.name.split(None,1)[0:1] != [name]: continue
+      if file_order: yield e
+      else: found[voffset] = e
+    inf.close()
+    if not file_order:
+      for [voffset,name] in voffsets:
+        if voffset in found: yield found[voffset]
+
+# Pre: BGZF reader at the start of a record
+def _read_record(r):
+  parts = []
+  count = 0
+  while count < 4:
+    v = r.read(4096)
+    if not v: break
+    parts.append(v)
+    count += v.count("\n")
+  lines = ''.join(parts).split("\n")
+  if len(lines) < 4: return None
+  return Fastq([lines[0].rstrip("\r")[1:]]+[x.rstrip("\r") for x in lines[1:4]])
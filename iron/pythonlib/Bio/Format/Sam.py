@@ -1,17 +1,28 @@
 import struct, zlib, sys, re, os, gzip, random
+from collections import deque
+from array import array
 import Bio.Align
 #import Bio.Format.BamIndex as BamIndex
 from Bio.Sequence import rc
-from cStringIO import StringIO
-from string import maketrans
 from Bio.Range import GenomicRange
+from Bio.Format.BGZF import load_cached_block, block_cache_key, BlockReadAhead
+from Bio.Format.BGZF import writer as BGZF_writer
 from subprocess import Popen, PIPE
-_bam_ops = maketrans('012345678','MIDNSHP=X')
-_bam_char = maketrans('abcdefghijklmnop','=ACMGRSVTWYHKDBN')
-_bam_value_type = {'c':[1,'<b'],'C':[1,'<B'],'s':[2,'<h'],'S':[2,'<H'],'i':[4,'<i'],'I':[4,'<I']}
-_sam_cigar_target_add = re.compile('[M=XDN]$')
+_bam_ops = 'MIDNSHP=X'
+_bam_char = '=ACMGRSVTWYHKDBN'
+# every packed sequence byte to its two bases, and quality byte to its phred+33 character
+_bam_seq_pairs = [_bam_char[i>>4]+_bam_char[i&0xF] for i in range(0,256)]
+_bam_qual = ''.join([chr((i+33)&0xFF) for i in range(0,256)])
+_bam_target_ops = set([0,2,3,7,8]) # M D N = X consume the target
+_bam_aligned_ops = set([0,7,8]) # M = X are aligned bases
+_sam_target_ops = set(['M','D','N','=','X'])
+_sam_aligned_ops = set(['M','=','X'])
+_bam_value_type = {'c':[1,'<b'],'C':[1,'<B'],'s':[2,'<h'],'S':[2,'<H'],'i':[4,'<i'],'I':[4,'<I'],'f':[4,'<f']}
+_sam_cigar_pattern = re.compile('([0-9]+)([MIDNSHP=X]+)')
 
 # A sam entry
+# The line is split once.  The cigar, tags and alignment ranges are
+# only worked out when they are first asked for.
 class SAM(Bio.Align.Alignment):
   def __init__(self,line,reference=None,reference_lengths=None):
     self._line = line.rstrip()
@@ -22,7 +33,6 @@ class SAM(Bio.Align.Alignment):
     self._parse_sam_line()
     # Private values holds tags cigar and entries
     self._alignment_ranges = None
-    self._set_alignment_ranges()
     return
 
   def __str__(self):
@@ -101,7 +111,16 @@ class SAM(Bio.Align.Alignment):
     return self
 
   def get_tag(self,key):
-    return self._private_values.get_tags()[key]['value']
+    return self.get_tags()[key]['value']
+
+  def get_alignment_ranges(self):
+    if not self._alignment_ranges:
+      self._set_alignment_ranges()
+    return self._alignment_ranges
+
+  # Same as the cigar M = X bases in the alignment ranges, without building them
+  def get_aligned_bases_count(self):
+    return sum([c[0] for c in self.get_cigar() if c[1] in _sam_aligned_ops])
 
   #Overrides Bio.Alignment.Align._set_alignment_ranges()
   #[target, query]
@@ -110,54 +129,27 @@ class SAM(Bio.Align.Alignment):
       self._alignment_ranges = None
       return
     self._alignment_ranges = []
-    cig = self.get_cigar()[:]
     target_pos = self.value('pos')
     query_pos = 1
-    while len(cig) > 0:
-      c = cig.pop(0)
-      if re.match('[S]$',c[1]): # hard or soft clipping
-        query_pos += c[0]
-      elif re.match('[ND]$',c[1]): # deleted from reference
-        target_pos += c[0]
-      elif re.match('[I]$',c[1]): # insertion to the reference
-        query_pos += c[0]
-      elif re.match('[MI=X]$',c[1]): # keep it
-        t_start = target_pos
-        q_start = query_pos
-        target_pos += c[0]
-        query_pos += c[0]
-        t_end = target_pos-1
-        q_end = query_pos-1
-        self._alignment_ranges.append([GenomicRange(self.value('rname'),t_start,t_end),GenomicRange(self.value('qname'),q_start,q_end)])
+    rname = self.value('rname')
+    qname = self.value('qname')
+    for [l,op] in self.get_cigar():
+      if op == 'S' or op == 'I': # soft clipping or insertion to the reference
+        query_pos += l
+      elif op == 'N' or op == 'D': # deleted from reference
+        target_pos += l
+      elif op in _sam_aligned_ops: # keep it
+        self._alignment_ranges.append([GenomicRange(rname,target_pos,target_pos+l-1),GenomicRange(qname,query_pos,query_pos+l-1)])
+        target_pos += l
+        query_pos += l
     return
 
   def _parse_sam_line(self):
-    f = self._line.rstrip().split("\t")
-    self._private_values.set_entry('qname',f[0])
-    self._private_values.set_entry('flag',int(f[1]))
-    self._private_values.set_entry('rname',f[2])
-    if f[2] == '*':
-      self._private_values.set_entry('pos',0)
-    else: 
-      self._private_values.set_entry('pos',int(f[3]))
-    self._private_values.set_entry('mapq',int(f[4]))
-    self._private_values.set_entry('cigar',f[5])
-    self._private_values.set_entry('rnext',f[6])
-    self._private_values.set_entry('pnext',int(f[7]))
-    self._private_values.set_entry('tlen',int(f[8]))
-    self._private_values.set_entry('seq',f[9])
-    self._private_values.set_entry('qual',f[10])
-    self._private_values.set_cigar([])
-    if self.value('cigar') != '*':
-      cig = [[int(m[0]),m[1]] for m in re.findall('([0-9]+)([MIDNSHP=X]+)',self.value('cigar'))]
-      self._private_values.set_cigar(cig)
-    tags = {}
-    if len(f) > 11:
-      for m in [[y.group(1),y.group(2),y.group(3)] for y in [re.match('([^:]{2,2}):([^:]):(.+)$',x) for x in f[11:]]]:
-        if m[1] == 'i': m[2] = int(m[2])
-        elif m[1] == 'f': m[2] = float(m[2])
-        tags[m[0]] = {'type':m[1],'value':m[2]}
-    self._private_values.set_tags(tags)
+    f = self._line.split("\t")
+    self._fields = f
+    self._private_values.set_entries_dict({'qname':f[0],'flag':int(f[1]),'rname':f[2],\
+      'pos':0 if f[2] == '*' else int(f[3]),'mapq':int(f[4]),'cigar':f[5],'rnext':f[6],\
+      'pnext':int(f[7]),'tlen':int(f[8]),'seq':f[9],'qual':f[10]})
 
   # Necessary function for doing a locus stream
   # For the context of a SAM file we set this to be the target range
@@ -167,8 +159,7 @@ class SAM(Bio.Align.Alignment):
   def get_target_range(self):
     if not self.is_aligned(): return None
     if self._target_range: return self._target_range
-    global _sam_cigar_target_add
-    tlen = sum([x[0] for x in self.get_cigar() if _sam_cigar_target_add.match(x[1])])
+    tlen = sum([x[0] for x in self.get_cigar() if x[1] in _sam_target_ops])
     self._target_range = GenomicRange(self.value('rname'),self.value('pos'),self.value('pos')+tlen-1)
     return self._target_range
   def check_flag(self,inbit):
@@ -192,9 +183,25 @@ class SAM(Bio.Align.Alignment):
   def value(self,key):
     return self._private_values.get_entry(key)
   def get_tags(self): 
-    return self._private_values.get_tags()
+    tags = self._private_values.get_tags()
+    if tags is None:
+      tags = {}
+      for x in self._fields[11:]:
+        val_type = x[3]
+        v = x[5:]
+        if val_type == 'i': v = int(v)
+        elif val_type == 'f': v = float(v)
+        tags[x[0:2]] = {'type':val_type,'value':v}
+      self._private_values.set_tags(tags)
+    return tags
   def get_cigar(self): 
-    return self._private_values.get_cigar()
+    cig = self._private_values.get_cigar()
+    if cig is None:
+      cig = []
+      if self.value('cigar') != '*':
+        cig = [[int(m[0]),m[1]] for m in _sam_cigar_pattern.findall(self.value('cigar'))]
+      self._private_values.set_cigar(cig)
+    return cig
 
   #Bam files need a specific override to get_tags and get_cigar that would break other parts of the class if we 
   # access the variables other ways
@@ -223,8 +230,9 @@ class SAM(Bio.Align.Alignment):
 # Slows down for accessing things that need more decoding like
 # sequence, quality, cigar string, and tags
 class BAM(SAM):
-  def __init__(self,bin_data,ref_names,fileName=None,blockStart=None,innerStart=None,ref_lengths=None,reference=None,line_number=None):
-    part_dict = _parse_bam_data_block(bin_data,ref_names)
+  # (optional) bin_start and bin_end bound the record when bin_data is a larger buffer
+  def __init__(self,bin_data,ref_names,fileName=None,blockStart=None,innerStart=None,ref_lengths=None,reference=None,line_number=None,bin_start=0,bin_end=None):
+    part_dict = _parse_bam_data_block(bin_data,ref_names,bin_start,bin_end)
     #self._bamfileobj = bamfileobj #this is most like our parent
     self._line = None
     self._line_number = line_number # the line number in the bam file
@@ -238,11 +246,6 @@ class BAM(SAM):
     #self._set_alignment_ranges()
     return
 
-  def get_alignment_ranges(self):
-    if not self._alignment_ranges:
-      self._set_alignment_ranges()
-    return self._alignment_ranges
-
   def get_line_number(self):
     return self._line_number
   def get_target_length(self):
@@ -259,13 +262,20 @@ class BAM(SAM):
     return 'fileName: '+self._file_position['fileName']+" "\
            'blockStart: '+str(self._file_position['blockStart'])+" "\
            'innerStart: '+str(self._file_position['innerStart'])
+  # Only this tag is decoded unless all the tags already have been
   def get_tag(self,key): 
+    cur = self._private_values.get_tags()
+    if cur: return cur[key]['value']
+    v = _bin_to_tag(self.value('extra_bytes'),key)
+    if not v: raise KeyError(key)
+    return v['value']
+  def get_tags(self):
     cur = self._private_values.get_tags()
     if not cur:
       v1,v2 = _bin_to_extra(self.value('extra_bytes'))
-      self._private_values.set_tags(v1) #keep the cigar array in a special palce
+      self._private_values.set_tags(v1)
       self._private_values.set_entry('remainder',v2)
-    return self._private_values.get_tags()[key]['value']
+    return self._private_values.get_tags()
   def get_cigar(self): 
     cur = self._private_values.get_cigar()
     if not cur:
@@ -306,6 +316,111 @@ class BAM(SAM):
     return self._private_values.get_entry(key)
 
 
+# A small bam entry for holding millions in memory at once
+# Only the raw record bytes and its file position are kept, in __slots__.
+# The fixed fields come from one struct.unpack_from and everything else
+# (qname, cigar, tags, seq, qual) is decoded each time it is asked for.
+# get_bam() gives the full BAM entry when its other methods are needed.
+class CompactBAM(object):
+  __slots__ = ('_data','_ref_names','_ref_lengths','_file_name','_block_start','_inner_start',\
+               '_refid','_pos','_bin_mq_nl','_flag_nc','_l_seq','_next_refid','_pnext','_tlen',\
+               '_target_range')
+  def __init__(self,bin_data,ref_names,fileName=None,blockStart=None,innerStart=None,ref_lengths=None,bin_start=0,bin_end=None):
+    if bin_end is None: bin_end = len(bin_data)
+    self._data = bin_data[bin_start:bin_end]
+    self._ref_names = ref_names
+    self._ref_lengths = ref_lengths
+    self._file_name = fileName
+    self._block_start = blockStart
+    self._inner_start = innerStart
+    self._refid, self._pos, self._bin_mq_nl, self._flag_nc, self._l_seq, \
+      self._next_refid, self._pnext, self._tlen = struct.unpack_from('<iiIIiiii',self._data)
+    self._target_range = None
+
+  def value(self,key):
+    if key == 'flag': return self._flag_nc >> 16
+    elif key == 'rname': return self._ref_names[self._refid]
+    elif key == 'pos': return self._pos+1
+    elif key == 'mapq': return (self._bin_mq_nl & 0xFF00) >> 8
+    elif key == 'qname': return self._data[32:32+(self._bin_mq_nl & 0xFF)].rstrip('\0')
+    elif key == 'rnext':
+      if self._next_refid == -1: return '*'
+      if self._ref_names[self._next_refid] == self._ref_names[self._refid]: return '='
+      return self._ref_names[self._next_refid]
+    elif key == 'pnext': return self._pnext+1
+    elif key == 'tlen': return self._tlen
+    elif key == 'cigar': return _bin_to_cigar(self._cigar_bytes())[1]
+    elif key == 'seq':
+      v = _bin_to_seq(self._data[self._seq_start():self._seq_start()+(self._l_seq+1)/2])
+      if not v: v = '*'
+      return v
+    elif key == 'qual':
+      qs = self._seq_start()+(self._l_seq+1)/2
+      v = _bin_to_qual(self._data[qs:qs+self._l_seq])
+      if not v: v = '*'
+      return v
+    elif key == 'remainder': return _bin_to_extra(self._extra_bytes())[1]
+    return self.get_bam().value(key)
+
+  def check_flag(self,inbit):
+    if (self._flag_nc >> 16) & inbit: return True
+    return False
+  def is_aligned(self):
+    return not self.check_flag(0x4)
+  def get_strand(self):
+    if self.check_flag(0x10): return '-'
+    return '+'
+
+  def get_coord(self):
+    return [self._block_start,self._inner_start]
+  def get_block_start(self):
+    return self._block_start
+  def get_inner_start(self):
+    return self._inner_start
+  def get_filename(self):
+    return self._file_name
+  def get_target_length(self):
+    return self._ref_lengths[self.value('rname')]
+
+  def get_cigar(self):
+    return _bin_to_cigar(self._cigar_bytes())[0]
+  def get_tag(self,key):
+    v = _bin_to_tag(self._extra_bytes(),key)
+    if not v: raise KeyError(key)
+    return v['value']
+  def get_tags(self):
+    return _bin_to_extra(self._extra_bytes())[0]
+
+  # Necessary function for doing a locus stream
+  def get_range(self):
+    return self.get_target_range()
+  def get_target_range(self):
+    if not self.is_aligned(): return None
+    if self._target_range: return self._target_range
+    tlen = sum([c >> 4 for c in self._cigar_ops() if (c & 0xF) in _bam_target_ops])
+    self._target_range = GenomicRange(self.value('rname'),self._pos+1,self._pos+tlen)
+    return self._target_range
+  # Same count as Alignment.get_aligned_bases_count without building the ranges
+  def get_aligned_bases_count(self):
+    return sum([c >> 4 for c in self._cigar_ops() if (c & 0xF) in _bam_aligned_ops])
+
+  # Post: the full BAM entry for this record
+  def get_bam(self):
+    return BAM(self._data,self._ref_names,fileName=self._file_name,blockStart=self._block_start,innerStart=self._inner_start,ref_lengths=self._ref_lengths)
+
+  def _cigar_bytes(self):
+    cs = 32+(self._bin_mq_nl & 0xFF)
+    return self._data[cs:self._seq_start()]
+  def _cigar_ops(self):
+    ops = array('I')
+    ops.fromstring(self._cigar_bytes())
+    if sys.byteorder == 'big': ops.byteswap()
+    return ops
+  def _seq_start(self):
+    return 32+(self._bin_mq_nl & 0xFF)+(self._flag_nc & 0xFFFF)*4
+  def _extra_bytes(self):
+    return self._data[self._seq_start()+(self._l_seq+1)/2+self._l_seq:]
+
 class SAMHeader:
   def __init__(self,header_text):
     self._text = header_text
@@ -330,23 +445,47 @@ class SAMHeader:
     return self._sequence_lengths[sname]
 
 # reference is a dict
+# Parsed header_text, n_ref, ref_names, ref_lengths, reference numbers and
+# where the entries start, for each bam file opened so far.  Keyed by
+# block_cache_key so a rewritten file is parsed again.
+_bam_header_cache = {}
+
 class BAMFile:
   #def __init__(self,filename,blockStart=None,innerStart=None,cnt=None,index_obj=None,index_file=None,reference=None):
-  def __init__(self,filename,blockStart=None,innerStart=None,cnt=None,reference=None):
+  # threads greater than one decompresses upcoming blocks on that many threads
+  # compact returns CompactBAM entries rather than BAM entries
+  def __init__(self,filename,blockStart=None,innerStart=None,cnt=None,reference=None,threads=1,compact=False):
     self.path = filename
+    self._compact = compact
     self._reference = reference # dict style accessable reference
-    self.fh = BGZF(filename)
     self._line_number = 0 # entry line number ... after header.  starts with 1
+    self._header = None
+    self._bai = None # standard .bai or .csi index for fetch
+    self._bgi = None # our .bgi index for fetch_by_names
+    self._output_range = None
+    #self.index = index_obj
+    # header and references are parsed once per file and shared
+    key = block_cache_key(filename)
+    cached = _bam_header_cache.get(key)
+    if cached and blockStart is not None and innerStart is not None:
+      # go straight to the entry without touching the header blocks
+      self.fh = BGZF(filename,blockStart=blockStart,innerStart=innerStart,threads=threads)
+    else:
+      self.fh = BGZF(filename,threads=threads)
+    if cached:
+      self.header_text, self.n_ref, self.ref_names, self.ref_lengths, self._ref_ids, data_start = cached
+      if blockStart is None or innerStart is None: self.fh.seek(data_start[0],data_start[1])
+      return
     # start reading the bam file
     self.header_text = None
-    self._header = None
     self.n_ref = None
     self._read_top_header()
     self.ref_names = []
     self.ref_lengths = {}
-    self._output_range = None
-    #self.index = index_obj
+    self._ref_ids = {} # reference name to its number in the bam
     self._read_reference_information()
+    _bam_header_cache[key] = [self.header_text,self.n_ref,self.ref_names,self.ref_lengths,self._ref_ids,\
+                              [self.fh.get_block_start(),self.fh.get_inner_start()]]
     # prepare for specific work
     if self.path and blockStart is not None and innerStart is not None:
       self.fh.seek(blockStart,innerStart)
@@ -413,12 +552,16 @@ class BAMFile:
   def read_entry2(self):
     bstart = self.fh.get_block_start()
     innerstart = self.fh.get_inner_start()
-    b = self.fh.read(4) # get block size bytes
-    if not b: return None
-    block_size = struct.unpack('<i',b)[0]
+    [b,bs,be] = self.fh.read_buffer(4) # get block size bytes
+    if be-bs < 4: return None
+    block_size = struct.unpack_from('<i',b,bs)[0]
     #print 'block_size '+str(block_size)
     self._line_number += 1
-    bam = BAM(self.fh.read(block_size),self.ref_names,fileName=self.path,blockStart=bstart,innerStart=innerstart,ref_lengths=self.ref_lengths,reference=self._reference,line_number = self._line_number)
+    # parse straight out of the decompressed block when the record is inside it
+    [data,ds,de] = self.fh.read_buffer(block_size)
+    if self._compact:
+      return CompactBAM(data,self.ref_names,fileName=self.path,blockStart=bstart,innerStart=innerstart,ref_lengths=self.ref_lengths,bin_start=ds,bin_end=de)
+    bam = BAM(data,self.ref_names,fileName=self.path,blockStart=bstart,innerStart=innerstart,ref_lengths=self.ref_lengths,reference=self._reference,line_number = self._line_number,bin_start=ds,bin_end=de)
     return bam
 
   def _set_output_range(self,rng):
@@ -451,6 +594,93 @@ class BAMFile:
   #    b2.close()
   #  return bams
     
+  # Pre: (optional) path to a .bai or .csi index, otherwise look next to the bam
+  # Post: the index is loaded for fetch
+  def read_bai(self,index_file=None):
+    from Bio.Format.BamIndex import BAI
+    if not index_file:
+      for f in [self.path+'.bai',re.sub('\.bam$','',self.path)+'.bai',self.path+'.csi']:
+        if os.path.exists(f):
+          index_file = f
+          break
+    if not index_file:
+      sys.stderr.write("ERROR: no .bai or .csi index found for "+self.path+"\n")
+      sys.exit()
+    self._bai = BAI(index_file)
+    return True
+
+  # Region query using the standard .bai or .csi index
+  # Pre: chromosome and (optional) 1-indexed start and end, or a GenomicRange
+  # Post: generator of entries whose target range overlaps the region,
+  #       in file order.  Stops reading once entries start past the end.
+  def fetch(self,chr=None,start=None,end=None,rng=None):
+    if rng:
+      chr = rng.chr
+      start = rng.start
+      end = rng.end
+    if not self._bai: self.read_bai()
+    if chr not in self._ref_ids: return
+    if not start: start = 1
+    if not end: end = self.ref_lengths[chr]
+    chunks = self._bai.get_chunks(self._ref_ids[chr],start-1,end)
+    if len(chunks) == 0: return
+    b2 = BAMFile(self.path,reference=self._reference,compact=self._compact)
+    for [cstart,cend] in chunks:
+      b2.fh.seek(cstart >> 16,cstart & 0xFFFF)
+      while (b2.fh.get_block_start() << 16 | b2.fh.get_inner_start()) < cend:
+        e = b2.read_entry2()
+        if not e: break
+        if e.value('rname') != chr or e.value('pos') > end: # sorted so we are done
+          b2.close()
+          return
+        rng2 = e.get_target_range()
+        if rng2 and rng2.end < start: continue
+        if not rng2 and e.value('pos') < start: continue
+        yield e
+    b2.close()
+
+  # Pre: (optional) path to a .bgi index in either format, otherwise the bam path + .bgi
+  # Post: the index is loaded for fetch_by_names
+  def read_bgi(self,index_file=None):
+    from Bio.Format.BamIndex import load_index
+    if not index_file: index_file = self.path+'.bgi'
+    if not os.path.exists(index_file):
+      sys.stderr.write("ERROR: no .bgi index found for "+self.path+"\n")
+      sys.exit()
+    self._bgi = load_index(index_file)
+    return True
+
+  # Batched lookup of records by query name through the .bgi index
+  # Pre: a list of names
+  #      file_order yields entries in file order rather than name by name
+  #      in the order requested
+  # Post: generator of every entry for each name found in the index
+  def fetch_by_names(self,names,file_order=False):
+    if not self._bgi: self.read_bgi()
+    coords = []
+    for name in names:
+      coords += self._bgi.get_coords_by_name(name)
+    return self.fetch_by_coords(coords,file_order=file_order)
+
+  # Pre: a list of [block start, inner start] coordinates
+  #      file_order yields entries in file order rather than request order
+  # Post: generator of the entry at each coordinate.  The coordinates are
+  #       sorted and read through one handle, so each bgzf block is only
+  #       decompressed once.  For request order the entries are held until
+  #       all of them have been read.
+  def fetch_by_coords(self,coords,file_order=False):
+    voffsets = [c[0] << 16 | c[1] for c in coords]
+    b2 = BAMFile(self.path,reference=self._reference,compact=self._compact)
+    found = {}
+    for v in sorted(set(voffsets)):
+      b2.fh.seek(v >> 16,v & 0xFFFF)
+      e = b2.read_entry2()
+      if file_order: yield e
+      else: found[v] = e
+    b2.close()
+    if not file_order:
+      for v in voffsets: yield found[v]
+
   # only get a single
   def fetch_by_coord(self,coord):
     #b2 = BAMFile(self.path,blockStart=coord[0],innerStart=coord[1],index_obj=self.index,reference=self._reference)
@@ -467,10 +697,13 @@ class BAMFile:
 
   def _read_reference_information(self):
     for n in range(self.n_ref):
-      l_name = struct.unpack('<i',self.fh.read(4))[0]
-      name = self.fh.read(l_name).rstrip('\0')
-      l_ref = struct.unpack('<i',self.fh.read(4))[0]
+      [b,bs,be] = self.fh.read_buffer(4)
+      l_name = struct.unpack_from('<i',b,bs)[0]
+      [b,bs,be] = self.fh.read_buffer(l_name+4)
+      name = b[bs:bs+l_name].rstrip('\0')
+      l_ref = struct.unpack_from('<i',b,bs+l_name)[0]
       self.ref_lengths[name] = l_ref
+      self._ref_ids[name] = len(self.ref_names)
       self.ref_names.append(name)
   def _read_top_header(self):
     magic = self.fh.read(4)
@@ -478,191 +711,408 @@ class BAMFile:
     self.header_text = self.fh.read(l_text).rstrip('\0')
     self.n_ref = struct.unpack('<i',self.fh.read(4))[0]
 
-def _parse_bam_data_block(bin_in,ref_names):
+# Pre: bin_in holds the record, optionally between start and end of a larger buffer
+def _parse_bam_data_block(bin_in,ref_names,start=0,end=None):
+  if end is None: end = len(bin_in)
   v = {}
-  data = StringIO(bin_in)
-  rname_num = struct.unpack('<i',data.read(4))[0]
+  rname_num, pos, bin_mq_nl, flag_nc, l_seq, rnext_num, pnext, tlen = struct.unpack_from('<iiIIiiii',bin_in,start)
   v['rname'] = ref_names[rname_num] #refID to check in ref names
-  v['pos'] = struct.unpack('<i',data.read(4))[0] + 1 #POS
-  bin_mq_nl = struct.unpack('<I',data.read(4))[0]
+  v['pos'] = pos + 1 #POS
   bin =  bin_mq_nl >> 16 
+  v['bin'] = bin
+  v['rname_id'] = rname_num # -1 when there is no reference
+  v['rnext_id'] = rnext_num
   v['mapq'] = (bin_mq_nl & 0xFF00) >> 8 #mapq
   l_read_name = bin_mq_nl & 0xFF #length of qname
-  flag_nc = struct.unpack('<I',data.read(4))[0] #flag and n_cigar_op
   v['flag'] = flag_nc >> 16
   n_cigar_op = flag_nc & 0xFFFF
-  l_seq = struct.unpack('<i',data.read(4))[0]
-  rnext_num = struct.unpack('<i',data.read(4))[0]
   if rnext_num == -1:
     v['rnext'] = '*'
   else:
     v['rnext'] = ref_names[rnext_num] #next_refID in ref_names
-  v['pnext'] = struct.unpack('<i',data.read(4))[0]+1 #pnext
-  tlen = struct.unpack('<i',data.read(4))[0]
+  v['pnext'] = pnext+1 #pnext
   v['tlen'] = tlen
-  v['qname'] = data.read(l_read_name).rstrip('\0') #read_name or qname
-  #print 'n_cigar_op '+str(n_cigar_op)
-  v['cigar_bytes'] = data.read(n_cigar_op*4)
-  #print 'cigar bytes '+str(len(v['cigar_bytes']))
-  v['seq_bytes'] = data.read((l_seq+1)/2)
-  v['qual_bytes'] = data.read(l_seq)
-  v['extra_bytes'] = data.read()
+  p = start+32
+  v['qname'] = bin_in[p:p+l_read_name].rstrip('\0') #read_name or qname
+  p += l_read_name
+  v['cigar_bytes'] = bin_in[p:p+n_cigar_op*4]
+  p += n_cigar_op*4
+  v['seq_bytes'] = bin_in[p:p+(l_seq+1)/2]
+  p += (l_seq+1)/2
+  v['qual_bytes'] = bin_in[p:p+l_seq]
+  p += l_seq
+  v['extra_bytes'] = bin_in[p:end]
   #last second tweak
   if v['rnext'] == v['rname']: v['rnext'] = '='
   return v
 
+# Pre: a sam line and a dict of reference names to numbers
+# Post: the bam record for it, without the leading block_size
+def _sam_to_bin(line,ref_ids):
+  f = line.rstrip("\n").split("\t")
+  refid = -1
+  if f[2] != '*': refid = ref_ids[f[2]]
+  pos = int(f[3])-1
+  nextid = -1
+  if f[6] == '=': nextid = refid
+  elif f[6] != '*': nextid = ref_ids[f[6]]
+  cigar = array('I')
+  tlen = 0
+  if f[5] != '*':
+    for m in re.finditer('([0-9]+)([MIDNSHP=X])',f[5]):
+      op = _bam_ops.index(m.group(2))
+      cigar.append(int(m.group(1)) << 4 | op)
+      if op in _bam_target_ops: tlen += int(m.group(1))
+  if sys.byteorder == 'big': cigar.byteswap()
+  seq = ''
+  qual = ''
+  l_seq = 0
+  if f[9] != '*':
+    l_seq = len(f[9])
+    seq = ''.join([chr(_sam_base[f[9][i]] << 4 | _sam_base[f[9][i+1]]) for i in range(0,l_seq-1,2)])
+    if l_seq % 2: seq += chr(_sam_base[f[9][-1]] << 4)
+    if f[10] == '*': qual = '\xff'*l_seq
+    else: qual = ''.join([chr(ord(c)-33) for c in f[10]])
+  end = pos+max(tlen,1)
+  if pos < 0: bin = 4680
+  else: bin = _reg2bin(pos,end)
+  qname = f[0]+'\0'
+  data = struct.pack('<iiIIiiii',refid,pos,bin << 16 | int(f[4]) << 8 | len(qname),int(f[1]) << 16 | len(cigar),l_seq,nextid,int(f[7])-1,int(f[8]))
+  return data+qname+cigar.tostring()+seq+qual+''.join([_sam_tag_to_bin(x) for x in f[11:]])
+
+_sam_base = {}
+for i in range(0,len(_bam_char)):
+  _sam_base[_bam_char[i]] = i
+  _sam_base[_bam_char[i].lower()] = i
+_sam_base['.'] = 15
+
+# Post: the bam bytes for a TAG:TYPE:VALUE from a sam line
+#       integers are stored in the smallest type that holds them
+def _sam_tag_to_bin(text):
+  key, val_type, val = text[0:2], text[3], text[5:]
+  if val_type == 'i':
+    v = int(val)
+    for t in ['c','s','i'] if v < 0 else ['C','S','I']:
+      size, fmt = _bam_value_type[t]
+      if -(1 << (8*size-1)) <= v < (1 << (8*size)): break
+    return key+t+struct.pack(fmt,v)
+  elif val_type == 'f': return key+'f'+struct.pack('<f',float(val))
+  elif val_type == 'A': return key+'A'+val
+  elif val_type == 'B':
+    vals = val.split(',')
+    fmt = _bam_value_type[vals[0]][1]
+    conv = float if vals[0] == 'f' else int
+    return key+'B'+vals[0]+struct.pack('<i',len(vals)-1)+''.join([struct.pack(fmt,conv(x)) for x in vals[1:]])
+  return key+val_type+val+'\0' # Z and H
+
+# Post: the bin of a 0-based half open region, from the SAM specification
+def _reg2bin(beg,end):
+  end -= 1
+  if beg >> 14 == end >> 14: return ((1 << 15)-1)/7 + (beg >> 14)
+  if beg >> 17 == end >> 17: return ((1 << 12)-1)/7 + (beg >> 17)
+  if beg >> 20 == end >> 20: return ((1 << 9)-1)/7 + (beg >> 20)
+  if beg >> 23 == end >> 23: return ((1 << 6)-1)/7 + (beg >> 23)
+  if beg >> 26 == end >> 26: return ((1 << 3)-1)/7 + (beg >> 26)
+  return 0
+
 def _bin_to_qual(qual_bytes):
   if len(qual_bytes) == 0: return '*'
-  if struct.unpack('<B',qual_bytes[0])[0] == 0xFF: return '*'
-  #print qual_bytes
-  #try:
-  qual = ''.join([chr(struct.unpack('<B',x)[0]+33) for x in qual_bytes])
-  #except:
-  #  return '*'
-  return qual
+  if qual_bytes[0] == '\xff': return '*'
+  return qual_bytes.translate(_bam_qual)
 
 def _bin_to_seq(seq_bytes):
   if len(seq_bytes) == 0: return None
-  global _bam_char
-  #print len(seq_bytes)
-  seq = ''.join([''.join([''.join([chr(z+97).translate(_bam_char) for z in  [y>>4,y&0xF]]) for y in struct.unpack('<B',x)]) for x in seq_bytes]).rstrip('=')
-  return seq
+  return ''.join(map(_bam_seq_pairs.__getitem__,bytearray(seq_bytes))).rstrip('=')
 
 def _bin_to_cigar(cigar_bytes):
-  global _bam_ops
   if len(cigar_bytes) == 0: return [[],'*']
-  cigar_packed = [struct.unpack('<I',x)[0] for x in \
-             [cigar_bytes[i:i+4] for i in range(0,len(cigar_bytes),4)]]
-  cigar_array = [[c >> 4, str(c &0xF).translate(_bam_ops)] for c in cigar_packed]
-  cigar_seq = ''.join([''.join([str(x[0]),x[1]]) for x in cigar_array])
+  cigar_packed = array('I') # cigar words are uint32
+  cigar_packed.fromstring(cigar_bytes)
+  if sys.byteorder == 'big': cigar_packed.byteswap()
+  cigar_array = [[c >> 4, _bam_ops[c & 0xF]] for c in cigar_packed]
+  cigar_seq = ''.join([str(x[0])+x[1] for x in cigar_array])
   return [cigar_array,cigar_seq]
 
+# Pre: the extra bytes of an entry and the position of a tag in them
+# Post: [tag, value type, value start, position of the next tag]
+#       Only finds the bounds, nothing is decoded
+def _bin_tag_span(extra_bytes,pos):
+  tag = extra_bytes[pos:pos+2]
+  val_type = extra_bytes[pos+2]
+  start = pos+3
+  if val_type in _bam_value_type:
+    return [tag,val_type,start,start+_bam_value_type[val_type][0]]
+  elif val_type == 'A':
+    return [tag,val_type,start,start+1]
+  elif val_type == 'Z' or val_type == 'H':
+    end = extra_bytes.find('\0',start)
+    if end == -1: end = len(extra_bytes)
+    return [tag,val_type,start,end+1]
+  elif val_type == 'B':
+    array_type = extra_bytes[start]
+    if array_type not in _bam_value_type:
+      sys.stderr.write("ERROR: unknown array type "+array_type+" for tag "+tag+"\n")
+      sys.exit()
+    element_count = struct.unpack_from('<i',extra_bytes,start+1)[0]
+    return [tag,val_type,start,start+5+element_count*_bam_value_type[array_type][0]]
+  sys.stderr.write("ERROR: unknown type "+val_type+" for tag "+tag+"\n")
+  sys.exit()
+
+# Pre: the extra bytes and a span from _bin_tag_span
+# Post: int for the integer types, float for f, a list for B arrays
+#       and a string for A, Z and H
+def _bin_tag_value(extra_bytes,val_type,start,end):
+  if val_type in _bam_value_type:
+    return struct.unpack_from(_bam_value_type[val_type][1],extra_bytes,start)[0]
+  elif val_type == 'A':
+    return extra_bytes[start]
+  elif val_type == 'Z' or val_type == 'H':
+    return extra_bytes[start:end-1]
+  # B array, all elements unpacked at once
+  array_type = extra_bytes[start]
+  element_count = struct.unpack_from('<i',extra_bytes,start+1)[0]
+  fmt = '<'+str(element_count)+_bam_value_type[array_type][1][1]
+  return list(struct.unpack_from(fmt,extra_bytes,start+5))
+
+# The SAM text for a decoded tag value
+def _sam_tag_text(tag,val_type,val,array_type=None):
+  if val_type == 'f':
+    return tag+':f:'+('%g' % val)
+  elif val_type in _bam_value_type:
+    return tag+':i:'+str(val)
+  elif val_type == 'B':
+    if array_type == 'f':
+      return tag+':B:f'+''.join([','+('%g' % x) for x in val])
+    return tag+':B:'+array_type+''.join([','+str(x) for x in val])
+  return tag+':'+val_type+':'+val
+
+#Pre the reamining bytes of an entry and a tag
+#Post {'type':,'value':} for that tag or None if its not there
+#     Tags before it are only skipped over, not decoded
+def _bin_to_tag(extra_bytes,key):
+  pos = 0
+  while pos < len(extra_bytes):
+    [tag,val_type,start,pos] = _bin_tag_span(extra_bytes,pos)
+    if tag == key:
+      return {'type':val_type,'value':_bin_tag_value(extra_bytes,val_type,start,pos)}
+  return None
+
 #Pre all the reamining bytes of an entry
 #Post an array of 
-# 1. A dict keyed by Tag with {'type':,'value':} where value is a string unless type is i
+# 1. A dict keyed by Tag with {'type':,'value':} where value is an int for
+#    integer types, float for f, list for B and a string otherwise
 # 2. A string of the remainder
 def _bin_to_extra(extra_bytes):
-  global _bam_value_type
-  extra = StringIO(extra_bytes)
   tags = {}
-  rem = ''
-  while extra.tell() < len(extra_bytes):
-    tag = extra.read(2)
-    val_type = extra.read(1)
-    if val_type == 'Z':
-      rem += tag+':'
-      rem += val_type+':'
-      p = re.compile('([!-~])')
-      m = p.match(extra.read(1))
-      vre = ''
-      while m:
-        vre += m.group(1)
-        c = extra.read(1)
-        #print c
-        m = p.match(c)
-      rem += vre+"\t"
-      tags[tag] = {'type':val_type,'value':vre}
-    elif val_type == 'A':
-      rem += tag+':'
-      rem += val_type+':'
-      vre = extra.read(1)
-      rem += vre+"\t"      
-      tags[tag] = {'type':val_type,'value':vre}      
-    elif val_type in _bam_value_type:
-      rem += tag+':'
-      rem += 'i'+':'
-      val = struct.unpack(_bam_value_type[val_type][1],extra.read(_bam_value_type[val_type][0]))[0]
-      rem += str(val)+"\t"
-      tags[tag] = {'type':val_type,'value':val}
-    elif val_type == 'B':
-      sys.sterr.write("WARNING array not implmented\n")
-      continue
-      rem += tag+':'
-      rem += val_type+':'
-      array_type = _bam_value_type[extra.read(1)]
-      element_count = struct.unpack('<I',extra.read(4))[0]
-      array_bytes = extra.read(element_count*_bam_value_type[array_type][0])
-      for by in [array_bytes[i:i+_bam_value_type[array_type][0]] for i in range(0,len(array_bytes),_bam_value_type[array_type][0])]:
-        aval = struct.unpack(_bam_value_type[array_type][1],by)
-  return [tags,rem.rstrip("\t")]
+  rem = []
+  pos = 0
+  while pos < len(extra_bytes):
+    [tag,val_type,start,pos] = _bin_tag_span(extra_bytes,pos)
+    val = _bin_tag_value(extra_bytes,val_type,start,pos)
+    tags[tag] = {'type':val_type,'value':val}
+    array_type = None
+    if val_type == 'B': array_type = extra_bytes[start]
+    rem.append(_sam_tag_text(tag,val_type,val,array_type))
+  return [tags,"\t".join(rem)]
 
 
 class BGZF:
   # Methods adapted from biopython's bgzf.py
-  def __init__(self,filename,blockStart=None,innerStart=None):
+  # threads greater than one inflates upcoming blocks on worker threads
+  def __init__(self,filename,blockStart=None,innerStart=None,threads=1):
     self.path = filename
     self.fh = open(filename,'rb')
     if blockStart: self.fh.seek(blockStart)
     self._block_start = 0
+    self._cache_path = block_cache_key(filename) # random access goes through block_cache
+    self._cache_next = True # store the block we land on after a seek
+    self._read_ahead = None
+    if threads > 1:
+      self._read_ahead = BlockReadAhead(self.fh,self.fh.tell(),threads)
     #self.pointer = 0
     #holds block_size and data
     self._buffer = self._load_block()
     self._buffer_pos = 0
     if innerStart: self._buffer_pos = innerStart
   def close(self):
+    if self._read_ahead: self._read_ahead.close()
+    self._read_ahead = None
     self.fh.close()
   def get_block_start(self):
     return self._block_start
   def get_inner_start(self):
     return self._buffer_pos
   def seek(self,blockStart,innerStart):
+    if blockStart == self._block_start and self._buffer['data']: # block is already decompressed
+      self._buffer_pos = innerStart
+      return
     self.fh.seek(blockStart)
+    if self._read_ahead: self._read_ahead.reset(blockStart)
+    self._cache_next = True
     self._buffer_pos = 0
     self._buffer = self._load_block()
     self._buffer_pos = innerStart
   def read(self,size):
+    data = self._buffer['data']
+    if size < len(data) - self._buffer_pos: # all in this block
+      v = data[self._buffer_pos:self._buffer_pos+size]
+      self._buffer_pos += size
+      return v
     done = 0 #number of bytes that have been read so far
-    v = ''
+    parts = [] # joined once at the end rather than copied on every block
     while True:
       if size-done < len(self._buffer['data']) - self._buffer_pos:
-        v +=  self._buffer['data'][self._buffer_pos:self._buffer_pos+(size-done)]
+        parts.append(self._buffer['data'][self._buffer_pos:self._buffer_pos+(size-done)])
         self._buffer_pos += (size-done)
         #self.pointer += size
-        return v
+        return ''.join(parts)
       else: # we need more buffer
         vpart = self._buffer['data'][self._buffer_pos:]
         self._buffer = self._load_block()
-        v += vpart
+        parts.append(vpart)
         self._buffer_pos = 0
-        if len(self._buffer['data'])==0: return v
+        if len(self._buffer['data'])==0: return ''.join(parts)
         done += len(vpart)
 
+  # Pre: size in bytes
+  # Post: [buf, start, end] where buf[start:end] are the bytes read
+  #       If they are all in the current block, buf is the decompressed
+  #       block itself and nothing is copied.  Use with struct.unpack_from.
+  def read_buffer(self,size):
+    data = self._buffer['data']
+    start = self._buffer_pos
+    if size < len(data) - start:
+      self._buffer_pos += size
+      return [data,start,start+size]
+    v = self.read(size)
+    return [v,0,len(v)]
+
+  # Pre: b is a writable buffer such as a bytearray
+  # Post: b is filled straight from the decompressed blocks
+  #       returns the number of bytes read
+  def readinto(self,b):
+    view = memoryview(b)
+    size = len(view)
+    done = 0
+    while done < size:
+      data = self._buffer['data']
+      avail = len(data) - self._buffer_pos
+      if size-done < avail:
+        view[done:size] = buffer(data,self._buffer_pos,size-done)
+        self._buffer_pos += (size-done)
+        return size
+      view[done:done+avail] = buffer(data,self._buffer_pos,avail)
+      done += avail
+      self._buffer = self._load_block()
+      self._buffer_pos = 0
+      if len(self._buffer['data'])==0: break
+    return done
+
   def _load_block(self):
     #pointer_start = self.fh.tell()
-    if not self.fh: return {'block_size':0,'data':''}
-    self._block_start = self.fh.tell()
-    magic = self.fh.read(4)
-    if len(magic) < 4:
-      #print 'end?'
-      #print len(self.fh.read())
-      return {'block_size':0,'data':''}
-    gzip_mod_time, gzip_extra_flags, gzip_os,extra_len = struct.unpack("<LBBH",self.fh.read(8))
-    pos = 0
-    block_size = None
-    #get block_size
-    while pos < extra_len:
-      subfield_id = self.fh.read(2)
-      subfield_len = struct.unpack("<H",self.fh.read(2))[0]
-      subfield_data = self.fh.read(subfield_len)
-      pos += subfield_len+4
-      if subfield_id == 'BC':
-        block_size = struct.unpack("<H",subfield_data)[0]+1
-    #block_size is determined
-    deflate_size = block_size - 1 - extra_len - 19
-    d = zlib.decompressobj(-15)
-    data = d.decompress(self.fh.read(deflate_size))+d.flush()
-    expected_crc = self.fh.read(4)
-    expected_size = struct.unpack("<I",self.fh.read(4))[0]
-    if expected_size != len(data):
-      sys.stderr.write("ERROR unexpected size\n")
-      sys.exit()
-    crc = zlib.crc32(data)
-    if crc < 0:  crc = struct.pack("<i",crc)
-    else:  crc = struct.pack("<I",crc)
-    if crc != expected_crc:
-      sys.stderr.write("ERROR crc fail\n")
-      sys.exit()
-    return {'block_size':block_size, 'data':data}
+    if not self.fh: return {'block_start':0,'block_size':0,'data':''}
+    if self._read_ahead:
+      block = self._read_ahead.next_block()
+    else:
+      block = load_cached_block(self.fh,self._cache_path,self.fh.tell(),self._cache_next)
+      self._cache_next = False
+    self._block_start = block['block_start']
+    return block
+
+# Write a BAM file straight to BGZF without going through samtools
+# CompactBAM records are written as the raw bytes they were read as.
+# BAM records are packed from their fixed fields with the raw cigar,
+# seq, qual and tag bytes they were read with.  SAM records are encoded.
+# References are matched by name, so entries can come from a bam with
+# its references in another order.
+# Pre: filename to write, or an open handle
+#      header_text is the sam header
+#      (optional) ref_names list and ref_lengths dict, otherwise they
+#                 come from the @SQ lines of the header
+#      (optional) threads greater than one compresses on that many threads
+#      (optional) level is the zlib compression level, samtools uses 6
+class BAMWriter:
+  def __init__(self,filename,header_text,ref_names=None,ref_lengths=None,threads=1,level=6):
+    self._own_handle = False
+    if hasattr(filename,'write'): self._of = filename
+    else:
+      self._of = open(filename,'wb')
+      self._own_handle = True
+    self._bgzf = BGZF_writer(self._of,level=level,threads=threads)
+    if ref_names is None:
+      ref_names = []
+      ref_lengths = {}
+      for line in header_text.split("\n"):
+        m = re.match('@SQ\t.*SN:([^\t]+)',line)
+        if not m: continue
+        ref_names.append(m.group(1))
+        ref_lengths[m.group(1)] = int(re.search('\tLN:(\d+)',line).group(1))
+    self.ref_names = ref_names
+    self.ref_lengths = ref_lengths
+    self._ref_ids = {}
+    for i in range(0,len(ref_names)): self._ref_ids[ref_names[i]] = i
+    self._remaps = {} # id of a source ref_names list to [list, refid remap]
+    if header_text and not header_text.endswith("\n"): header_text += "\n"
+    out = ['BAM\1',struct.pack('<i',len(header_text)),header_text,struct.pack('<i',len(ref_names))]
+    for name in ref_names:
+      out.append(struct.pack('<i',len(name)+1)+name+'\0'+struct.pack('<i',ref_lengths[name]))
+    self._bgzf.write(''.join(out))
+
+  # Pre: a SAM, BAM or CompactBAM entry
+  def write_entry(self,e):
+    if isinstance(e,CompactBAM):
+      data = e._data
+      remap = self._get_remap(e._ref_names)
+      if remap is not None:
+        data = bytearray(data)
+        struct.pack_into('<i',data,0,remap[e._refid])
+        struct.pack_into('<i',data,20,remap[e._next_refid])
+        data = str(data)
+    elif isinstance(e,BAM):
+      data = self._pack_bam(e)
+    else:
+      data = _sam_to_bin(e.get_line(),self._ref_ids)
+    self._bgzf.write(struct.pack('<i',len(data))+data)
+
+  # Pre: a bam record without its leading block_size
+  #      using this writer's reference numbering
+  def write_bytes(self,data):
+    self._bgzf.write(struct.pack('<i',len(data))+data)
+
+  def close(self):
+    self._bgzf.close()
+    if self._own_handle: self._of.close()
+    else: self._of.flush()
+
+  # Pre: the ref_names list an entry was read with
+  # Post: None if its numbering is the same as this writer's,
+  #       otherwise a dict of its refid to this writer's refid.
+  #       Built once for each source list.
+  def _get_remap(self,ref_names):
+    key = id(ref_names)
+    if key not in self._remaps:
+      remap = None
+      if ref_names is not self.ref_names and ref_names != self.ref_names:
+        remap = {-1:-1}
+        for i in range(0,len(ref_names)): remap[i] = self._ref_ids[ref_names[i]]
+      # keep the list so its id is not reused while we hold it
+      self._remaps[key] = [ref_names,remap]
+    return self._remaps[key][1]
+
+  def _pack_bam(self,e):
+    refid = -1
+    if e.value('rname_id') != -1: refid = self._ref_ids[e.value('rname')]
+    rnext = e.value('rnext')
+    nextid = -1
+    if e.value('rnext_id') == -1: nextid = -1
+    elif rnext == '=': nextid = refid
+    else: nextid = self._ref_ids[rnext]
+    qname = e.value('qname')+'\0'
+    cigar_bytes = e.value('cigar_bytes')
+    qual_bytes = e.value('qual_bytes')
+    return struct.pack('<iiIIiiii',refid,e.value('pos')-1,e.value('bin') << 16 | e.value('mapq') << 8 | len(qname),\
+                       e.value('flag') << 16 | len(cigar_bytes)/4,len(qual_bytes),nextid,e.value('pnext')-1,e.value('tlen'))\
+           +qname+cigar_bytes+e.value('seq_bytes')+qual_bytes+e.value('extra_bytes')
 
 class SamStream:
   #  minimum_intron_size greater than zero will only show sam entries with introns (junctions)
@@ -680,6 +1130,7 @@ class SamStream:
       self.minimum_intron_size = minimum_intron_size
     self._header = None
     self.header_text = ''
+    self._junction_lines = deque() # filtered lines waiting in junction only mode
     if fh:
       self.fh = fh
       self.assign_handle(fh)
@@ -709,10 +1160,8 @@ class SamStream:
           break
       # make sure our first line is
       if self.junction_only:
-        while True:
-          if not self.previous_line: break
-          if is_junction_line(self.previous_line,self.minimum_intron_size,self.minimum_overhang): break
-          self.previous_line = self.fh.readline()
+        if self.previous_line and not is_junction_line(self.previous_line,self.minimum_intron_size,self.minimum_overhang):
+          self.previous_line = self._next_junction_line()
 
   def __iter__(self):
     return self
@@ -727,22 +1176,37 @@ class SamStream:
   def read_entry(self):
     if not self.previous_line: return False
     out = self.previous_line
-    self.previous_line = self.fh.readline()
     if self.junction_only:
-      while True:
-        if not self.previous_line: break
-        if is_junction_line(self.previous_line,self.minimum_intron_size,self.minimum_overhang): break
-        self.previous_line = self.fh.readline()
+      self.previous_line = self._next_junction_line()
+    else:
+      self.previous_line = self.fh.readline()
     if out:
-      s = SAM(out,reference=self._reference)
-      s.get_range()
-      return s
+      return SAM(out,reference=self._reference)
     return None
 
+  # In junction only mode lines are read in chunks and filtered together
+  # Post: the next junction line, or an empty string at the end
+  def _next_junction_line(self):
+    while not self._junction_lines:
+      lines = self.fh.readlines(_junction_batch_bytes)
+      if not lines: return ''
+      self._junction_lines.extend(filter_junction_lines(lines,self.minimum_intron_size,self.minimum_overhang))
+    return self._junction_lines.popleft()
+
+_junction_batch_bytes = 4*1024*1024
+_junction_cigar_pattern = re.compile('([0-9]+)([NMX=])')
+
+# Pre: a list of sam lines (no header lines)
+# Post: the ones with an intron of minlen or more, as in is_junction_line
+def filter_junction_lines(lines,minlen=68,minoverhang=0):
+  return [x for x in lines if 'N' in x and is_junction_line(x,minlen,minoverhang)]
+
+# Only the cigar column is looked at, and lines without an N in it
+# are turned away before the cigar is parsed.
 def is_junction_line(line,minlen=68,minoverhang=0):
-  prog = re.compile('([0-9]+)([NMX=])')
-  f = line.rstrip().split("\t")
-  v = prog.findall(f[5])
+  cigar = line.split("\t",6)[5]
+  if 'N' not in cigar: return False
+  v = _junction_cigar_pattern.findall(cigar)
   #get the indecies of introns
   ns = [i for i in range(0,len(v)) if v[i][1]=='N' and int(v[i][0]) >= minlen]
   if len(ns) == 0: return False
@@ -783,6 +1247,7 @@ class SamtoolsBAMStream(SamStream):
       self.minimum_intron_size = minimum_intron_size
     self.header_text = ''
     self._header = None
+    self._junction_lines = deque() # filtered lines waiting in junction only mode
     self.path = path
     cmd = 'samtools view -h '+self.path
     self.fh_orig = Popen(cmd.split(),stdout=PIPE)
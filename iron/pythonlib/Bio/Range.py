@@ -1,9 +1,13 @@
-import sys, re, json
+import sys, re, json, pickle
+from bisect import bisect_left, bisect_right
 # These classes are to help deal with genomic coordinates and 
 # this associated with those coordinates.
 
 #These are 1-index for both start and end
-class GenomicRange:
+# Slotted, and the payload list is only made once a payload is set, since
+# alignments and transcripts make many thousands of these.
+class GenomicRange(object):
+  __slots__ = ('chr','start','end','direction','_payload')
   def __init__(self,chr=None,start=None,end=None,dir=None,range_string=None):
     if range_string:
       m = re.match('^(.+):(\d+)-(\d+)$',range_string)
@@ -19,10 +23,30 @@ class GenomicRange:
     self.start = None
     if start:
       self.start = int(start)
+    self.end = None
     if end:
       self.end = int(end)
     self.direction = dir
-    self.payload = [] # should be a reference since its an array
+    self._payload = None
+
+  # the payload list, made when it is first needed
+  @property
+  def payload(self):
+    if self._payload is None: self._payload = []
+    return self._payload
+  @payload.setter
+  def payload(self,v):
+    self._payload = v
+
+  # slots have no __dict__ for pickle to use
+  def __getstate__(self):
+    return [self.chr,self.start,self.end,self.direction,self._payload]
+  def __setstate__(self,state):
+    [self.chr,self.start,self.end,self.direction,self._payload] = state
+
+  # sorts the same as sort_ranges
+  def __lt__(self,other):
+    return (self.chr,self.start,self.end,self.direction) < (other.chr,other.start,other.end,other.direction)
 
   def load_serialized(self,instr):
     self = pickle.loads(instr)
@@ -33,15 +57,13 @@ class GenomicRange:
 
   def __str__(self):
     payload = False
-    if len(self.payload)>0: payload = True
+    if self._payload: payload = True
     return self.get_range_string()+" dir:"+str(self.direction)+" payload:"+str(payload)
 
   # Copy with the exception of payload.  Thats still a link
   def copy(self):
     n = GenomicRange(self.chr,self.start,self.end,self.direction)
-    n.payload = []
-    for p in self.payload:
-      n.payload.append(p)
+    if self._payload: n._payload = self._payload[:]
     return n
 
   def get_range(self):
@@ -54,12 +76,12 @@ class GenomicRange:
     return arr 
 
   def get_payload(self):
-    return self.payload[0]
+    return self._payload[0]
   def set_payload(self,inpay):
-    if len(self.payload)==0:
-      self.payload = [inpay]
+    if not self._payload:
+      self._payload = [inpay]
       return
-    self.payload[0] = inpay
+    self._payload[0] = inpay
   def get_direction(self):
     return self.direction
   def set_direction(self,dir):
@@ -94,62 +116,24 @@ class GenomicRange:
     return False
 
   def overlaps(self,in_genomic_range,use_direction=False,padding=0):
-    if padding > 0:
-      in_genomic_range = GenomicRange(in_genomic_range.chr,max([1,in_genomic_range.start-padding]),in_genomic_range.end+padding)
     if self.chr != in_genomic_range.chr:
       return False
-    if self.direction != in_genomic_range.direction and use_direction :
-      return False
-    if self.end < in_genomic_range.start:
-      return False
-    if in_genomic_range.end < self.start:
-      return False
-    if self.start > in_genomic_range.end:
-      return False
-    if in_genomic_range.start > self.end:
+    if use_direction and self.direction != in_genomic_range.direction:
       return False
-    if self.start <= in_genomic_range.start and self.end >= in_genomic_range.start:
-      return True
-    if self.start <= in_genomic_range.end and self.end >= in_genomic_range.end:
-      return True
-    if self.start >= in_genomic_range.start and self.end <= in_genomic_range.end:
-      return True
-    if self.start <= in_genomic_range.start and self.end >= in_genomic_range.end:
-      return True
-    if in_genomic_range.start <= self.start and in_genomic_range.end >= self.start:
-      return True
-    if in_genomic_range.start <= self.end and in_genomic_range.end >= self.end:
-      return True
-    sys.stderr.write("overlaps: unprogrammed error\n")
-    return False
+    if padding > 0:
+      return self.start <= in_genomic_range.end+padding and max(1,in_genomic_range.start-padding) <= self.end
+    return self.start <= in_genomic_range.end and in_genomic_range.start <= self.end
 
   def overlaps_with_padding(self,in_genomic_range,padding):
-    in_range_padded = GenomicRange(in_genomic_range.chr,max([1,in_genomic_range.start-padding]),in_genomic_range.end+padding)
-    return self.overlaps(in_range_padded)
+    return self.overlaps(in_genomic_range,padding=padding)
 
   def overlap_size(self,in_genomic_range):
     if self.chr != in_genomic_range.chr:
       return 0
-    if self.end < in_genomic_range.start:
-      return 0
-    if in_genomic_range.end < self.start:
-      return 0
-    if self.start > in_genomic_range.end:
+    o = in_genomic_range
+    if self.end < o.start or o.end < self.start:
       return 0
-    if self.start >= in_genomic_range.start and self.end <= in_genomic_range.end:
-      return self.end-self.start+1
-    if self.start <= in_genomic_range.start and self.end >= in_genomic_range.end:
-      return in_genomic_range.end-in_genomic_range.start+1
-    if self.start <= in_genomic_range.start and self.end >= in_genomic_range.start:
-      return self.end-in_genomic_range.start+1
-    if self.start <= in_genomic_range.end and self.end >= in_genomic_range.end:
-      return in_genomic_range.end-self.start+1
-    if in_genomic_range.start <= self.start and in_genomic_range.end >= self.start:
-      return in_genomic_range.end-self.start+1
-    if in_genomic_range.start <= self.end and in_genomic_range.end >= self.end:
-      return self.end-in_genomic_range.start+1
-    sys.stderr.write("overlap_size: unprogrammed error\n")
-    return 0
+    return (self.end if self.end < o.end else o.end)-(self.start if self.start > o.start else o.start)+1
 
   def merge(self,range2,use_direction=False): #merge this bed with another bed
     if self.chr != range2.chr:
@@ -219,18 +203,17 @@ class GenomicRange:
 # Pre: Inherits all methods of GenomicRange but modifies the class to use the 0-based start 1-based end style of a bed file
 # Essentially, a Bed is just another way of defining a GenomicRange.
 class Bed(GenomicRange):
+  __slots__ = ()
   # Takes as an input the chromosome, 0-based start, 1-based end of a range
   def __init__(self,chrom,start,finish,dir=None):
     self.start = int(start)+1
     self.end = int(finish)
     self.chr = str(chrom)
-    self.payload = []
+    self._payload = None
     self.direction = dir
   def copy(self):
     n = Bed(self.chr,self.start-1,self.end,self.direction)
-    n.payload = []
-    for p in self.payload:
-      n.payload.append(p)
+    if self._payload: n._payload = self._payload[:]
     return n
 
 class Locus:
@@ -473,6 +456,144 @@ def subtract_range_array(bed1,beds2,is_sorted=False):
     output = temp
   return output
 
+# Overlap index of a collection of ranges, built once and then queried
+# many times.  Each chromosome is kept as an implicit interval tree over
+# its members sorted by start (the layout used by cgranges), every
+# internal node carrying the largest end beneath it, so a query costs
+# O(log n) plus the overlaps found.
+# Pre: a list of anything with get_range() (GenomicRange, Bed, GPD, PSL, SAM ...)
+# Post: query, query_many and nearest return the members themselves,
+#       ordered by start on the chromosome
+class RangeIndex:
+  def __init__(self,members):
+    self._chrs = {}
+    by_chr = {}
+    for i in range(0,len(members)):
+      rng = members[i].get_range()
+      if rng.chr not in by_chr: by_chr[rng.chr] = []
+      by_chr[rng.chr].append([rng.start,rng.end,i])
+    for chr in by_chr:
+      v = sorted(by_chr[chr])
+      starts = [x[0] for x in v]
+      ends = [x[1] for x in v]
+      self._chrs[chr] = {'starts':starts,'ends':ends,'ids':[x[2] for x in v],
+                         'members':[members[x[2]] for x in v],
+                         'max':_index_max_ends(ends),'prefix_max':_prefix_max(ends)}
+  def __len__(self):
+    return sum([len(x['starts']) for x in self._chrs.values()])
+
+  # Pre: anything with get_range()
+  #      use_direction only keeps members on the same strand
+  # Post: list of the members that overlap it
+  def query(self,rng,use_direction=False):
+    rng = rng.get_range()
+    if rng.chr not in self._chrs: return []
+    c = self._chrs[rng.chr]
+    out = [c['members'][i] for i in _index_overlaps(c,rng.start,rng.end)]
+    if use_direction: out = [x for x in out if x.get_range().direction == rng.direction]
+    return out
+
+  # Post: for each query the list of members that overlap it
+  def query_many(self,rngs,use_direction=False):
+    return [self.query(x,use_direction=use_direction) for x in rngs]
+
+  # Post: positions in the original list of the members that overlap,
+  #       ordered by start
+  def query_ids(self,rng):
+    rng = rng.get_range()
+    if rng.chr not in self._chrs: return []
+    c = self._chrs[rng.chr]
+    return [c['ids'][i] for i in _index_overlaps(c,rng.start,rng.end)]
+
+  # Post: list of the members closest to the range on its chromosome,
+  #       the overlapping ones if there are any, otherwise those at
+  #       the smallest distance to either side
+  def nearest(self,rng):
+    rng = rng.get_range()
+    if rng.chr not in self._chrs: return []
+    c = self._chrs[rng.chr]
+    out = self.query(rng)
+    if out: return out
+    left = None
+    right = None
+    # nothing overlaps so every member starting before the range ends before it
+    hi = bisect_right(c['starts'],rng.end)
+    if hi > 0: 
+      left_end = c['prefix_max'][hi-1]
+      left = [c['members'][i] for i in _index_overlaps(c,left_end,left_end) if c['ends'][i] == left_end]
+    if hi < len(c['starts']):
+      right_start = c['starts'][hi]
+      right = [c['members'][i] for i in range(hi,bisect_right(c['starts'],right_start))]
+    if left is None: return right
+    if right is None: return left
+    dleft = rng.start-left_end
+    dright = right_start-rng.end
+    if dleft < dright: return left
+    if dright < dleft: return right
+    return left+right
+
+# Pre: ends of the members sorted by start
+# Post: the largest end under each node of the implicit tree
+#       even positions are leaves, and a node at level k has children
+#       2**(k-1) either side of it
+def _index_max_ends(ends):
+  n = len(ends)
+  mx = ends[:]
+  if n == 0: return mx
+  last_i = (n-1) & ~1
+  last = ends[last_i] # largest end under the last node at the current level
+  k = 1
+  while 1 << k <= n:
+    x = 1 << (k-1)
+    for i in range((x << 1)-1,n,x << 2):
+      er = last
+      if i+x < n: er = mx[i+x]
+      mx[i] = max(ends[i],mx[i-x],er)
+    if last_i >> k & 1: last_i -= x
+    else: last_i += x
+    if last_i < n and mx[last_i] > last: last = mx[last_i]
+    k += 1
+  return mx
+
+# Post: the largest of ends[0] through ends[i] for each i
+def _prefix_max(ends):
+  out = []
+  mx = None
+  for e in ends:
+    if mx is None or e > mx: mx = e
+    out.append(mx)
+  return out
+
+# Pre: a chromosome of the index, 1-indexed inclusive start and end
+# Post: sorted positions of the members that overlap
+def _index_overlaps(c,start,end):
+  starts = c['starts']
+  ends = c['ends']
+  mx = c['max']
+  n = len(starts)
+  out = []
+  if n == 0: return out
+  k = 0
+  while 1 << (k+1) <= n: k += 1
+  stack = [[k,(1 << k)-1,0]]
+  while stack:
+    [k,x,w] = stack.pop()
+    if k <= 3:
+      # a small subtree, check every member of it in order
+      i = x >> k << k
+      i1 = min(i+(1 << (k+1))-1,n)
+      while i < i1 and starts[i] <= end:
+        if ends[i] >= start: out.append(i)
+        i += 1
+    elif w == 0:
+      stack.append([k,x,1])
+      y = x-(1 << (k-1)) # the left child, which may be past the end
+      if y >= n or mx[y] >= start: stack.append([k-1,y,0])
+    elif x < n and starts[x] <= end:
+      if ends[x] >= start: out.append(x)
+      stack.append([k-1,x+(1 << (k-1)),0])
+  return out
+
 def string_to_genomic_range(rstring):
   m = re.match('([^:]+):(\d+)-(\d+)',rstring)
   if not m: 
@@ -484,68 +605,61 @@ def sort_genomic_ranges(rngs):
 
 # take a list of ranges as an input
 # output a list of ranges and the coverage at each range
+# Each chromosome is one pass over its sorted starts and ends, and
+# with threads the chromosomes are shared out across processes.
+# Post: non-overlapping ranges sorted by chromosome and start,
+#       each with its depth as the payload
 def ranges_to_coverage(rngs,threads=1):
-  # input is the bed ranges on a single chromosome
-  # out is the non-overlapping bed ranges with the edition of depth
-  def do_chr(rngs):
-    #starts = sorted(range(0,len(rngs)), key=lambda x: rngs[x].start)
-    #print starts
-    #ends = sorted(range(0,len(rngs)), key=lambda x: rngs[x].end)
-    start_events = [x.start for x in rngs]
-    end_events = [x.end+1 for x in rngs]
-    indexed_events = {}
-    for e in start_events:
-      if e not in indexed_events: indexed_events[e] = {'starts':0,'ends':0}
-      indexed_events[e]['starts']+=1
-    for e in end_events:
-      if e not in indexed_events: indexed_events[e] = {'starts':0,'ends':0}
-      indexed_events[e]['ends']+=1
-    cdepth = 0
-    pstart = None
-    pend = None
-    outputs = []
-    ordered_events = sorted(indexed_events.keys())
-    for loc in ordered_events:
-      prev_depth = cdepth # where we were
-      # see where we are before the change
-      cdepth += indexed_events[loc]['starts']
-      cdepth -= indexed_events[loc]['ends']
-      if prev_depth > 0 and prev_depth != cdepth:
-        outputs.append([rngs[0].chr,pstart,loc-1,prev_depth]) # output what was before this if we are in something
-      if prev_depth != cdepth or cdepth == 0:
-        pstart = loc
-    #print outputs
-    return outputs
-  
-  class Queue:
-    def __init__(self,val):
-      self.val = [val]
-    def get(self):
-      return self.val.pop(0)
-
-  ### START MAIN ####
-  srngs = sort_genomic_ranges(rngs)
-  # get the leftmost unique range
-  chr = srngs[0].chr
-  buffer = []
+  by_chr = {}
+  for rng in rngs:
+    if rng.chr not in by_chr: by_chr[rng.chr] = [[],[]]
+    by_chr[rng.chr][0].append(rng.start)
+    by_chr[rng.chr][1].append(rng.end)
+  chrs = sorted(by_chr.keys())
+  jobs = [[chr]+by_chr[chr] for chr in chrs]
+  if threads > 1 and len(jobs) > 1:
+    from multiprocessing import Pool
+    p = Pool(processes=threads)
+    outputs = p.map(_chr_coverage,jobs)
+    p.close()
+    p.join()
+  else:
+    outputs = [_chr_coverage(x) for x in jobs]
   results = []
-  prelim = []
-  for b in srngs:
-    if b.chr != chr:
-      rs = do_chr(buffer[:])
-      for r in rs:  
-        results.append(GenomicRange(r[0],r[1],r[2]))
-        results[-1].set_payload(r[3])
-      buffer = []
-    buffer.append(b)
-    chr = b.chr
-  if len(buffer) > 0:
-    rs = do_chr(buffer[:])
-    for r in rs: 
-      results.append(GenomicRange(r[0],r[1],r[2]))
-      results[-1].set_payload(r[3])
+  for i in range(0,len(chrs)):
+    for [start,end,depth] in outputs[i]:
+      rng = GenomicRange(chrs[i],start,end)
+      rng._payload = [depth]
+      results.append(rng)
   return results
 
+# Pre: [chromosome, starts, ends] of the ranges on one chromosome
+# Post: [start, end, depth] of each stretch of constant non-zero depth
+def _chr_coverage(job):
+  [chr,starts,ends] = job
+  starts = sorted(starts)
+  ends = sorted([x+1 for x in ends]) # depth drops the base after an end
+  n = len(starts)
+  i = 0
+  j = 0
+  depth = 0
+  pstart = None
+  outputs = []
+  while j < n:
+    loc = ends[j]
+    if i < n and starts[i] < loc: loc = starts[i]
+    prev_depth = depth
+    while i < n and starts[i] == loc:
+      depth += 1
+      i += 1
+    while j < n and ends[j] == loc:
+      depth -= 1
+      j += 1
+    if prev_depth == depth: continue
+    if prev_depth > 0: outputs.append([pstart,loc-1,prev_depth])
+    pstart = loc
+  return outputs
+
 class BedArrayStream:
   def __init__(self,bedarray):
     self.prev = None
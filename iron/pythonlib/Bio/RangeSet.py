@@ -0,0 +1,278 @@
+import sys, re
+import numpy as np
+from Bio.Range import GenomicRange
+
+# A set of ranges held as columns rather than GenomicRange objects
+# chromosome codes index into chr_names, and starts and ends are bed
+# style, 0-indexed start and 1-indexed end.
+# Set operations work on every chromosome at once by laying the
+# chromosomes end to end on one line, each at its code shifted up by
+# _shift, then sorting positions and summing start and end events.
+# Pre: (optional) ranges, a list of anything with get_range()
+#      (optional) bed_file to read chromosome, start and end from
+#      (optional) chr_names, chrs, starts and ends as the columns
+class GenomicRangeSet:
+  def __init__(self,ranges=None,bed_file=None,chr_names=None,chrs=None,starts=None,ends=None):
+    self.chr_names = []
+    self.chrs = np.zeros(0,dtype=np.int64)
+    self.starts = np.zeros(0,dtype=np.int64)
+    self.ends = np.zeros(0,dtype=np.int64)
+    if ranges is not None:
+      rngs = [x.get_range() for x in ranges]
+      self._set_columns([x.chr for x in rngs],[x.start-1 for x in rngs],[x.end for x in rngs])
+    elif bed_file:
+      names = []
+      starts = []
+      ends = []
+      with open(bed_file) as inf:
+        for line in inf:
+          if re.match('(track|browser|#)',line): continue
+          f = line.rstrip("\n").split("\t")
+          if len(f) < 3: continue
+          names.append(f[0])
+          starts.append(int(f[1]))
+          ends.append(int(f[2]))
+      self._set_columns(names,starts,ends)
+    elif chr_names is not None:
+      self.chr_names = list(chr_names)
+      self.chrs = np.asarray(chrs,dtype=np.int64)
+      self.starts = np.asarray(starts,dtype=np.int64)
+      self.ends = np.asarray(ends,dtype=np.int64)
+
+  def _set_columns(self,names,starts,ends):
+    self.chr_names = sorted(set(names))
+    codes = {}
+    for i in range(0,len(self.chr_names)): codes[self.chr_names[i]] = i
+    self.chrs = np.array([codes[x] for x in names],dtype=np.int64)
+    self.starts = np.array(starts,dtype=np.int64)
+    self.ends = np.array(ends,dtype=np.int64)
+
+  def __len__(self):
+    return len(self.starts)
+
+  def copy(self):
+    return GenomicRangeSet(chr_names=self.chr_names,chrs=self.chrs.copy(),starts=self.starts.copy(),ends=self.ends.copy())
+
+  # Post: list of GenomicRange, 1-indexed like the rest of Bio.Range
+  def to_ranges(self):
+    names = self.chr_names
+    return [GenomicRange(names[c],s+1,e) for c,s,e in zip(self.chrs.tolist(),self.starts.tolist(),self.ends.tolist())]
+
+  # Post: writes chromosome, start and end lines
+  def write_bed(self,of):
+    names = self.chr_names
+    for c,s,e in zip(self.chrs.tolist(),self.starts.tolist(),self.ends.tolist()):
+      of.write(names[c]+"\t"+str(s)+"\t"+str(e)+"\n")
+
+  # Post: number of bases covered, counting overlaps more than once
+  def base_count(self):
+    return int(np.sum(self.ends-self.starts))
+
+  # Post: sorted by chromosome name, start then end
+  def sort(self):
+    order = np.lexsort((self.ends,self.starts,self.chrs))
+    return GenomicRangeSet(chr_names=self.chr_names,chrs=self.chrs[order],starts=self.starts[order],ends=self.ends[order])
+
+  # Post: sorted set with overlapping and adjacent ranges joined,
+  #       like merge_ranges
+  def merge(self):
+    if len(self) == 0: return self.copy()
+    [s,e] = self._linear()
+    order = np.argsort(s,kind='mergesort')
+    s = s[order]
+    e = np.maximum.accumulate(e[order])
+    # a new range begins wherever a start is past every end before it
+    first = np.ones(len(s),dtype=bool)
+    first[1:] = s[1:] > e[:-1]
+    last = np.ones(len(s),dtype=bool)
+    last[:-1] = first[1:]
+    return self._from_linear(self.chr_names,s[first],e[last])
+
+  # Pre: padding in bases
+  #      (optional) chr_lengths dict of chromosome lengths to stop at
+  # Post: each range widened by padding on both sides, not merged
+  def pad(self,padding,chr_lengths=None):
+    starts = np.maximum(self.starts-padding,0)
+    ends = self.ends+padding
+    if chr_lengths:
+      lengths = np.array([chr_lengths.get(x,np.iinfo(np.int64).max) for x in self.chr_names],dtype=np.int64)
+      if len(self): ends = np.minimum(ends,lengths[self.chrs])
+    return GenomicRangeSet(chr_names=self.chr_names,chrs=self.chrs.copy(),starts=starts,ends=ends)
+
+  # Pre: chr_lengths dict of chromosome lengths
+  # Post: merged set of the bases of those chromosomes not in this set
+  def complement(self,chr_lengths):
+    names = sorted(chr_lengths.keys())
+    genome = GenomicRangeSet(chr_names=names,chrs=range(0,len(names)),starts=[0]*len(names),ends=[chr_lengths[x] for x in names])
+    return genome.subtract(self)
+
+  # Post: merged set of the bases in either set
+  def union(self,other):
+    [a,b,names] = self._align(other)
+    return GenomicRangeSet(chr_names=names,chrs=np.concatenate([a.chrs,b.chrs]),starts=np.concatenate([a.starts,b.starts]),ends=np.concatenate([a.ends,b.ends])).merge()
+
+  # Post: merged set of the bases in both sets
+  def intersect(self,other):
+    return self._combine(other,3)
+
+  # Post: merged set of the bases in this set and not the other,
+  #       like subtract_ranges
+  def subtract(self,other):
+    return self._combine(other,1)
+
+  # Post: [set of non-overlapping ranges, numpy array of the depth of each]
+  #       a bedGraph of how many ranges cover each base
+  def coverage(self):
+    [s,e] = self._linear()
+    [pos,depth] = _sweep(np.concatenate([s,e]),np.concatenate([np.ones(len(s),dtype=np.int64),-np.ones(len(e),dtype=np.int64)]))
+    keep = depth[:-1] > 0
+    out = self._from_linear(self.chr_names,pos[:-1][keep],pos[1:][keep])
+    return [out,depth[:-1][keep]]
+
+  # Pre: (optional) threads to share the chromosomes out across
+  # Post: Coverage of how many ranges cover each base
+  def get_coverage(self,threads=1):
+    if threads <= 1 or len(self.chr_names) <= 1:
+      [rngs,depths] = self.coverage()
+      return Coverage(rngs.chr_names,rngs.chrs,rngs.starts,rngs.ends,depths)
+    order = np.argsort(self.chrs,kind='mergesort')
+    chrs = self.chrs[order]
+    bounds = np.searchsorted(chrs,np.arange(0,len(self.chr_names)+1))
+    jobs = [[self.starts[order[bounds[i]:bounds[i+1]]],self.ends[order[bounds[i]:bounds[i+1]]]] for i in range(0,len(self.chr_names))]
+    from multiprocessing import Pool
+    p = Pool(processes=threads)
+    outputs = p.map(_chr_coverage,jobs)
+    p.close()
+    p.join()
+    chrs = np.concatenate([np.zeros(len(outputs[i][0]),dtype=np.int64)+i for i in range(0,len(outputs))])
+    [starts,ends,depths] = [np.concatenate([x[k] for x in outputs]) for k in range(0,3)]
+    return Coverage(self.chr_names,chrs,starts,ends,depths)
+
+  # Bases covered by self count 1 and by other count 2, so after a sweep
+  # 1 is only in self, 2 only in other and 3 in both
+  def _combine(self,other,value):
+    [a,b,names] = self._align(other)
+    a = a.merge()
+    b = b.merge()
+    [sa,ea] = a._linear()
+    [sb,eb] = b._linear()
+    pos = np.concatenate([sa,ea,sb,eb])
+    delta = np.concatenate([np.ones(len(sa),dtype=np.int64),-np.ones(len(ea),dtype=np.int64),
+                            2*np.ones(len(sb),dtype=np.int64),-2*np.ones(len(eb),dtype=np.int64)])
+    [pos,depth] = _sweep(pos,delta)
+    keep = depth[:-1] == value
+    return self._from_linear(names,pos[:-1][keep],pos[1:][keep])
+
+  # Post: [self, other, names] with both sets coded by the same names
+  def _align(self,other):
+    if self.chr_names == other.chr_names: return [self,other,self.chr_names]
+    names = sorted(set(self.chr_names) | set(other.chr_names))
+    codes = {}
+    for i in range(0,len(names)): codes[names[i]] = i
+    out = []
+    for x in [self,other]:
+      recode = np.array([codes[n] for n in x.chr_names]+[0],dtype=np.int64)
+      out.append(GenomicRangeSet(chr_names=names,chrs=recode[x.chrs],starts=x.starts,ends=x.ends))
+    return out+[names]
+
+  # Post: [starts, ends] as positions on one line through every chromosome
+  def _linear(self):
+    offsets = self.chrs << _shift
+    return [offsets+self.starts,offsets+self.ends]
+
+  def _from_linear(self,names,s,e):
+    return GenomicRangeSet(chr_names=names,chrs=s >> _shift,starts=s & _mask,ends=e-((s >> _shift) << _shift))
+
+# room for any chromosome length, and over eight million chromosomes
+_shift = 40
+_mask = (1 << _shift)-1
+
+# Pre: positions and the change in depth at each
+# Post: [sorted positions where the depth changes, depth from each
+#       position to the next]
+def _sweep(pos,delta):
+  if len(pos) == 0: return [np.zeros(0,dtype=np.int64),np.zeros(0,dtype=np.int64)]
+  [upos,inverse] = np.unique(pos,return_inverse=True)
+  depth = np.cumsum(np.bincount(inverse,weights=delta,minlength=len(upos))).astype(np.int64)
+  keep = np.ones(len(upos),dtype=bool)
+  keep[1:] = depth[1:] != depth[:-1]
+  return [upos[keep],depth[keep]]
+
+# Pre: [starts, ends] of the ranges on one chromosome
+# Post: [starts, ends, depths] of each stretch of constant non-zero depth
+def _chr_coverage(job):
+  [starts,ends] = job
+  [pos,depth] = _sweep(np.concatenate([starts,ends]),np.concatenate([np.ones(len(starts),dtype=np.int64),-np.ones(len(ends),dtype=np.int64)]))
+  keep = depth[:-1] > 0
+  return [pos[:-1][keep],pos[1:][keep],depth[:-1][keep]]
+
+# A bedGraph held as columns, stretches of constant non-zero depth
+# sorted by chromosome and start, with bed style coordinates
+class Coverage:
+  def __init__(self,chr_names,chrs,starts,ends,depths):
+    self.chr_names = list(chr_names)
+    self.chrs = np.asarray(chrs,dtype=np.int64)
+    self.starts = np.asarray(starts,dtype=np.int64)
+    self.ends = np.asarray(ends,dtype=np.int64)
+    self.depths = np.asarray(depths,dtype=np.int64)
+    self._sums = {} # cumulative sums for summarize, by minimum depth
+
+  def __len__(self):
+    return len(self.starts)
+
+  # Post: list of GenomicRange with the depth as the payload,
+  #       the same as ranges_to_coverage
+  def to_ranges(self):
+    out = []
+    names = self.chr_names
+    for c,s,e,d in zip(self.chrs.tolist(),self.starts.tolist(),self.ends.tolist(),self.depths.tolist()):
+      rng = GenomicRange(names[c],s+1,e)
+      rng.set_payload(d)
+      out.append(rng)
+    return out
+
+  def write_bedgraph(self,of):
+    names = self.chr_names
+    for c,s,e,d in zip(self.chrs.tolist(),self.starts.tolist(),self.ends.tolist(),self.depths.tolist()):
+      of.write(names[c]+"\t"+str(s)+"\t"+str(e)+"\t"+str(d)+"\n")
+
+  # Pre: list of anything with get_range()
+  #      (optional) mindepth for counting bases covered
+  # Post: [total depth summed over the bases, mean depth,
+  #        bases covered at mindepth or more] as arrays, one per range
+  #       Each range costs two binary searches of the bedGraph
+  def summarize(self,ranges,mindepth=1):
+    codes = {}
+    for i in range(0,len(self.chr_names)): codes[self.chr_names[i]] = i
+    rngs = [x.get_range() for x in ranges]
+    chrs = np.array([codes.get(x.chr,-1) for x in rngs],dtype=np.int64)
+    qs = np.array([x.start-1 for x in rngs],dtype=np.int64)
+    qe = np.array([x.end for x in rngs],dtype=np.int64)
+    lengths = qe-qs
+    found = chrs >= 0
+    qs = (np.maximum(chrs,0) << _shift)+qs
+    qe = (np.maximum(chrs,0) << _shift)+qe
+    if mindepth not in self._sums:
+      self._sums[mindepth] = self._cumulative(mindepth)
+    [s,l,cum_depth,cum_bases] = self._sums[mindepth]
+    totals = (self._integrate(qe,s,l,cum_depth,self.depths)-self._integrate(qs,s,l,cum_depth,self.depths))*found
+    covered = (self._integrate(qe,s,l,cum_bases,self.depths >= mindepth)-self._integrate(qs,s,l,cum_bases,self.depths >= mindepth))*found
+    means = totals/np.maximum(lengths,1).astype(float)
+    return [totals,means,covered]
+
+  # Post: [linear starts, lengths, depth and covered bases summed over
+  #       every stretch before each one]
+  def _cumulative(self,mindepth):
+    s = (self.chrs << _shift)+self.starts
+    l = self.ends-self.starts
+    cum_depth = np.concatenate([[0],np.cumsum(self.depths*l)]).astype(np.int64)
+    cum_bases = np.concatenate([[0],np.cumsum((self.depths >= mindepth)*l)]).astype(np.int64)
+    return [s,l,cum_depth,cum_bases]
+
+  # Post: the value summed from the start of the line up to each position
+  def _integrate(self,pos,s,l,cum,values):
+    if len(s) == 0: return np.zeros(len(pos),dtype=np.int64)
+    i = np.searchsorted(s,pos,side='right')-1
+    j = np.maximum(i,0)
+    part = np.clip(pos-s[j],0,l[j])
+    return np.where(i >= 0,cum[j]+values[j].astype(np.int64)*part,0)
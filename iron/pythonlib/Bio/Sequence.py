@@ -37,9 +37,10 @@ class Seq:
   def n_count(self):
     return self.seq.translate(maketrans('Nn','NN')).count('N')
 
+complement_table = maketrans('ACTGUNXactgunx','TGACANXtgacanx')
+
 def rc(seq):
-  complement = maketrans('ACTGUNXactgunx','TGACANXtgacanx')
-  return seq.translate(complement)[::-1]
+  return seq.translate(complement_table)[::-1]
 
 
 def encode_name(conversion_string):
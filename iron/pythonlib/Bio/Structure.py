@@ -1,5 +1,5 @@
 import sys, random, string, uuid, pickle, zlib, base64
-from Bio.Range import GenomicRange, ranges_to_coverage, merge_ranges
+from Bio.Range import GenomicRange, merge_ranges
 from Bio.Sequence import rc
 import Bio.Graph
 
@@ -248,15 +248,21 @@ class Transcript:
     return self._sequence
 
   def set_sequence(self,ref_dict):
+    self._initialize()
+    chr = self.get_chrom()
+    if hasattr(ref_dict,'get_sequences'):
+      self._set_exon_sequences(ref_dict.get_sequences([x.get_range() for x in self.exons]))
+    else:
+      self._set_exon_sequences([ref_dict[chr][e.start-1:e.end] for e in [x.get_range() for x in self.exons]])
+
+  # Pre: the reference sequence of each exon in order, positive strand
+  def _set_exon_sequences(self,exon_sequences):
     self._initialize()
     strand = '+'
     if not self._direction:
       sys.stderr.write("WARNING: no strand information for the transcript\n")
     if self._direction: strand = self._direction
-    chr = self.get_chrom()
-    seq = ''
-    for e in [x.get_range() for x in self.exons]:
-      seq += ref_dict[chr][e.start-1:e.end]
+    seq = ''.join(exon_sequences)
     if strand == '-':  seq = rc(seq)
     self._sequence = seq.upper()
 
@@ -666,32 +672,27 @@ class TranscriptLoci:
   def set_merge_rules(self,mr):  self.merge_rules = mr
 
   # using all the transcripts find the depth 
+  # every exon is looked up at once in one bedGraph of the loci
   def get_depth_per_transcript(self,mindepth=1):
+    from Bio.RangeSet import GenomicRangeSet
+    txs = self.get_transcripts()
     bedarray = []
-    for tx in self.get_transcripts():
+    for tx in txs:
       for ex in [x.rng for x in tx.exons]: bedarray.append(ex)
-    cov = ranges_to_coverage(bedarray)
+    cov = GenomicRangeSet(bedarray).get_coverage()
+    [totals,means,covered] = cov.summarize(bedarray,mindepth=mindepth)
     results = {}
-    for tx in self.get_transcripts():
+    pos = 0
+    for tx in txs:
       tlen = tx.get_length()
-      bcov = []
-      for ex in [x.rng for x in tx.exons]:     
-        excov = [[x.overlap_size(ex),x.get_payload()] for x in cov]
-        for coved in [x for x in excov if x[0] > 0]:
-          bcov.append(coved)
-      total_base_coverage = sum([x[0]*x[1] for x in bcov])
+      n = len(tx.exons)
+      total_base_coverage = int(totals[pos:pos+n].sum())
+      minimum_bases_covered = int(covered[pos:pos+n].sum())
+      pos += n
       average_coverage = float(total_base_coverage)/float(tlen)
-      minimum_bases_covered = sum([x[0] for x in bcov if x[1] >= mindepth])
       fraction_covered_at_minimum = float(minimum_bases_covered)/float(tlen)
       res = {'tx':tx,'average_coverage':average_coverage,'fraction_covered':fraction_covered_at_minimum,'mindepth':mindepth,'length_covered':minimum_bases_covered}
       results[tx.get_id()] = res
-      #print average_coverage
-      #print fraction_covered_at_minimum
-      #print tlen
-      #tcov = float(bcov)/float(tlen)
-      #print tcov
-    #for c in cov:
-    #  print c
     return results
 
   def get_range(self):
@@ -1019,7 +1020,16 @@ class Transcriptome:
       with open(gpd_file) as inf:
         for line in inf:
           self.transcripts.append(GPD(line))
-    if ref_fasta:
+    if ref_fasta and hasattr(ref_fasta,'get_sequences'):
+      # one batched fetch of every exon rather than reads per transcript
+      ranges = []
+      for tx in self.transcripts: ranges += [x.get_range() for x in tx.exons]
+      seqs = ref_fasta.get_sequences(ranges)
+      pos = 0
+      for tx in self.transcripts:
+        tx._set_exon_sequences(seqs[pos:pos+len(tx.exons)])
+        pos += len(tx.exons)
+    elif ref_fasta:
       for i in range(0,len(self.transcripts)):
         self.transcripts[i].get_sequence(ref_fasta)
   def dump_serialized(self):
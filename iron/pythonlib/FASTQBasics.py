@@ -149,12 +149,11 @@ class QualityFormatDetector:
 
   # can be called many times instead of reading a file
   def record_observation(self,line):
-    chars = list(line)
-    for c in chars: 
+    for c in set(line): 
       deci = ord(c)
       if deci not in self.observed_qualities:
         self.observed_qualities[deci] = 0
-      self.observed_qualities[deci] += 1
+      self.observed_qualities[deci] += line.count(c)
 
 # A class to help describe what how qualites are distributed in reads
 class QualityProfile:
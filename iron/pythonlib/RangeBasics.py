@@ -1,10 +1,12 @@
 import sys, re
+from Bio.Range import RangeIndex
 # These classes are to help deal with genomic coordinates and 
 # this associated with those coordinates.
 
 class GenomicRangeDictionary:
   def __init__(self):
     self.members = []
+    self._index = None # overlap index of the members, built when first queried
 
   def length(self):
     return len(self.members)
@@ -17,22 +19,24 @@ class GenomicRangeDictionary:
 
   def add(self,genomic_range):
     self.members.append(genomic_range)
+    self._index = None
 
   # access based on key
   def get_overlapped(self,genomic_range):
     r = GenomicRangeDictionary()
-    for m in self.members:
-      if m.overlaps(genomic_range):
-        r.add(m)
+    for i in self._get_overlapped_ids(genomic_range):
+      r.add(self.members[i])
     return r
 
   def remove_overlapped(self,genomic_range):
-    r = GenomicRangeDictionary()
-    newmembers = []
-    for m in self.members:
-      if not m.overlaps(genomic_range):
-        newmembers.append(m)
-    self.members = newmembers
+    remove = set(self._get_overlapped_ids(genomic_range))
+    self.members = [self.members[i] for i in range(0,len(self.members)) if i not in remove]
+    self._index = None
+
+  # Post: positions of the overlapping members in the order they were added
+  def _get_overlapped_ids(self,genomic_range):
+    if not self._index: self._index = RangeIndex(self.members)
+    return sorted(self._index.query_ids(genomic_range))
 
 #These are 1-index for both start and end
 class GenomicRange:
@@ -51,6 +55,9 @@ class GenomicRange:
     self.direction = dir
     self.payload = [] # should be a reference since its an array
 
+  def get_range(self):
+    return self
+
   # Copy with the exception of payload.  Thats still a link
   def copy(self):
     n = GenomicRange(self.chr,self.start,self.end,self.direction)
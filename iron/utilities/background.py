@@ -1,7 +1,8 @@
 #!/usr/bin/python
 import argparse, sys
 from GenePredBasics import GenePredEntry
-from RangeBasics import Bed, sort_ranges, merge_ranges, pad_ranges, subtract_ranges
+from RangeBasics import Bed
+from Bio.RangeSet import GenomicRangeSet
 from subprocess import Popen, PIPE
 from PoissonBasics import probability_threshold
 
@@ -36,26 +37,20 @@ def main():
         erng = Bed(g.value('chrom'),g.value('exonStarts')[i],g.value('exonEnds')[i])
         exon_beds.append(erng)
   avglen = float(asum)/float(atot)
-  sys.stderr.write("Sorting gene bed\n")
-  gene_beds = sort_ranges(gene_beds)
-  gene_beds = merge_ranges(gene_beds,already_sorted=True)
-  sys.stderr.write("Sorting chromosome beds\n")
-  chr_beds = sort_ranges([chr_beds[x] for x in chr_beds.keys()])
-  sys.stderr.write("Sorting exon beds\n")
-  exon_beds = sort_ranges(exon_beds)
+  sys.stderr.write("Merging gene bed\n")
+  gene_set = GenomicRangeSet(gene_beds).merge()
+  chr_set = GenomicRangeSet([chr_beds[x] for x in chr_beds.keys()])
   sys.stderr.write("Get padded genes\n")
-  padded_gene_beds = pad_ranges(gene_beds,args.intergenic_buffer,chr_beds)
-  padded_gene_beds = merge_ranges(padded_gene_beds,already_sorted=True)
+  padded_gene_set = gene_set.pad(args.intergenic_buffer).intersect(chr_set)
   sys.stderr.write("Get intergenic regions\n")
-  intergenic_beds = subtract_ranges(chr_beds,padded_gene_beds,already_sorted=True)
-  intergenic_beds = merge_ranges(intergenic_beds,already_sorted=True)
+  intergenic_beds = chr_set.subtract(padded_gene_set).to_ranges()
   intergenic_beds = window_break(intergenic_beds,args.window_size)
   #for i in intergenic_beds: print i.get_range_string()
   sys.stderr.write("Get merged exons\n")
-  exon_beds = merge_ranges(exon_beds)
+  exon_set = GenomicRangeSet(exon_beds).merge()
+  exon_beds = exon_set.to_ranges()
   sys.stderr.write("Get introns\n")
-  intron_beds = subtract_ranges(gene_beds,exon_beds,already_sorted=True)  
-  intron_beds = merge_ranges(intron_beds,already_sorted=True)
+  intron_beds = gene_set.subtract(exon_set).to_ranges()
   intron_beds = window_break(intron_beds,args.window_size)
   sys.stderr.write("Going through short reads\n")
   cmd = "sam_to_bed_depth.py "+args.bam_input
@@ -0,0 +1,164 @@
+#!/usr/bin/python
+import argparse, sys, os, struct, random, time
+from shutil import rmtree
+from tempfile import mkdtemp, gettempdir
+from cStringIO import StringIO
+from Bio.Format.BGZF import writer as BGZF_writer
+from Bio.Format.Sam import BAMFile, _parse_bam_data_block
+
+# Report how many records per second we can read from a synthetic BAM.
+# 'before' reads each record the way BAMFile used to, concatenating the
+# block strings and parsing through a StringIO.  'after' reads with
+# read_buffer and parses straight out of the decompressed block.
+# 'BAMFile' is a full iteration that also builds each BAM object.
+
+def main():
+  args = do_inputs()
+  path = args.tempdir+'/synthetic.bam'
+  if args.input: path = args.input
+  else:
+    sys.stderr.write("writing "+str(args.records)+" synthetic records\n")
+    make_synthetic_bam(path,args.records,args.read_length)
+  for name, func in [['before',read_before],['after',read_after],['BAMFile',read_bamfile]]:
+    best = None
+    for i in range(0,args.repeats):
+      st = time.time()
+      cnt = func(path,args.threads)
+      el = time.time()-st
+      if best is None or el < best: best = el
+    print name+"\t"+str(cnt)+" records\t"+str(round(best,3))+" sec\t"+str(int(cnt/best))+" records/sec"
+  if not args.specific_tempdir:
+    rmtree(args.tempdir)
+
+def read_bamfile(path,threads):
+  bf = BAMFile(path,threads=threads)
+  cnt = 0
+  for e in bf:
+    cnt += 1
+  bf.close()
+  return cnt
+
+def read_after(path,threads):
+  bf = BAMFile(path,threads=threads)
+  fh = bf.fh
+  cnt = 0
+  while True:
+    [b,bs,be] = fh.read_buffer(4)
+    if be-bs < 4: break
+    block_size = struct.unpack_from('<i',b,bs)[0]
+    [data,ds,de] = fh.read_buffer(block_size)
+    _parse_bam_data_block(data,bf.ref_names,ds,de)
+    cnt += 1
+  bf.close()
+  return cnt
+
+def read_before(path,threads):
+  bf = BAMFile(path,threads=threads)
+  fh = bf.fh
+  cnt = 0
+  while True:
+    b = _concatenating_read(fh,4)
+    if not b: break
+    block_size = struct.unpack('<i',b)[0]
+    _stringio_parse(_concatenating_read(fh,block_size),bf.ref_names)
+    cnt += 1
+  bf.close()
+  return cnt
+
+# The original BGZF.read, extending a string every time it crosses a block
+def _concatenating_read(fh,size):
+  done = 0
+  v = ''
+  while True:
+    if size-done < len(fh._buffer['data']) - fh._buffer_pos:
+      v += fh._buffer['data'][fh._buffer_pos:fh._buffer_pos+(size-done)]
+      fh._buffer_pos += (size-done)
+      return v
+    else:
+      vpart = fh._buffer['data'][fh._buffer_pos:]
+      fh._buffer = fh._load_block()
+      v += vpart
+      fh._buffer_pos = 0
+      if len(fh._buffer['data'])==0: return v
+      done += len(vpart)
+
+# The original fixed field parse, one struct.unpack per field
+def _stringio_parse(bin_in,ref_names):
+  v = {}
+  data = StringIO(bin_in)
+  v['rname'] = ref_names[struct.unpack('<i',data.read(4))[0]]
+  v['pos'] = struct.unpack('<i',data.read(4))[0] + 1
+  bin_mq_nl = struct.unpack('<I',data.read(4))[0]
+  v['mapq'] = (bin_mq_nl & 0xFF00) >> 8
+  l_read_name = bin_mq_nl & 0xFF
+  flag_nc = struct.unpack('<I',data.read(4))[0]
+  v['flag'] = flag_nc >> 16
+  n_cigar_op = flag_nc & 0xFFFF
+  l_seq = struct.unpack('<i',data.read(4))[0]
+  rnext_num = struct.unpack('<i',data.read(4))[0]
+  if rnext_num == -1: v['rnext'] = '*'
+  else: v['rnext'] = ref_names[rnext_num]
+  v['pnext'] = struct.unpack('<i',data.read(4))[0]+1
+  v['tlen'] = struct.unpack('<i',data.read(4))[0]
+  v['qname'] = data.read(l_read_name).rstrip('\0')
+  v['cigar_bytes'] = data.read(n_cigar_op*4)
+  v['seq_bytes'] = data.read((l_seq+1)/2)
+  v['qual_bytes'] = data.read(l_seq)
+  v['extra_bytes'] = data.read()
+  return v
+
+def make_synthetic_bam(path,count,read_length):
+  random.seed(1)
+  of = open(path,'wb')
+  bw = BGZF_writer(of)
+  header = "@HD\tVN:1.4\tSO:coordinate\n@SQ\tSN:chr1\tLN:100000000\n"
+  bw.write('BAM\1'+struct.pack('<i',len(header))+header+struct.pack('<i',1))
+  bw.write(struct.pack('<i',5)+"chr1\0"+struct.pack('<i',100000000))
+  pos = 0
+  for i in range(0,count):
+    pos += random.randint(0,100)
+    name = 'read'+str(i)+"\0"
+    cigar = struct.pack('<III',(read_length/2)<<4,(random.randint(100,5000)<<4)|3,(read_length-read_length/2)<<4)
+    seq = ''.join([chr(random.choice([0x11,0x24,0x48,0x81,0x14,0x42])) for x in range(0,(read_length+1)/2)])
+    qual = ''.join([chr(random.randint(2,40)) for x in range(0,read_length)])
+    tags = 'NMC'+chr(random.randint(0,10))+'RGZgroup1'+"\0"
+    data = struct.pack('<iiIIiiii',0,pos,(4680<<16)|(60<<8)|len(name),(0<<16)|3,read_length,-1,-1,0)
+    data += name+cigar+seq+qual+tags
+    bw.write(struct.pack('<i',len(data))+data)
+  bw.close()
+  of.close()
+
+def do_inputs():
+  parser = argparse.ArgumentParser(description="Benchmark reading records from a bam file",formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  parser.add_argument('--input',help="Use this BAM rather than a synthetic one")
+  parser.add_argument('--records',type=int,default=200000,help="number of synthetic records")
+  parser.add_argument('--read_length',type=int,default=150,help="length of synthetic reads")
+  parser.add_argument('--repeats',type=int,default=3,help="report the best of this many runs")
+  parser.add_argument('--threads',type=int,default=1,help="threads to decompress with")
+  group = parser.add_mutually_exclusive_group()
+  group.add_argument('--tempdir',default=gettempdir(),help="The temporary directory is made and destroyed here.")
+  group.add_argument('--specific_tempdir',help="This temporary directory will be used, but will remain after executing.")
+  args = parser.parse_args()
+  setup_tempdir(args)
+  return args
+
+def setup_tempdir(args):
+  if args.specific_tempdir:
+    if not os.path.exists(args.specific_tempdir):
+      os.makedirs(args.specific_tempdir.rstrip('/'))
+    args.tempdir = args.specific_tempdir.rstrip('/')
+    if not os.path.exists(args.specific_tempdir.rstrip('/')):
+      sys.stderr.write("ERROR: Problem creating temporary directory\n")
+      sys.exit()
+  else:
+    args.tempdir = mkdtemp(prefix="weirathe.",dir=args.tempdir.rstrip('/'))
+    if not os.path.exists(args.tempdir.rstrip('/')):
+      sys.stderr.write("ERROR: Problem creating temporary directory\n")
+      sys.exit()
+  if not os.path.exists(args.tempdir):
+    sys.stderr.write("ERROR: Problem creating temporary directory\n")
+    sys.exit()
+  return
+
+if __name__=="__main__":
+  main()
@@ -2,7 +2,7 @@
 import sys, argparse, tempfile, os, StringIO, gzip
 from subprocess import PIPE, Popen
 from multiprocessing import Pool, cpu_count
-from Bio.Format.Sam import BAMFile, SAM
+from Bio.Format.Sam import BAMFile
 
 ps = None
 
@@ -66,19 +66,18 @@ def do_output(res):
   inf.close()
 
 def do_seq(seq,args,fname):
-  cmd = 'samtools view '+args.input+' '+seq
-  p = Popen(cmd.split(),stdout=PIPE)
+  bf = BAMFile(args.input)
   cmd = 'bedtools genomecov -i - -bg -g '+fname
   po2 = Popen(cmd.split(),stdin=PIPE,stdout=PIPE)
   cmd = 'sort -k 1,1 -k2,2n -k3,3n -S1G --parallel='+str(args.threads)
   if args.tempdir: cmd += ' -T '+args.tempdir
   po1 = Popen(cmd.split(),stdin=PIPE,stdout=po2.stdin)
-  for line in p.stdout:
-    sam = SAM(line)
+  for sam in bf.fetch(seq):
     if not sam.is_aligned(): continue
     for ex in sam.get_target_transcript(min_intron=68).exons:
       bed = "\t".join([str(x) for x in ex.get_range().get_bed_array()])
       po1.stdin.write(bed+"\n")
+  bf.close()
   po1.communicate()
   res = po2.communicate()[0]
   return res
@@ -1,22 +1,14 @@
 #!/usr/bin/python
 import sys, argparse, gzip, os.path
-#from Bio.Format.Sam import BAMFile
-from subprocess import Popen, PIPE
+from Bio.Format.Sam import BAMFile, BAMWriter
 
 def main():
   parser = argparse.ArgumentParser(description="Get the best alignments from an indexed bam file",formatter_class=argparse.ArgumentDefaultsHelpFormatter)
   parser.add_argument('input',help="Use bgi (our indexing) BAM file input")
   parser.add_argument('-o','--output',help="The output file or SAM STDOUT if unset")
+  parser.add_argument('--threads',type=int,default=1,help="threads for decompressing and compressing")
   args = parser.parse_args()
 
-  if args.output:
-    cmd = 'samtools view -Sb -'
-    of2 = open(args.output,'w')
-    p = Popen(cmd.split(),stdin=PIPE,stdout=of2)
-    of = p.stdin
-  else:
-    of = sys.stdout
-
   sys.stderr.write("Checking index...\n")
   if not os.path.isfile(args.input+'.bgi'):
     sys.stderr.write("ERROR: bgi index (our format) needs to be set\n")
@@ -34,33 +26,30 @@ def main():
     bestlines.append(z)
 
   inf.close()
-  #bf = BAMFile(args.input)
-  cmd = 'samtools view -H '+args.input
-  pin = Popen(cmd.split(),stdout=of)
-  pin.communicate()
+  bf = BAMFile(args.input,threads=args.threads,compact=True)
+  w = None
+  of = None
+  if args.output:
+    w = BAMWriter(args.output,bf.header_text,bf.ref_names,bf.ref_lengths,threads=args.threads)
+  else:
+    of = sys.stdout
+    if bf.header_text: of.write(bf.header_text.rstrip("\n")+"\n")
   sys.stderr.write("Traversing bam file...\n")
   k=0
-  #tot = bf.index.get_length()
-  #of.write(bf.header_text)
-  cmd = 'samtools view '+args.input
-  pin = Popen(cmd.split(),stdout=PIPE)
   bestiter = 0
   total = len(bestlines)
-  for line in pin.stdout:
+  for e in bf:
     k+=1
     if k%1000==0:sys.stderr.write(str(k)+'/'+str(z)+"\r")
-    if bestiter >= total: continue
+    if bestiter >= total: break
     if k != bestlines[bestiter]:
       continue
     bestiter+=1
-    of.write(line)
-  pin.communicate()
+    if w: w.write_entry(e)
+    else: of.write(e.get_bam().get_line()+"\n")
+  bf.close()
   sys.stderr.write("\n")
-  if args.output:
-    p.communicate()
-    of2.close()
-  else:
-    of.close()
-  pin.stdout.close()
+  if w: w.close()
+  else: of.close()
 if __name__=="__main__":
   main()
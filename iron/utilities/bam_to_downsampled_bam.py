@@ -5,6 +5,7 @@ from multiprocessing import cpu_count
 from tempfile import mkdtemp, gettempdir
 from subprocess import PIPE, Popen
 from uuid import uuid4
+from Bio.Format.Sam import BAMFile, BAMWriter
 
 def main():
   #do our inputs
@@ -13,11 +14,8 @@ def main():
   id = uuid4().hex[:6]
 
   sys.stderr.write("Traversing bam to discover names\n")
-  cmd = 'samtools view '+args.bam_input
-  if args.aligned: cmd += ' -F 4'
+  bf = BAMFile(args.bam_input,threads=args.threads,compact=True)
   names = []
-  p = Popen(cmd.split(),stdout=PIPE)
-  prog = re.compile('^([^\t]+)')
   z = 0
   tof = open(args.tempdir+'/nlist.txt.gz','w')
   cmd1 = 'sort -S'+str(args.mem)+'G -R -k1,1 --parallel='+str(args.threads)+' -T '+args.tempdir
@@ -25,16 +23,16 @@ def main():
   sys.stderr.write(cmd1+"\n")
   po2 = Popen(cmd2.split(),stdout=tof,stdin=PIPE)
   po1 = Popen(cmd1.split(),stdout=po2.stdin,stdin=PIPE)
-  for line in p.stdout:
+  for e in bf:
+    if args.aligned and not e.is_aligned(): continue
     z += 1
     if z%10000==0: sys.stderr.write("traversed "+str(z)+"   \r")
-    m = prog.match(line)
-    po1.stdin.write(m.group(1)+"\t"+str(z)+"\n")
+    po1.stdin.write(e.value('qname')+"\t"+str(z)+"\n")
     #names.append([m.group(1),z])
   sys.stderr.write("\n")
   po1.communicate()
   po2.communicate()
-  p.communicate()
+  bf.close()
   tof.close()
   ## Now we can get a set of names
   sys.stderr.write("Traversing numbers to select\n")
@@ -59,35 +57,33 @@ def main():
   p1.communicate()
   p2.communicate()
   tof.close()
-  of = sys.stdout
+  bf = BAMFile(args.bam_input,threads=args.threads,compact=True)
+  w = None
+  of = None
   if args.output:
-    of = open(args.output+'.'+str(cnt-1)+'.'+id+'.bam','w')
-    cmd = "samtools view -Sb -"
-  else: cmd = 'cat'
-  p0 = Popen(cmd.split(),stdout=of,stdin=PIPE,close_fds=True)
-  cmd = "samtools view -H "+args.bam_input
-  p1 = Popen(cmd.split(),stdout=p0.stdin)
-  p1.communicate()
-  cmd = 'samtools view '+args.bam_input
-  if args.aligned: cmd += ' -F 4'
-  p = Popen(cmd.split(),stdout=PIPE)
+    w = BAMWriter(args.output+'.'+str(cnt-1)+'.'+id+'.bam',bf.header_text,bf.ref_names,bf.ref_lengths,threads=args.threads)
+  else:
+    of = sys.stdout
+    if bf.header_text: of.write(bf.header_text.rstrip("\n")+"\n")
   z = 0
   inf = gzip.open(args.tempdir+'/nlist2.txt.gz')
   curr = inf.readline()
   if curr: curr = int(curr.rstrip())
-  for line in p.stdout:
-    if not curr: continue
+  for e in bf:
+    if not curr: break
+    if args.aligned and not e.is_aligned(): continue
     z += 1
     if z%10000==0: sys.stderr.write("Final traversal of "+str(z)+" alignments    \r")
     if curr == z:
-      p0.stdin.write(line) # write to the p0 pipe
+      if w: w.write_entry(e)
+      else: of.write(e.get_bam().get_line()+"\n")
       curr = inf.readline()
       if curr: curr = int(curr.rstrip())
   inf.close()
-  p.communicate()
+  bf.close()
   sys.stderr.write("\n")
-  p0.communicate()  
-  of.close()
+  if w: w.close()
+  else: of.close()
 
 
   # Temporary working directory step 3 of 3 - Cleanup
@@ -1,6 +1,6 @@
 #!/usr/bin/python
 import sys, argparse, gzip
-from Bio.Format.Fasta import FastaData
+from Bio.Format.Fasta import open_reference
 import random
 
 g_version = None
@@ -10,7 +10,7 @@ def main(args):
   myrandom.seed(args.seed)
   sum = 0
   if args.reference_genome:
-    ref = FastaData(open(args.reference_genome).read())
+    ref = open_reference(args.reference_genome)
     for name in ref.keys():
       sum += len(ref[name])
   else:
@@ -107,7 +107,7 @@ def do_inputs():
   parser = argparse.ArgumentParser(description="convert bed depth from depth to strata",formatter_class=argparse.ArgumentDefaultsHelpFormatter)
   parser.add_argument('input',help="bed or - for STDIN")
   group = parser.add_mutually_exclusive_group(required=True)
-  group.add_argument('-r','--reference_genome',help="fasta reference genome")
+  group.add_argument('-r','--reference_genome',help="fasta or .2bit reference genome")
   group.add_argument('-l','--reference_lengths',help="lenths of reference chromosomes TSV <chr> <length>")
   #parser.add_argument('reference_genome',help="fasta reference genome")
   #parser.add_argument('strata',type=int,help="number of strata to group reads into")
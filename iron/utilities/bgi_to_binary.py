@@ -0,0 +1,19 @@
+#!/usr/bin/python
+import sys, argparse
+from Bio.Format.BamIndex import convert_index, is_binary_index
+
+# Convert a gzipped TSV .bgi index into the compact binary .bgi
+# that Bio.Format.BamIndex.BinaryBAMIndex mmaps
+
+def main():
+  parser = argparse.ArgumentParser(description="Convert a gzipped TSV .bgi index to the binary .bgi format",formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  parser.add_argument('input',help="gzipped TSV .bgi index")
+  parser.add_argument('-o','--output',required=True,help="binary index to write")
+  args = parser.parse_args()
+  if is_binary_index(args.input):
+    sys.stderr.write("ERROR: input is already a binary index\n")
+    sys.exit()
+  convert_index(args.input,args.output)
+
+if __name__=="__main__":
+  main()
@@ -9,6 +9,8 @@ def main():
   group.add_argument('-z','--zip',action='store_true',help="compress the file or stream")
   group.add_argument('-x','--unzip',action='store_true',help="uncompress the archive or stream")
   parser.add_argument('-o','--output',help="output file")
+  parser.add_argument('--threads',type=int,default=1,help="number of threads to compress or decompress with")
+  parser.add_argument('-l','--level',type=int,default=9,choices=range(1,10),help="compression level when zipping")
   args = parser.parse_args()
   
   of = sys.stdout
@@ -17,23 +19,24 @@ def main():
   if args.input == '-':
     if args.unzip:
       inf = sys.stdin
-      br = Bio.Format.BGZF.reader(inf)
+      br = Bio.Format.BGZF.reader(inf,threads=args.threads)
     else: 
       inf = sys.stdin
-      bw = Bio.Format.BGZF.writer(of)
+      bw = Bio.Format.BGZF.writer(of,level=args.level,threads=args.threads)
   else: 
     if args.unzip:
       inf = open(args.input,'rb')
-      br = Bio.Format.BGZF.reader(inf)
+      br = Bio.Format.BGZF.reader(inf,threads=args.threads)
     else: 
       inf = open(args.input,'rb')
-      bw = Bio.Format.BGZF.writer(of)
+      bw = Bio.Format.BGZF.writer(of,level=args.level,threads=args.threads)
 
   if args.unzip:
     while True:
       v = br.read(1000000)
       if len(v) == 0: break
       of.write(v)
+    br.close()
     inf.close()
     of.close()
   else: # we zip it up 
@@ -1,12 +1,11 @@
 #!/usr/bin/python
 import argparse, os, sys, re
-from subprocess import call, Popen, PIPE
-from Bio.Format.Sam import BAMFile
+from Bio.Format.Sam import BAMFile, BAMWriter, SamStream
 
 def main():
   parser = argparse.ArgumentParser(description="Take multiple bam files and produce a single sorted bam output.")
   parser.add_argument('-o','--output',required=True,help="BAMFILE output name")
-  #parser.add_argument('--threads',type=int,default=1)
+  parser.add_argument('--threads',type=int,default=1,help="threads to compress the output with")
   #parser.add_argument('--sort',action='store_true',help="sort output")
   #parser.add_argument('--name',action='store_true',help="sort the BAM file by name")
   parser.add_argument('--numeric_names',action='store_true',help="order by integer in name")
@@ -34,18 +33,27 @@ def main():
   #if args.threads > 1: thread_option = ' --threads '+str(args.threads)+' '
   of = sys.stdout
   if args.output != '-':
-    of = open(args.output,'w')
-  cmd = 'samtools view -Sb - '
-  p1 = Popen(cmd.split(),stdin=PIPE,stdout=of)
-  cmd = 'samtools view -H '+args.input[0]
-  p2 = Popen(cmd.split(),stdout=p1.stdin)
-  p2.communicate()
+    of = open(args.output,'wb')
+  # header comes from the first input, entries are matched to its references by name
+  if re.search('\.bam$',args.input[0]):
+    bf = BAMFile(args.input[0])
+    w = BAMWriter(of,bf.header_text,bf.ref_names,bf.ref_lengths,threads=args.threads)
+    bf.close()
+  else:
+    inf = open(args.input[0])
+    w = BAMWriter(of,SamStream(inf).header_text,threads=args.threads)
+    inf.close()
   for file in names:
-    cmd = 'samtools view '+file
-    p3 = Popen(cmd.split(),stdout=p1.stdin)
-    p3.communicate()
+    if re.search('\.bam$',file):
+      bf = BAMFile(file,compact=True)
+      for e in bf: w.write_entry(e)
+      bf.close()
+    else:
+      inf = open(file)
+      for e in SamStream(inf): w.write_entry(e)
+      inf.close()
     sys.stderr.write('done '+file+"\n")
-  p1.communicate()
+  w.close()
   of.close()
   #cmd = 'samtools view -Sb '+args.input+' | samtools sort - '+m.group(1)+'.sorted' 
   #sys.stderr.write(cmd+"\n")
@@ -1,8 +1,7 @@
 #!/usr/bin/python
 import sys, argparse, re, os
-from subprocess import Popen, PIPE
-from SamBasics import is_header
-from multiprocessing import cpu_count, Pool
+from multiprocessing import cpu_count
+from Bio.Format.Sam import BAMFile, BAMWriter
 
 def main():
   parser = argparse.ArgumentParser(description="Break a bam into evenly sized chunks",formatter_class=argparse.ArgumentDefaultsHelpFormatter)
@@ -14,62 +13,34 @@ def main():
   parser.add_argument('-F',help="Add an input flag filter if you are reading from a bam file")
   args = parser.parse_args()
   
-  # read header first
-  header = []
-  cmd = "samtools view -H "+args.input
-  p = Popen(cmd.split(),stdout=PIPE,bufsize=1)
-  inf = p.stdout
-  for line in inf:
-    header.append(line)
-  p.communicate()
-
-  inf = None
-  cmd = "samtools view "+args.input
-  if args.F:
-    cmd += " -F "+args.F
-  p = Popen(cmd.split(),stdout=PIPE,bufsize=1)
-  rex = re.compile('^(\S+)')
+  bf = BAMFile(args.input,threads=args.threads,compact=True)
+  flag_filter = 0
+  if args.F: flag_filter = int(args.F,0)
   buffersize = args.k
-  buffer = []
+  count = 0
   prev_name = None
   i = 0
-  poo = Pool(processes=max(1,args.threads-2))
-  while True:
-    line = p.stdout.readline()
-    if not line: break
+  w = None
+  for e in bf:
+    if e.value('flag') & flag_filter: continue
     if args.name:
-      m = rex.match(line)
-      if prev_name and m.group(1) != prev_name and len(buffer) >= buffersize:
-        i+= 1 
-        poo.apply_async(do_output,args=(buffer[:],header,i,args.output_base))
-        buffer = []
-      prev_name = m.group(1)
-    else:
-      if len(buffer) >= buffersize:
-        i+=1
-        poo.apply_async(do_output,args=(buffer[:],header,i,args.output_base))
-        buffer = []
-    buffer.append(line)
-  # Deal with remainder
-  if len(buffer) > 0: 
-    i+=1
-    poo.apply_async(do_output,args=(buffer[:],header,i,args.output_base))
-    buffer = []
-  poo.close()
-  poo.join()
+      name = e.value('qname')
+      if prev_name and name != prev_name and count >= buffersize:
+        w.close()
+        w = None
+      prev_name = name
+    elif count >= buffersize:
+      w.close()
+      w = None
+    if not w:
+      i += 1
+      w = BAMWriter(args.output_base+'.'+str(i)+'.bam',bf.header_text,bf.ref_names,bf.ref_lengths,threads=args.threads)
+      count = 0
+    w.write_entry(e)
+    count += 1
+  if w: w.close()
+  bf.close()
   print i
 
-def do_output(buffer,header,i,output_base):
-  of = open(output_base+'.'+str(i)+'.bam','w')
-  cmd = 'samtools view - -Sb'
-  p = Popen(cmd.split(),stdin=PIPE,stdout=of)
-  for e in header:
-    p.stdin.write(e)
-  for e in buffer:
-    p.stdin.write(e)
-  p.communicate()
-  of.close()
-  return
-
 if __name__=="__main__":
   main()
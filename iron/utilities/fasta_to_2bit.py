@@ -0,0 +1,27 @@
+#!/usr/bin/python
+import argparse, sys
+from Bio.Format.Fasta import write_2bit, TwoBitFasta
+
+# Convert a fasta reference (gzipped or not) to UCSC .2bit once
+# so it can be opened with TwoBitFasta or open_reference
+# without reading the whole genome into every process
+
+def main():
+  args = do_inputs()
+  write_2bit(args.fasta_file,args.output)
+  if args.verbose:
+    ref = TwoBitFasta(args.output)
+    for name in ref.keys():
+      sys.stderr.write(name+"\t"+str(len(ref[name]))+"\n")
+    ref.close()
+
+def do_inputs():
+  parser = argparse.ArgumentParser(description="Convert a fasta to .2bit",formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  parser.add_argument('fasta_file',help="FASTAFILE can be gzipped")
+  parser.add_argument('-o','--output',required=True,help="OUTPUT .2bit file")
+  parser.add_argument('-v','--verbose',action='store_true',help="write chromosome lengths to STDERR")
+  args = parser.parse_args()
+  return args
+
+if __name__=="__main__":
+  main()
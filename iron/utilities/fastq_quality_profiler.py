@@ -1,7 +1,7 @@
 #!/usr/bin/python
 import argparse, sys, gzip
 import FASTQBasics
-from SequenceBasics import FastqHandleReader
+from Bio.Format.Fastq import FastqBatchHandle
 import random
 
 def main():
@@ -17,20 +17,19 @@ def main():
     do_reader(args) #jump down to just reading and reporting on the contents of a profile
     return
   if args.input != '-':  
-    if args.input[-3:] == '.gz':
-      inf = gzip.open(args.input)
-    inf = open(args.input)
-  fqr = FastqHandleReader(inf)
+    inf = open(args.input,'rb')
+  fqr = FastqBatchHandle(inf)
   buffer = []
   type = None
   if not args.quality_type:
     detector = FASTQBasics.QualityFormatDetector()
-    while True:
-      entry = fqr.read_entry()
-      if not entry: break
-      buffer.append(entry)
-      detector.record_observation(entry['qual'])
-      if len(buffer) >= args.autodetect_depth: break
+    while len(buffer) < args.autodetect_depth:
+      batch = fqr.get_batch()
+      if not batch: break
+      # the detector only counts characters so a batch goes in at once
+      # but only up to the autodetect depth, the rest is kept for profiling
+      detector.record_observation(''.join(batch.quals[0:args.autodetect_depth-len(buffer)]))
+      buffer += batch.quals
     type = detector.call_type()
     sys.stderr.write(detector.about+"\n")
   else:
@@ -39,16 +38,18 @@ def main():
   # Now that we have a type, we can do some profiling
   stats = {}
   z = 0
+  quals = iter(buffer)
   while True:
     if args.training_depth:
       if z > args.training_depth: break
     z += 1
-    if len(buffer) > 0:
-      entry = buffer.pop()
-    else:
-      entry = fqr.read_entry()
-    if not entry: break
-    qp.record_observation(entry['qual'])
+    qual = next(quals,None)
+    if qual is None:
+      batch = fqr.get_batch()
+      if not batch: break
+      quals = iter(batch.quals)
+      qual = next(quals)
+    qp.record_observation(qual)
     if z % 100 == 0:
       sys.stderr.write(str(z)+"\r")
   sys.stderr.write("\n")
@@ -1,6 +1,7 @@
 #!/usr/bin/python
 import sys, argparse, re
 from subprocess import PIPE, Popen
+from Bio.Format.Sam import BAMFile, BAMWriter
 
 def main():
   parser = argparse.ArgumentParser(description="",formatter_class=argparse.ArgumentDefaultsHelpFormatter)
@@ -10,7 +11,11 @@ def main():
   parser.add_argument('--ont_base',action='store_true',help="input is ont molecule in from <molecule name><_2D|_tem|_com>")
   parser.add_argument('-o','--output',help="Output to bam file, leave blank for stdout")
   parser.add_argument('--inv',action='store_true',help="Get all names NOT in this list")
+  parser.add_argument('--bgi',action='store_true',help="Look the names up in the bam's .bgi index rather than reading every entry")
   args = parser.parse_args()
+  if args.bgi and (args.input == '-' or args.inv or args.pacbio_base or args.ont_base):
+    sys.stderr.write("ERROR: --bgi needs a bam file and exact names\n")
+    sys.exit()
   
   names = set()
   with open(args.name_list) as inf:
@@ -26,6 +31,9 @@ def main():
       else:
         name = line.rstrip()
         names.add(name)
+  if args.bgi:
+    do_bgi(args,names)
+    return
   inf = sys.stdin
   if args.input != '-':
     cmd = 'samtools view -h '+args.input
@@ -68,5 +76,20 @@ def main():
     p.communicate()
   if args.output:
     po.communicate()
+# Fetch the entries for the names through the .bgi in file order
+def do_bgi(args,names):
+  bf = BAMFile(args.input,compact=True)
+  w = None
+  if args.output:
+    w = BAMWriter(args.output,bf.header_text,bf.ref_names,bf.ref_lengths)
+  else:
+    of = sys.stdout
+    if bf.header_text: of.write(bf.header_text.rstrip("\n")+"\n")
+  for e in bf.fetch_by_names(names,file_order=True):
+    if w: w.write_entry(e)
+    else: of.write(e.get_bam().get_line()+"\n")
+  bf.close()
+  if w: w.close()
+
 if __name__=="__main__":
   main()
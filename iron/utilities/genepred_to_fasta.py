@@ -14,7 +14,11 @@ if cmd_subfolder not in sys.path:
 
 
 import genepred_basics
+from Bio.Format.Fasta import FastaFile, TwoBitFasta, is_2bit_file
+from Bio.Range import GenomicRange
 
+# transcripts to fetch sequence for in one batch
+batch_size = 10000
 
 def main():
 
@@ -27,9 +31,49 @@ def main():
   dodirectionless = 0
   if len(sys.argv) == 5:
     dodirectionless = 1
-  if dodirectionless == 1:
+  # indexed references are read in batches instead of loading the genome
+  if os.path.isfile(genome_filename+'.fai') or is_2bit_file(genome_filename):
+    write_fasta_batched(genepred_filename,genome_filename,output_filename,dodirectionless)
+  elif dodirectionless == 1:
     genepred_basics.write_genepred_to_fasta_directionless(genepred_filename,genome_filename,output_filename)
   else:
     genepred_basics.write_genepred_to_fasta(genepred_filename,genome_filename,output_filename)
 
+# pre: genepred, fasta with a .fai or a .2bit, output fasta
+# post: same output as genepred_basics.write_genepred_to_fasta
+def write_fasta_batched(genepred_filename,genome_filename,output_filename,dodirectionless):
+  ref = None
+  if is_2bit_file(genome_filename): ref = TwoBitFasta(genome_filename)
+  else: ref = FastaFile(genome_filename)
+  ofile = open(output_filename,'w')
+  batch = []
+  with open(genepred_filename) as f:
+    for line in f:
+      if line[0] == '#': continue
+      d = genepred_basics.genepred_line_to_dictionary(line)
+      if d['chrom'] not in ref: continue
+      batch.append(d)
+      if len(batch) >= batch_size:
+        write_batch(batch,ref,ofile,dodirectionless)
+        batch = []
+  write_batch(batch,ref,ofile,dodirectionless)
+  ofile.close()
+
+def write_batch(batch,ref,ofile,dodirectionless):
+  ranges = []
+  for d in batch:
+    dir = '+'
+    if d['strand'] == '-' and dodirectionless == 0: dir = '-'
+    # exons are fetched in reverse order on the minus strand so that each
+    # reverse complemented exon lands in place
+    exons = [GenomicRange(d['chrom'],d['exonStarts'][i]+1,d['exonEnds'][i],dir) for i in range(0,d['exonCount'])]
+    if dir == '-': exons.reverse()
+    ranges.append(exons)
+  seqs = ref.get_sequences([x for exons in ranges for x in exons])
+  pos = 0
+  for i in range(0,len(batch)):
+    n = len(ranges[i])
+    ofile.write(">"+str(batch[i]['name'])+"\n"+''.join(seqs[pos:pos+n]).upper()+"\n")
+    pos += n
+
 main()
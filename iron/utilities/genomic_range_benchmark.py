@@ -0,0 +1,110 @@
+#!/usr/bin/python
+import argparse, sys, random, time
+from Bio.Range import GenomicRange
+
+# Report how many ranges per second we can make and compare.
+# 'before' is the original GenomicRange, with a __dict__ and a payload
+# list on every instance and the long chain of comparisons in overlaps.
+# 'after' is the slotted Bio.Range.GenomicRange.
+
+def main():
+  args = do_inputs()
+  random.seed(1)
+  coords = []
+  for i in range(0,args.ranges):
+    start = random.randint(1,args.span)
+    coords.append(['chr'+str(random.randint(1,3)),start,start+random.randint(0,500)])
+  for name, cls in [['before',OriginalGenomicRange],['after',GenomicRange]]:
+    [made,rngs] = best_of(args.repeats,lambda: [cls(c[0],c[1],c[2]) for c in coords])
+    pairs = zip(rngs,rngs[1:]+rngs[0:1])
+    [overlapped,cnt] = best_of(args.repeats,lambda: len([1 for [a,b] in pairs if a.overlaps(b)]))
+    [sized,tot] = best_of(args.repeats,lambda: sum([a.overlap_size(b) for [a,b] in pairs]))
+    size = sys.getsizeof(rngs[0])
+    if hasattr(rngs[0],'__dict__'): size += sys.getsizeof(rngs[0].__dict__)+sys.getsizeof(rngs[0].payload)
+    print name+"\t"+str(int(len(coords)/made))+" constructed/sec\t"+str(int(len(pairs)/overlapped))+" overlaps/sec\t"+str(int(len(pairs)/sized))+" overlap_size/sec\t"+str(size)+" bytes/range\t"+str(cnt)+" overlapping\t"+str(tot)+" bases"
+
+# Post: [fastest time, result] of running func repeats times
+def best_of(repeats,func):
+  best = None
+  v = None
+  for i in range(0,repeats):
+    st = time.time()
+    v = func()
+    el = time.time()-st
+    if best is None or el < best: best = el
+  return [max(best,0.000001),v]
+
+# The original GenomicRange, kept only to compare against
+class OriginalGenomicRange:
+  def __init__(self,chr=None,start=None,end=None,dir=None):
+    self.chr = None
+    if chr:
+      self.chr = str(chr)
+    self.start = None
+    if start:
+      self.start = int(start)
+    if end:
+      self.end = int(end)
+    self.direction = dir
+    self.payload = []
+  def overlaps(self,in_genomic_range,use_direction=False,padding=0):
+    if padding > 0:
+      in_genomic_range = OriginalGenomicRange(in_genomic_range.chr,max([1,in_genomic_range.start-padding]),in_genomic_range.end+padding)
+    if self.chr != in_genomic_range.chr:
+      return False
+    if self.direction != in_genomic_range.direction and use_direction :
+      return False
+    if self.end < in_genomic_range.start:
+      return False
+    if in_genomic_range.end < self.start:
+      return False
+    if self.start > in_genomic_range.end:
+      return False
+    if in_genomic_range.start > self.end:
+      return False
+    if self.start <= in_genomic_range.start and self.end >= in_genomic_range.start:
+      return True
+    if self.start <= in_genomic_range.end and self.end >= in_genomic_range.end:
+      return True
+    if self.start >= in_genomic_range.start and self.end <= in_genomic_range.end:
+      return True
+    if self.start <= in_genomic_range.start and self.end >= in_genomic_range.end:
+      return True
+    if in_genomic_range.start <= self.start and in_genomic_range.end >= self.start:
+      return True
+    if in_genomic_range.start <= self.end and in_genomic_range.end >= self.end:
+      return True
+    return False
+  def overlap_size(self,in_genomic_range):
+    if self.chr != in_genomic_range.chr:
+      return 0
+    if self.end < in_genomic_range.start:
+      return 0
+    if in_genomic_range.end < self.start:
+      return 0
+    if self.start > in_genomic_range.end:
+      return 0
+    if self.start >= in_genomic_range.start and self.end <= in_genomic_range.end:
+      return self.end-self.start+1
+    if self.start <= in_genomic_range.start and self.end >= in_genomic_range.end:
+      return in_genomic_range.end-in_genomic_range.start+1
+    if self.start <= in_genomic_range.start and self.end >= in_genomic_range.start:
+      return self.end-in_genomic_range.start+1
+    if self.start <= in_genomic_range.end and self.end >= in_genomic_range.end:
+      return in_genomic_range.end-self.start+1
+    if in_genomic_range.start <= self.start and in_genomic_range.end >= self.start:
+      return in_genomic_range.end-self.start+1
+    if in_genomic_range.start <= self.end and in_genomic_range.end >= self.end:
+      return self.end-in_genomic_range.start+1
+    return 0
+
+def do_inputs():
+  parser = argparse.ArgumentParser(description="Benchmark making and comparing genomic ranges",formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  parser.add_argument('--ranges',type=int,default=500000,help="number of ranges to make")
+  parser.add_argument('--span',type=int,default=100000,help="ranges start in the first span bases of each chromosome")
+  parser.add_argument('--repeats',type=int,default=3,help="report the best of this many runs")
+  args = parser.parse_args()
+  return args
+
+if __name__=="__main__":
+  main()
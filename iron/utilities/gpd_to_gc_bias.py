@@ -7,7 +7,7 @@ from tempfile import mkdtemp, gettempdir
 from subprocess import PIPE, Popen
 
 from Bio.Format.GPD import GPDStream
-from Bio.Format.Fasta import FastaData
+from Bio.Format.Fasta import open_reference
 from Bio.Sequence import Seq
 
 # The stratified best_X_covered option requires external calls and bedtools
@@ -27,7 +27,7 @@ def main():
       inf = open(args.input)
 
   sys.stderr.write("reading in fasta\n")
-  f = FastaData(open(args.reference).read())
+  f = open_reference(args.reference)
   sh = GPDStream(inf)
   gc_bins = range(0,args.number_of_bins)
   bin_handles = []
@@ -160,7 +160,7 @@ def do_inputs():
   # Setup command line inputs
   parser=argparse.ArgumentParser(description="Report the GC Bias of reads for overall data",formatter_class=argparse.ArgumentDefaultsHelpFormatter)
   parser.add_argument('input',help="INPUT FILE or '-' for STDIN")
-  parser.add_argument('-r','--reference',required='True',help="Reference genome fasta")
+  parser.add_argument('-r','--reference',required='True',help="Reference genome fasta or .2bit")
   parser.add_argument('-o','--output',help="OUTPUTFILE or STDOUT if not set")
   parser.add_argument('--threads',type=int,default=cpu_count(),help="INT number of threads to run. Default is system cpu count")
 
@@ -1,7 +1,8 @@
 #!/usr/bin/python
 import sys, os, subprocess, multiprocessing, re, zlib, argparse
 import SamBasics
-from SequenceBasics import GenericFastqFileReader, read_fasta_into_hash
+from SequenceBasics import read_fasta_into_hash
+from Bio.Format.Fastq import FastqBatchHandle
 from random import randint
 from shutil import rmtree
 
@@ -327,26 +328,26 @@ def check_parameters(z,gz,ifile,tdir,max_allowed_mismatches,Q,fsize):
     return
 
 def read_fastq(fastq_file,maxcnt):
-  gfr = GenericFastqFileReader(fastq_file)
+  inf = open(fastq_file,'rb')
+  fqr = FastqBatchHandle(inf)
   ecnt = 0
   qseen = set()
   lenmax = 0
   lenmin = float('inf')
   entries = []
   bases = 0
-  while True:
-    e = gfr.read_entry()
-    if not e or ecnt > maxcnt: break
-    ecnt += 1
-    slen = len(e['seq'])
-    if slen < lenmin: lenmin = slen
-    if slen > lenmax: lenmax = slen
-    seq = e['seq']
-    bases += len(seq)
-    for v in [ord(x) for x in e['quality']]:
-      qseen.add(v)
-    entries.append(e)
-  gfr.close()
+  for batch in fqr:
+    n = min(len(batch),maxcnt+1-ecnt)
+    ecnt += n
+    lens = [len(x) for x in batch.seqs[0:n]]
+    lenmin = min([lenmin]+lens)
+    lenmax = max([lenmax]+lens)
+    bases += sum(lens)
+    qseen |= set([ord(x) for x in set(''.join(batch.quals[0:n]))])
+    for i in range(0,n):
+      entries.append({'name':batch.names[i].split("\t")[0],'seq':batch.seqs[i],'quality':batch.quals[i]})
+    if ecnt > maxcnt: break
+  inf.close()
   qmin = min(qseen)
   qmax = max(qseen)
   stats  = {}
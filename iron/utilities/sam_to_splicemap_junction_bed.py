@@ -26,28 +26,31 @@ def main():
   sys.stderr.write("reading through sam file\n")
   zall = 0
   zn = 0
-  while True:
-    line = inf.readline()
-    if not line: break
-    line = line.rstrip()
-    if SamBasics.is_header(line): continue
-    d = SamBasics.sam_line_to_dictionary(line)
-    chrom = d['rname']
+  refs = set(g.keys())
+  # lines are read in chunks, and only the first columns are split
+  # until a line is known to have an N in its cigar
+  for line in iter_lines(inf):
+    if line[0] == '@' and SamBasics.is_header(line): continue
+    f = line.split("\t",6)
+    chrom = f[2]
     if chrom =='*': continue
-    if chrom not in g.keys():
+    if chrom not in refs:
       sys.stderr.write("WARNING: "+chrom+" not in reference, skipping\n")
       continue
+    flag = int(f[1])
     mate = 'U'
-    if SamBasics.check_flag(d['flag'],int('0x4',16)): #check if its unmapped
+    if flag & 0x4: #check if its unmapped
       continue  # we can ignore the unmapped things for now
-    if SamBasics.check_flag(d['flag'],int('0x40',16)):
+    if flag & 0x40:
       mate = 'L'
-    elif SamBasics.check_flag(d['flag'],int('0x80',16)):
+    elif flag & 0x80:
       mate = 'R'
-    actual_read = d['qname']+"\t"+mate
+    actual_read = f[0]+"\t"+mate
     if actual_read not in read_mapping_count:
       read_mapping_count[actual_read] = 0
     read_mapping_count[actual_read] += 1
+    if 'N' not in f[5]: continue # there are no splices to report here
+    d = SamBasics.sam_line_to_dictionary(line.rstrip())
     has_intron = 0
     start_loc = d['pos']
     current_loc = start_loc
@@ -146,6 +149,12 @@ def main():
     bed[3] = name
     of.write("\t".join(bed)+"\n")    
 
+def iter_lines(inf,chunk_bytes=4*1024*1024):
+  while True:
+    lines = inf.readlines(chunk_bytes)
+    if not lines: break
+    for line in lines: yield line
+
 def is_canon(input):
   v = set()
   v.add('GT-AG')
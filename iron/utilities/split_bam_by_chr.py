@@ -1,7 +1,7 @@
 #!/usr/bin/python
 import sys, argparse, re, os
-from subprocess import Popen, PIPE
 from multiprocessing import Process
+from Bio.Format.Sam import BAMFile, BAMWriter
 
 def main():
   parser = argparse.ArgumentParser(description="Split aligned reads into chromosomes",formatter_class=argparse.ArgumentDefaultsHelpFormatter)
@@ -16,14 +16,9 @@ def main():
   args.output = args.output.rstrip('/')
   if not os.path.exists(args.output):
     os.makedirs(args.output)
-  cmd = "samtools view -H "+args.input
-  p = Popen(cmd.split(),stdout=PIPE)
-  chrs = []
-  for line in p.stdout:
-    m = re.match('@SQ\tSN:(\S+)',line)
-    if not m: continue
-    chrs.append(m.group(1))
-  p.communicate()
+  bf = BAMFile(args.input)
+  chrs = bf.ref_names[:]
+  bf.close()
   ps = []
   for chr in chrs:
     ps.append(Process(target=do_chr,args=(chr,args,basename,)))
@@ -32,24 +27,21 @@ def main():
   for p in ps: p.join()
 
 def do_un(args,basename):
-    of = open(args.output+'/'+basename+'.unaligned.bam','w')
-    cmd1 = "samtools view -f 4 -h "+args.input
-    p1 = Popen(cmd1.split(),stdout=PIPE)
-    cmd2 = "samtools view -Sb -"
-    p2 = Popen(cmd2.split(),stdin=p1.stdout,stdout=of)
-    p2.communicate()
-    p1.communicate()
-    of.close()
+    bf = BAMFile(args.input,compact=True)
+    w = BAMWriter(args.output+'/'+basename+'.unaligned.bam',bf.header_text,bf.ref_names,bf.ref_lengths)
+    for e in bf:
+      if e.check_flag(4): w.write_entry(e)
+    w.close()
+    bf.close()
 
+# uses the .bai (or .csi) index to read just this chromosome
 def do_chr(chr,args,basename):
-    of = open(args.output+'/'+basename+'.'+chr+'.bam','w')
-    cmd1 = "samtools view -F 4 -h "+args.input+" "+chr
-    p1 = Popen(cmd1.split(),stdout=PIPE)
-    cmd2 = "samtools view -Sb -"
-    p2 = Popen(cmd2.split(),stdin=p1.stdout,stdout=of)
-    p2.communicate()
-    p1.communicate()
-    of.close()
+    bf = BAMFile(args.input,compact=True)
+    w = BAMWriter(args.output+'/'+basename+'.'+chr+'.bam',bf.header_text,bf.ref_names,bf.ref_lengths)
+    for e in bf.fetch(chr):
+      if not e.check_flag(4): w.write_entry(e)
+    w.close()
+    bf.close()
 
 if __name__=="__main__":
   main()